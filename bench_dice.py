@@ -0,0 +1,66 @@
+"""Микробенчмарк подсистемы кубиков.
+
+Запуск: python bench_dice.py
+"""
+import random
+import timeit
+
+import bot
+
+
+def legacy_roll(dice_expr):
+    """Прежняя реализация: разбор через split и цикл random.randint"""
+    if '+' in dice_expr:
+        dice_part, bonus_part = dice_expr.split('+')
+        bonus = int(bonus_part)
+    elif '-' in dice_expr:
+        dice_part, penalty_part = dice_expr.split('-')
+        bonus = -int(penalty_part)
+    else:
+        dice_part = dice_expr
+        bonus = 0
+    num_dice, sides = map(int, dice_part.split('d'))
+    return sum(random.randint(1, sides) for _ in range(num_dice)) + bonus
+
+
+def report(name, seconds, operations, unit):
+    print(f"{name:<45} {operations / seconds:>14,.0f} {unit}/с")
+
+
+def bench(name, fn, operations=1, unit="оп", number=None):
+    timer = timeit.Timer(fn)
+    if number is None:
+        number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=3, number=number)) / number
+    report(name, seconds, operations, unit)
+
+
+def main():
+    text = "Гоблин атакует {1d20+4}, урон {2d6+2}. Ты отвечаешь с преимуществом {2d20kh1+5} и наносишь {8d6+1d4+3}."
+
+    print("Разбор")
+    bench("compile_dice (кэш)", lambda: bot.compile_dice("8d6+1d4+3"))
+    bench("compile_dice (без кэша)", lambda: bot.compile_dice.__wrapped__("8d6+1d4+3"))
+
+    print("\nОдиночные броски")
+    bench("legacy 2d6+3", lambda: legacy_roll("2d6+3"), unit="бросков")
+    bench("DiceExpression.roll 2d6+3", lambda: bot.compile_dice("2d6+3").roll(), unit="бросков")
+    bench("process_dice_rolls (4 выражения в тексте)", lambda: bot.process_dice_rolls(text), unit="текстов")
+
+    print("\nБольшие пулы")
+    bench("legacy 1000d100", lambda: legacy_roll("1000d100"), 1000, "кубиков")
+    bench("DiceExpression.roll 1000d100", lambda: bot.compile_dice("1000d100").roll(), 1000, "кубиков")
+
+    print("\nПовторные броски (векторно)")
+    for expr, times in (("3d6", 100000), ("2d20kh1+5", 100000), ("4d6dl1", 100000)):
+        expression = bot.compile_dice(expr)
+        dice = sum(term.count for _, term in expression.terms if isinstance(term, bot.DiceGroup))
+        bench(f"roll_many {times}×{expr}", lambda: expression.roll_many(times), times * dice, "кубиков")
+
+    print("\nРаспределения (без кэша)")
+    for expr in ("8d6+1d4+3", "2d20kh1+5", "4d6dl1", "10d20kh3", "1000d100"):
+        bench(f"distribution {expr}", lambda: bot.compile_dice.__wrapped__(expr).distribution(), unit="расчетов", number=3)
+
+
+if __name__ == "__main__":
+    main()
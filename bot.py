@@ -1,32 +1,961 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import gzip
+import hashlib
+import hmac
 import logging
+import math
 import sqlite3
 import json
 import os
 import random
 import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit
+import httpx
+import numpy as np
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 import pyttsx3
-from together import Together
 
 # Настройка логирования
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger(__name__ + ".trace")
 
-# Инициализация клиента Together AI
-together_client = Together(api_key=os.environ.get("TOGETHER_API_KEY", "your_api_key_here"))
-
-# Функция для вызова LLM как предоставлено
-def ask_llm(prompt, system_prompt):
-    response = together_client.chat.completions.create(
-        model="deepseek-ai/DeepSeek-V3",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=1.1
-    )
-    return response.choices[0].message.content
+# Метрики и трассировка
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # 0 — HTTP-эндпоинт выключен
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN = float(os.environ.get("LOOP_LAG_WARN", "0.1"))
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class TraceLogFilter(logging.Filter):
+    """Добавить в записи журнала correlation ID текущего обновления"""
+
+    def filter(self, record):
+        trace = current_trace.get()
+        record.trace_id = trace.trace_id if trace else "-"
+        return True
+
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TraceLogFilter())
+
+class Metrics:
+    """Счетчики, показатели и гистограммы в текстовом формате Prometheus
+
+    Обновляются только из цикла событий, поэтому блокировки не нужны.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    HELP = {
+        "bot_stage_seconds": "Время этапов обработки",
+        "bot_request_seconds": "Полное время обработки обновления или хода",
+        "bot_llm_requests_total": "Запросы к LLM",
+        "bot_llm_tokens_total": "Токены промптов и ответов LLM",
+        "bot_llm_first_token_seconds": "Время до первого фрагмента потокового ответа",
+        "bot_llm_backend_seconds": "Время запроса к бэкенду LLM",
+        "bot_llm_hedges_total": "Дублирующие запросы к запасному бэкенду",
+        "bot_llm_hedge_wins_total": "Дублирующие запросы, ответившие первыми",
+        "bot_llm_breaker_open": "Выключатель бэкенда разомкнут",
+        "bot_queue_wait_seconds": "Ожидание задачи в очереди планировщика",
+        "bot_queue_depth": "Задач в очереди планировщика",
+        "bot_jobs_running": "Выполняемых задач планировщика",
+        "bot_event_loop_lag_seconds": "Задержка цикла событий",
+        "bot_history_rows_total": "Сообщений истории, сохраненных групповой записью",
+        "bot_history_flushes_total": "Транзакций групповой записи истории",
+        "bot_archived_messages_total": "Сообщений, перенесенных в архив",
+        "bot_reclaimed_bytes_total": "Байт, возвращенных incremental_vacuum",
+        "bot_webhook_updates_total": "Обновления, принятые вебхуком, по рабочим процессам",
+        "bot_webhook_rejected_total": "Обновления, отклоненные из-за переполнения очереди",
+        "bot_webhook_queue_depth": "Обновлений в очереди пересылки рабочему процессу",
+        "bot_webhook_worker_restarts_total": "Перезапуски рабочих процессов",
+    }
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._types = {}
+        self._values = {}  # name -> {labels: значение или [счетчики корзин, сумма, количество]}
+
+    def _series(self, name, kind, labels):
+        self._types.setdefault(name, kind)
+        return self._values.setdefault(name, {}), tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        series, key = self._series(name, "counter", labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        series, key = self._series(name, "gauge", labels)
+        series[key] = value
+
+    def observe(self, name, value, **labels):
+        series, key = self._series(name, "histogram", labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self):
+        """Вернуть все метрики в текстовом формате Prometheus"""
+        lines = []
+        for name, series in self._values.items():
+            kind = self._types[name]
+            if name in self.HELP:
+                lines.append(f"# HELP {name} {self.HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in series.items():
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {bucket_count}")
+                lines.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(key)} {total}")
+                lines.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class Trace:
+    """Трассировка одного обновления или хода МП
+
+    Хранит correlation ID, суммарное время по этапам и счетчики (токены).
+    По завершении пишет одну структурированную запись в журнал bot.trace.
+    """
+
+    def __init__(self, kind, **fields):
+        self.trace_id = os.urandom(6).hex()
+        self.kind = kind
+        self.fields = fields
+        self.stages = {}
+        self.counts = {}
+        self.started = time.perf_counter()
+
+    def add(self, stage_name, seconds):
+        self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self, status="ok"):
+        duration = time.perf_counter() - self.started
+        metrics.observe("bot_request_seconds", duration, kind=self.kind, status=status)
+        session_recorder.trace(self, duration, status)
+        trace_logger.info(json.dumps({
+            "trace_id": self.trace_id,
+            "kind": self.kind,
+            "status": status,
+            "duration_ms": round(duration * 1000, 1),
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            **self.counts,
+            **self.fields,
+        }, ensure_ascii=False, default=str))
+
+@contextlib.contextmanager
+def stage(name):
+    """Замерить этап: гистограмма bot_stage_seconds и время в текущей трассировке"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("bot_stage_seconds", elapsed, stage=name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+def count_trace(name, value):
+    """Добавить значение счетчика (например, токенов) в текущую трассировку"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.count(name, value)
+
+@contextlib.contextmanager
+def tracing(trace):
+    """Сделать trace текущей трассировкой и завершить ее на выходе"""
+    token = current_trace.set(trace)
+    status = "ok"
+    try:
+        yield trace
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        trace.finish(status)
+        current_trace.reset(token)
+
+def traced(handler):
+    """Обернуть обработчик Telegram: новая трассировка на каждое обновление"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        chat = update.effective_chat
+        session_recorder.update(handler.__name__, update, context)
+        with tracing(Trace(handler.__name__, update_id=update.update_id, chat_id=chat.id if chat else None)):
+            return await handler(update, context)
+    return wrapper
+
+async def watch_event_loop(interval=LOOP_LAG_INTERVAL):
+    """Измерять задержку цикла событий: насколько позже срока просыпается sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        metrics.observe("bot_event_loop_lag_seconds", lag)
+        if lag > LOOP_LAG_WARN:
+            logger.warning(f"Цикл событий был заблокирован на {lag * 1000:.0f} мс")
+
+class MetricsServer:
+    """Минимальный HTTP-сервер: GET /metrics отдает метрики Prometheus"""
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._lag_task = None
+
+    async def start(self):
+        self._lag_task = asyncio.create_task(watch_event_loop())
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+metrics_server = MetricsServer()
+
+# Запись игровых сессий для детерминированного воспроизведения (replay.py)
+SESSION_TRACE_PATH = os.environ.get("SESSION_TRACE_PATH")  # .gz — сжатая запись
+
+class SessionRecorder:
+    """Запись сессии в JSONL: обновления, ходы, ответы LLM, зерно кубиков и итоги трассировок
+
+    Каждое событие хранит смещение от начала записи в секундах. Промпты
+    сохраняются только хэшем и оценкой размера, чтобы запись оставалась
+    компактной; ответы LLM сохраняются целиком для воспроизведения.
+    Запросы к LLM нумеруются в каждом чате в порядке начала, а для ходов
+    записывается состав раунда, поэтому воспроизведение сопоставляет
+    ответы с запросами, не завися от таймингов.
+    """
+
+    def __init__(self, path=SESSION_TRACE_PATH):
+        self.path = path
+        self._file = None
+        self._started = 0.0
+        self._llm_calls = {}  # chat_id -> число начатых запросов к LLM
+
+    @property
+    def active(self):
+        return self._file is not None
+
+    def start(self):
+        if not self.path:
+            return
+        opener = gzip.open if self.path.endswith(".gz") else open
+        self._file = opener(self.path, "at", encoding="utf-8")
+        self._started = time.monotonic()
+        seed = int.from_bytes(os.urandom(4), "big")
+        seed_dice(seed)
+        self._write({"type": "start", "seed": seed, "model": LLM_MODEL, "streaming": LLM_STREAMING,
+                     "turn_window": TURN_WINDOW, "stream_edit_interval": STREAM_EDIT_INTERVAL})
+        logger.info(f"Запись сессий в {self.path}")
+
+    def stop(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, event):
+        event["t"] = round(time.monotonic() - self._started, 4)
+        self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def update(self, handler_name, update, context):
+        """Записать входящее обновление до его обработки"""
+        if not self.active:
+            return
+        user = update.effective_user
+        self._write({
+            "type": "update",
+            "update_id": update.update_id,
+            "handler": handler_name,
+            "chat_id": update.effective_chat.id,
+            "user_id": user.id if user else None,
+            "first_name": user.first_name if user else None,
+            "text": update.message.text if update.message else None,
+            "session_id": context.chat_data.get('active_session_id'),
+        })
+
+    def llm_call(self):
+        """Номер начатого запроса к LLM в чате текущей трассировки (None, если запись выключена)"""
+        if not self.active:
+            return None
+        chat_id = _trace_chat_id()
+        seq = self._llm_calls.get(chat_id, 0)
+        self._llm_calls[chat_id] = seq + 1
+        return seq
+
+    def llm(self, seq, system_prompt, prompt, text, elapsed):
+        """Записать ответ LLM; ключ — чат текущей трассировки и номер запроса в нем"""
+        if not self.active or seq is None:
+            return
+        self._write({
+            "type": "llm",
+            "chat_id": _trace_chat_id(),
+            "seq": seq,
+            "system": prompt_key(system_prompt),
+            "prompt_sha": hashlib.sha1(prompt.encode()).hexdigest()[:16],
+            "prompt_tokens": count_tokens(prompt),
+            "latency": round(elapsed, 4),
+            "text": text,
+        })
+
+    def llm_failed(self, seq, system_prompt, status, elapsed):
+        """Записать запрос, не давший ответа: отмененный ("cancelled") или с ошибкой ("error")"""
+        if not self.active or seq is None:
+            return
+        self._write({
+            "type": "llm",
+            "chat_id": _trace_chat_id(),
+            "seq": seq,
+            "system": prompt_key(system_prompt),
+            "status": status,
+            "latency": round(elapsed, 4),
+        })
+
+    def batch(self, chat_id, update_ids):
+        """Записать состав раунда: какие обновления сыграны одним ходом"""
+        if self.active:
+            self._write({"type": "batch", "chat_id": chat_id, "updates": update_ids})
+
+    def trace(self, trace, duration, status):
+        """Записать итог трассировки для сравнения с воспроизведением"""
+        if not self.active:
+            return
+        self._write({
+            "type": "trace",
+            "kind": trace.kind,
+            "status": status,
+            "chat_id": trace.fields.get("chat_id"),
+            "duration": round(duration, 5),
+            "stages": {name: round(seconds, 5) for name, seconds in trace.stages.items()},
+        })
+
+def _trace_chat_id():
+    trace = current_trace.get()
+    return trace.fields.get("chat_id") if trace else None
+
+def prompt_key(system_prompt):
+    """Короткий хэш системного промпта: по нему ответы LLM сопоставляются при воспроизведении"""
+    return hashlib.sha1(system_prompt.encode()).hexdigest()[:12]
+
+session_recorder = SessionRecorder()
+
+# Настройки LLM (Together AI предоставляет OpenAI-совместимый API)
+LLM_API_BASE = os.environ.get("LLM_API_BASE", "https://api.together.xyz/v1")
+LLM_API_KEY = os.environ.get("TOGETHER_API_KEY", "your_api_key_here")
+LLM_MODEL = os.environ.get("LLM_MODEL", "deepseek-ai/DeepSeek-V3")
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", "20"))
+LLM_STREAMING = os.environ.get("LLM_STREAMING", "1") == "1"
+
+# Ограничения Telegram для потоковых ответов
+MESSAGE_LIMIT = 4000
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+
+class LLMClient:
+    """Асинхронный клиент chat-completions с пулом keep-alive соединений.
+
+    Семафор ограничивает число одновременных запросов для всего бота,
+    а каждый запрос имеет собственный таймаут, поэтому медленная генерация
+    в одном чате не задерживает обработку обновлений в других.
+    """
+
+    def __init__(self, name, api_base, api_key, model, max_concurrency, timeout, pool_size):
+        self.name = name
+        self.api_base = api_base.rstrip('/')
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+
+    def _get_client(self):
+        # Клиент создается лениво, уже внутри работающего цикла событий
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.api_base,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+            )
+        return self._client
+
+    def _payload(self, prompt, system_prompt, temperature, stream=False):
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": temperature,
+            "stream": stream,
+        }
+
+    async def complete(self, prompt, system_prompt, temperature=1.1, timeout=None):
+        """Отправить запрос к модели и вернуть текст ответа"""
+        payload = self._payload(prompt, system_prompt, temperature)
+        timeout = timeout or self.timeout
+        status = "error"
+        try:
+            async with self._semaphore:
+                started = time.perf_counter()
+                response = await asyncio.wait_for(
+                    self._get_client().post("/chat/completions", json=payload, timeout=timeout),
+                    timeout,
+                )
+            response.raise_for_status()
+            data = response.json()
+            text = data["choices"][0]["message"]["content"]
+            status = "ok"
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_llm_backend_seconds", elapsed, backend=self.name, mode="complete")
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            metrics.inc("bot_llm_requests_total", backend=self.name, mode="complete", status=status)
+        self._count_tokens(data.get("usage"), prompt, system_prompt, text)
+        return text
+
+    @staticmethod
+    def _count_tokens(usage, prompt, system_prompt, text):
+        """Учесть токены: по данным API, а если их нет — по оценке count_tokens"""
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens") or count_tokens(system_prompt) + count_tokens(prompt)
+        completion_tokens = usage.get("completion_tokens") or count_tokens(text)
+        metrics.inc("bot_llm_tokens_total", prompt_tokens, kind="prompt")
+        metrics.inc("bot_llm_tokens_total", completion_tokens, kind="completion")
+        count_trace("prompt_tokens", prompt_tokens)
+        count_trace("completion_tokens", completion_tokens)
+
+    async def stream(self, prompt, system_prompt, temperature=1.1, timeout=None):
+        """Отправить потоковый запрос и отдавать фрагменты текста по мере генерации"""
+        payload = self._payload(prompt, system_prompt, temperature, stream=True)
+        timeout = timeout or self.timeout
+        deadline = asyncio.get_running_loop().time() + timeout
+        text, usage, status = "", None, "error"
+        try:
+            async with self._semaphore:
+                started, consumer_time = time.perf_counter(), 0.0
+                async with self._get_client().stream("POST", "/chat/completions", json=payload, timeout=timeout) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if asyncio.get_running_loop().time() > deadline:
+                            raise asyncio.TimeoutError("Превышено время ожидания ответа LLM")
+                        # Формат Server-Sent Events: "data: {...}" или "data: [DONE]"
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        event = json.loads(data)
+                        usage = event.get("usage") or usage
+                        delta = event["choices"][0].get("delta", {}).get("content") if event.get("choices") else None
+                        if delta:
+                            if not text:
+                                metrics.observe("bot_llm_first_token_seconds", time.perf_counter() - started, backend=self.name)
+                            text += delta
+                            # Время обработки фрагмента потребителем не относится к LLM
+                            handed_off = time.perf_counter()
+                            yield delta
+                            consumer_time += time.perf_counter() - handed_off
+                elapsed = time.perf_counter() - started - consumer_time
+                metrics.observe("bot_llm_backend_seconds", elapsed, backend=self.name, mode="stream")
+            status = "ok"
+        except (asyncio.CancelledError, GeneratorExit):
+            status = "cancelled"
+            raise
+        finally:
+            metrics.inc("bot_llm_requests_total", backend=self.name, mode="stream", status=status)
+        self._count_tokens(usage, prompt, system_prompt, text)
+
+    async def aclose(self):
+        """Закрыть пул соединений"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# Маршрутизация между несколькими бэкендами
+LLM_BACKENDS = os.environ.get("LLM_BACKENDS")      # JSON-список, см. load_llm_backends
+LLM_FAST_MODEL = os.environ.get("LLM_FAST_MODEL")  # быстрая модель для дешевых задач
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "90"))
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "1.0"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.environ.get("LLM_HEDGE_DEFAULT_DELAY", "10"))
+LLM_STATS_WINDOW = int(os.environ.get("LLM_STATS_WINDOW", "200"))
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_ERROR_RATE = float(os.environ.get("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+
+TIER_MAIN = "main"  # ходы, вступления, сводки
+TIER_FAST = "fast"  # варианты кампаний и персонажей
+
+class LLMBackend:
+    """Бэкенд LLM со скользящей статистикой и автоматическим выключателем
+
+    Хранит время последних успешных ответов (полных и до первого
+    фрагмента) и исходы запросов. После LLM_BREAKER_FAILURES ошибок подряд
+    или доли ошибок выше LLM_BREAKER_ERROR_RATE выключатель размыкается на
+    cooldown секунд; затем пропускается один пробный запрос, и при новой
+    ошибке пауза удваивается.
+    """
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, client, tier=TIER_MAIN, window=LLM_STATS_WINDOW):
+        self.client = client
+        self.name = client.name
+        self.tier = tier
+        self.latencies = deque(maxlen=window)
+        self.first_token = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.failures = 0
+        self.cooldown = LLM_BREAKER_COOLDOWN
+        self.open_until = 0.0
+        self._probing = False
+
+    def available(self):
+        if not self.open_until:
+            return True
+        return time.monotonic() >= self.open_until and not self._probing
+
+    def begin(self):
+        """Отметить начало запроса; после паузы первый запрос становится пробным"""
+        if self.open_until and time.monotonic() >= self.open_until:
+            self._probing = True
+
+    def cancel(self):
+        """Запрос отменен (проиграл дублирующему) — это не ошибка бэкенда"""
+        self._probing = False
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def record(self, ok, latency=None, samples=None):
+        self.outcomes.append(ok)
+        if ok:
+            if samples is not None:
+                samples.append(latency)
+            self.failures = 0
+            if self.open_until:
+                logger.info(f"LLM {self.name}: бэкенд снова доступен")
+                self.open_until = 0.0
+                self.cooldown = LLM_BREAKER_COOLDOWN
+            self._probing = False
+        else:
+            self.failures += 1
+            too_many = len(self.outcomes) >= self.MIN_SAMPLES and self.error_rate() >= LLM_BREAKER_ERROR_RATE
+            if self._probing or self.failures >= LLM_BREAKER_FAILURES or too_many:
+                self._open()
+        metrics.set("bot_llm_breaker_open", 1 if self.open_until else 0, backend=self.name)
+
+    def _open(self):
+        if self._probing:
+            self.cooldown = min(self.cooldown * 2, LLM_BREAKER_COOLDOWN * 10)
+        self._probing = False
+        self.open_until = time.monotonic() + self.cooldown
+        self.outcomes.clear()
+        logger.warning(f"LLM {self.name}: выключатель разомкнут на {self.cooldown:.0f} с")
+
+    def hedge_delay(self, samples):
+        """Через сколько секунд без ответа отправлять дублирующий запрос"""
+        if len(samples) < self.MIN_SAMPLES:
+            return LLM_HEDGE_DEFAULT_DELAY
+        ordered = sorted(samples)
+        value = ordered[min(len(ordered) - 1, int(len(ordered) * LLM_HEDGE_PERCENTILE / 100))]
+        return max(LLM_HEDGE_MIN_DELAY, value)
+
+class LLMRouter:
+    """Маршрутизатор запросов между несколькими OpenAI-совместимыми бэкендами
+
+    Запрос уходит на первый доступный бэкенд своего уровня (TIER_FAST —
+    дешевые задачи, при отсутствии таких бэкендов используется основной).
+    Если ответа нет дольше LLM_HEDGE_PERCENTILE-перцентиля его задержки,
+    тот же запрос дублируется на следующий бэкенд и используется ответ,
+    пришедший первым; второй запрос отменяется. При ошибке запрос
+    сразу переходит на следующий бэкенд. Для потоковых ответов
+    сравнивается время до первого фрагмента.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+
+    def candidates(self, tier=TIER_MAIN):
+        preferred = ([backend for backend in self.backends if backend.tier == tier]
+                     + [backend for backend in self.backends if backend.tier != tier])
+        available = [backend for backend in preferred if backend.available()]
+        # Если выключены все, лучше попробовать основной, чем сразу отказать
+        return available or preferred[:1]
+
+    async def _attempt(self, backend, call, samples):
+        backend.begin()
+        started = time.perf_counter()
+        try:
+            result = await call(backend)
+        except asyncio.CancelledError:
+            backend.cancel()
+            raise
+        except Exception:
+            backend.record(False)
+            raise
+        backend.record(True, time.perf_counter() - started, getattr(backend, samples))
+        return result
+
+    async def _race(self, candidates, call, samples, discard=None):
+        """Выполнить call на бэкендах с дублированием и переходом при ошибке
+
+        discard освобождает результат проигравшего запроса, если тот
+        успел завершиться одновременно с победителем.
+        """
+        queue = list(candidates)
+        pending = {}
+        errors = []
+        hedged = False
+
+        def launch():
+            backend = queue.pop(0)
+            pending[asyncio.create_task(self._attempt(backend, call, samples))] = backend
+
+        launch()
+        try:
+            while pending:
+                delay = None
+                if queue and not hedged:
+                    primary = next(iter(pending.values()))
+                    delay = primary.hedge_delay(getattr(primary, samples))
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    metrics.inc("bot_llm_hedges_total", backend=queue[0].name)
+                    launch()
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is None:
+                        if hedged and backend is not candidates[0]:
+                            metrics.inc("bot_llm_hedge_wins_total", backend=backend.name)
+                        return backend, task.result()
+                    errors.append(task.exception())
+                    logger.warning(f"LLM {backend.name}: ошибка запроса: {task.exception()!r}")
+                    if queue and not pending:
+                        launch()
+            raise errors[-1]
+        finally:
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+                elif discard and not task.cancelled() and task.exception() is None:
+                    asyncio.create_task(discard(task.result()))
+
+    async def complete(self, prompt, system_prompt, temperature=1.1, timeout=None, tier=TIER_MAIN):
+        """Получить ответ модели целиком"""
+        seq = session_recorder.llm_call()
+        started = time.perf_counter()
+        try:
+            with stage("llm"):
+                _, text = await self._race(
+                    self.candidates(tier),
+                    lambda backend: backend.client.complete(prompt, system_prompt, temperature, timeout),
+                    "latencies",
+                )
+        except BaseException as e:
+            status = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+            session_recorder.llm_failed(seq, system_prompt, status, time.perf_counter() - started)
+            raise
+        # Записывается только ответ победившего бэкенда
+        session_recorder.llm(seq, system_prompt, prompt, text, time.perf_counter() - started)
+        return text
+
+    @staticmethod
+    async def _open_stream(backend, prompt, system_prompt, temperature, timeout):
+        # Поток считается ответившим, когда пришел первый фрагмент
+        chunks = backend.client.stream(prompt, system_prompt, temperature, timeout)
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = ""
+        except BaseException:
+            await chunks.aclose()
+            raise
+        return chunks, first
+
+    async def stream(self, prompt, system_prompt, temperature=1.1, timeout=None, tier=TIER_MAIN):
+        """Отдавать фрагменты ответа по мере генерации"""
+        seq = session_recorder.llm_call()
+        started, consumer_time, text = time.perf_counter(), 0.0, ""
+        try:
+            backend, (chunks, first) = await self._race(
+                self.candidates(tier),
+                lambda backend: self._open_stream(backend, prompt, system_prompt, temperature, timeout),
+                "first_token",
+                discard=lambda opened: opened[0].aclose(),
+            )
+        except BaseException as e:
+            status = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+            session_recorder.llm_failed(seq, system_prompt, status, time.perf_counter() - started)
+            raise
+        try:
+            if first:
+                text += first
+                handed_off = time.perf_counter()
+                yield first
+                consumer_time += time.perf_counter() - handed_off
+            async for chunk in chunks:
+                text += chunk
+                # Время обработки фрагмента потребителем не относится к LLM
+                handed_off = time.perf_counter()
+                yield chunk
+                consumer_time += time.perf_counter() - handed_off
+            session_recorder.llm(seq, system_prompt, prompt, text, time.perf_counter() - started - consumer_time)
+        except (asyncio.CancelledError, GeneratorExit):
+            session_recorder.llm_failed(seq, system_prompt, "cancelled", time.perf_counter() - started - consumer_time)
+            raise
+        except Exception:
+            backend.record(False)
+            session_recorder.llm_failed(seq, system_prompt, "error", time.perf_counter() - started - consumer_time)
+            raise
+        finally:
+            await chunks.aclose()
+            elapsed = time.perf_counter() - started - consumer_time
+            metrics.observe("bot_stage_seconds", elapsed, stage="llm")
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add("llm", elapsed)
+
+    async def aclose(self):
+        """Закрыть пулы соединений всех бэкендов"""
+        for backend in self.backends:
+            await backend.client.aclose()
+
+def load_llm_backends():
+    """Бэкенды из LLM_BACKENDS или из одиночных настроек LLM_*
+
+    LLM_BACKENDS — JSON-список, например:
+    [{"name": "together", "model": "deepseek-ai/DeepSeek-V3"},
+     {"name": "together-fast", "model": "meta-llama/Llama-3.3-70B-Instruct-Turbo", "tier": "fast"},
+     {"name": "local", "api_base": "http://127.0.0.1:8000/v1", "api_key": "-", "model": "local"}]
+    Необязательные поля: api_base, api_key или api_key_env, model, tier,
+    max_concurrency, timeout. Порядок списка — порядок предпочтения.
+    """
+    if LLM_BACKENDS:
+        specs = json.loads(LLM_BACKENDS)
+    else:
+        specs = [{"name": "primary"}]
+        if LLM_FAST_MODEL:
+            specs.append({"name": "fast", "model": LLM_FAST_MODEL, "tier": TIER_FAST})
+    backends = []
+    for spec in specs:
+        api_key = spec.get("api_key") or os.environ.get(spec.get("api_key_env", "TOGETHER_API_KEY"), LLM_API_KEY)
+        client = LLMClient(spec["name"], spec.get("api_base", LLM_API_BASE), api_key, spec.get("model", LLM_MODEL),
+                           spec.get("max_concurrency", LLM_MAX_CONCURRENCY), spec.get("timeout", LLM_TIMEOUT), LLM_POOL_SIZE)
+        backends.append(LLMBackend(client, spec.get("tier", TIER_MAIN)))
+    return backends
+
+llm_client = LLMRouter(load_llm_backends())
+
+# Функция для вызова LLM
+async def ask_llm(prompt, system_prompt, timeout=None, tier=TIER_MAIN):
+    return await llm_client.complete(prompt, system_prompt, timeout=timeout, tier=tier)
+
+# Дешевые задачи (варианты кампаний и персонажей) — на быстрых моделях
+async def ask_fast_llm(prompt, system_prompt, timeout=None):
+    return await ask_llm(prompt, system_prompt, timeout=timeout, tier=TIER_FAST)
+
+# Потоковый вариант ask_llm
+def stream_llm(prompt, system_prompt, timeout=None):
+    return llm_client.stream(prompt, system_prompt, timeout=timeout)
+
+# Планировщик тяжелой работы (LLM, TTS) с приоритетами и справедливостью между чатами
+PRIORITY_TURN = 0        # ходы игроков и вступления
+PRIORITY_OPTIONS = 1     # варианты кампаний и персонажей
+PRIORITY_VOICE = 2       # озвучка
+PRIORITY_BACKGROUND = 3  # фоновые задачи (сводки)
+
+SCHED_MAX_PER_CHAT = int(os.environ.get("SCHED_MAX_PER_CHAT", "4"))
+SCHED_MAX_QUEUED = int(os.environ.get("SCHED_MAX_QUEUED", "200"))
+
+class SchedulerBusy(Exception):
+    """Очередь переполнена — задача отклонена"""
+
+class JobSuperseded(Exception):
+    """Задача отменена более новой задачей с тем же ключом"""
+
+class _Job:
+    def __init__(self, chat_id, priority, fn, args, key):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+        self.trace = current_trace.get()
+        self.enqueued = time.perf_counter()
+
+class JobScheduler:
+    """Справедливый планировщик задач с ограниченной параллельностью
+
+    У каждого приоритета свой набор очередей по чатам. Свободный слот
+    получает задача с наивысшим приоритетом, а внутри приоритета чаты
+    обслуживаются по кругу, поэтому один активный чат не задерживает
+    остальные. Глубина очередей ограничена: при переполнении задача сразу
+    отклоняется с SchedulerBusy. Новая задача с тем же key отменяет
+    ожидающую старую (JobSuperseded).
+    """
+
+    def __init__(self, name, capacity, max_per_chat=SCHED_MAX_PER_CHAT, max_queued=SCHED_MAX_QUEUED):
+        self.name = name
+        self.capacity = capacity
+        self.max_per_chat = max_per_chat
+        self.max_queued = max_queued
+        self.running = 0
+        self.queued = 0
+        self._queues = {}  # priority -> OrderedDict(chat_id -> deque of _Job)
+        self._per_chat = {}
+
+    def overloaded(self, chat_id=None):
+        """Проверить, будет ли новая задача чата отклонена"""
+        if self.queued >= self.max_queued:
+            return True
+        return chat_id is not None and self._per_chat.get(chat_id, 0) >= self.max_per_chat
+
+    async def run(self, chat_id, priority, fn, *args, key=None):
+        """Поставить fn(*args) в очередь и дождаться результата"""
+        if key is not None:
+            self._supersede(chat_id, key)
+        if self.overloaded(chat_id):
+            raise SchedulerBusy(f"{self.name}: очередь переполнена")
+        job = _Job(chat_id, priority, fn, args, key)
+        self._queues.setdefault(priority, OrderedDict()).setdefault(chat_id, deque()).append(job)
+        self._per_chat[chat_id] = self._per_chat.get(chat_id, 0) + 1
+        self.queued += 1
+        self._dispatch()
+        return await job.future
+
+    def _supersede(self, chat_id, key):
+        for chats in self._queues.values():
+            jobs = chats.get(chat_id)
+            for job in list(jobs or ()):
+                if job.key == key:
+                    jobs.remove(job)
+                    self._forget(job)
+                    job.future.set_exception(JobSuperseded(key))
+            if jobs is not None and not jobs:
+                del chats[chat_id]
+
+    def _forget(self, job):
+        self.queued -= 1
+        self._per_chat[job.chat_id] -= 1
+        if not self._per_chat[job.chat_id]:
+            del self._per_chat[job.chat_id]
+
+    def _next_job(self):
+        for priority in sorted(self._queues):
+            chats = self._queues[priority]
+            while chats:
+                # Круговой обход: чат уходит в конец очереди после каждой задачи
+                chat_id, jobs = chats.popitem(last=False)
+                job = jobs.popleft()
+                if jobs:
+                    chats[chat_id] = jobs
+                if job.future.done():  # ожидающий отменил задачу
+                    self._forget(job)
+                    continue
+                return job
+        return None
+
+    def _dispatch(self):
+        while self.running < self.capacity:
+            job = self._next_job()
+            if job is None:
+                break
+            self._forget(job)
+            self.running += 1
+            task = asyncio.create_task(self._execute(job))
+            # Если ожидающий отменил задачу, прервать и ее выполнение
+            job.future.add_done_callback(lambda future, task=task: future.cancelled() and task.cancel())
+        metrics.set("bot_queue_depth", self.queued, scheduler=self.name)
+        metrics.set("bot_jobs_running", self.running, scheduler=self.name)
+
+    async def _execute(self, job):
+        # Задача выполняется в трассировке того, кто ее поставил, а не того, кто освободил слот
+        current_trace.set(job.trace)
+        waited = time.perf_counter() - job.enqueued
+        metrics.observe("bot_queue_wait_seconds", waited, scheduler=self.name)
+        if job.trace is not None:
+            job.trace.add(f"queue_{self.name}", waited)
+        try:
+            result = await job.fn(*job.args)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+llm_scheduler = JobScheduler("llm", LLM_MAX_CONCURRENCY)
 
 # Системный промпт для Мастера Подземелий
 DM_SYSTEM_PROMPT = """
@@ -48,10 +977,118 @@ DM_SYSTEM_PROMPT = """
 Помни: Твоя цель — создавать веселые, запоминающиеся впечатления для игроков, а не "побеждать" их.
 """
 
+# Хранилище: долгоживущие соединения SQLite в режиме WAL
+DB_PATH = os.environ.get("DB_PATH", "dnd_bot.db")
+DB_READERS = int(os.environ.get("DB_READERS", "4"))
+
+class Database:
+    """Общий слой хранения с постоянными соединениями
+
+    Все записи выполняются одним потоком-писателем с собственным
+    соединением, чтения — пулом потоков, у каждого из которых свое
+    соединение. Благодаря WAL читатели не блокируют писателя, а запросы
+    не выполняются в цикле событий. Подготовленные выражения
+    переиспользуются через кэш выражений модуля sqlite3.
+    """
+
+    PRAGMAS = (
+        # Действует только для нового файла; существующий переводится командой compact-db
+        "PRAGMA auto_vacuum=INCREMENTAL",
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+    def _connection(self):
+        """Вернуть соединение текущего потока, открыв его при первом обращении"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _fetch(self, sql, params, one):
+        cursor = self._connection().execute(sql, params)
+        return cursor.fetchone() if one else cursor.fetchall()
+
+    def _transact(self, fn, args):
+        conn = self._connection()
+        with conn:
+            return fn(conn, *args)
+
+    async def fetchone(self, sql, params=()):
+        """Выполнить запрос на чтение и вернуть одну строку"""
+        loop = asyncio.get_running_loop()
+        with stage("db_read"):
+            return await loop.run_in_executor(self._readers, self._fetch, sql, params, True)
+
+    async def fetchall(self, sql, params=()):
+        """Выполнить запрос на чтение и вернуть все строки"""
+        loop = asyncio.get_running_loop()
+        with stage("db_read"):
+            return await loop.run_in_executor(self._readers, self._fetch, sql, params, False)
+
+    async def transaction(self, fn, *args):
+        """Выполнить fn(conn, *args) в потоке-писателе внутри одной транзакции"""
+        loop = asyncio.get_running_loop()
+        with stage("db_write"):
+            return await loop.run_in_executor(self._writer, self._transact, fn, args)
+
+    async def execute(self, sql, params=()):
+        """Выполнить одиночную запись и вернуть lastrowid"""
+        return await self.transaction(lambda conn: conn.execute(sql, params).lastrowid)
+
+    def run_sync(self, fn, *args):
+        """Синхронно выполнить транзакцию (для запуска до старта цикла событий)"""
+        return self._writer.submit(self._transact, fn, args).result()
+
+    def close(self):
+        """Остановить потоки и закрыть все соединения"""
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+db = Database(DB_PATH)
+
 # Настройка базы данных
 def setup_database():
-    """Создать схему базы данных SQLite, если она не существует"""
-    conn = sqlite3.connect('dnd_bot.db')
+    """Создать или обновить схему базы данных SQLite до последней версии"""
+    version = db.run_sync(_migrate)
+    for problem in db.run_sync(check_query_plans):
+        logger.warning(f"Запрос не использует индекс: {problem}")
+    logger.info(f"Настройка базы данных завершена (версия схемы {version})")
+
+def _migrate(conn):
+    """Применить недостающие миграции; версия хранится в PRAGMA user_version"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in enumerate(MIGRATIONS, start=1):
+        if target > version:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            logger.info(f"Применена миграция схемы {target}: {migration.__doc__}")
+            version = target
+    return version
+
+def _migration_1_base_schema(conn):
+    """Базовые таблицы"""
     cursor = conn.cursor()
     
     # Создать таблицу для игровых сессий
@@ -105,171 +1142,2334 @@ def setup_database():
         FOREIGN KEY (session_id) REFERENCES game_sessions(session_id)
     )
     ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("Настройка базы данных завершена")
 
-# Управление игровым контекстом
-def get_session_context(session_id):
-    """Получить состояние игры, персонажей и историю разговоров для сессии"""
-    conn = sqlite3.connect('dnd_bot.db')
-    cursor = conn.cursor()
-    
-    # Получить детали игровой сессии
-    cursor.execute("""
+def _migration_2_hot_indexes(conn):
+    """Индексы для частых запросов"""
+    # История сессии по возрастанию message_id: последние N сообщений — O(log n)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_session ON conversation_history (session_id, message_id)")
+    # Покрывающий индекс для поиска персонажа игрока
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_characters_player ON characters (session_id, player_id, name)")
+    # Активная сессия чата (session_id содержится в индексе как rowid)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_chat_active ON game_sessions (chat_id, is_active)")
+
+def _migration_3_campaign_memory(conn):
+    """Сводка ранней истории кампании"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS campaign_memory (
+        session_id INTEGER PRIMARY KEY,
+        summary TEXT NOT NULL,
+        summarized_upto INTEGER NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES game_sessions(session_id)
+    )
+    ''')
+
+def _migration_4_history_fts(conn):
+    """Полнотекстовый индекс истории"""
+    # Внешнее содержимое: индекс FTS5 не дублирует текст сообщений.
+    # Токен session_key ("s<id>") позволяет искать только внутри одной сессии.
+    conn.execute('''
+    CREATE VIEW IF NOT EXISTS history_fts_source AS
+    SELECT message_id, 's' || session_id AS session_key, content FROM conversation_history
+    ''')
+    conn.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+        session_key, content,
+        content='history_fts_source', content_rowid='message_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    # Ранжирование BM25 только по тексту сообщения
+    conn.execute("INSERT INTO history_fts(history_fts, rank) VALUES ('rank', 'bm25(0.0, 1.0)')")
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON conversation_history BEGIN
+        INSERT INTO history_fts (rowid, session_key, content)
+        VALUES (new.message_id, 's' || new.session_id, new.content);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON conversation_history BEGIN
+        INSERT INTO history_fts (history_fts, rowid, session_key, content)
+        VALUES ('delete', old.message_id, 's' || old.session_id, old.content);
+    END
+    ''')
+    # Проиндексировать уже накопленную историю
+    conn.execute("INSERT INTO history_fts(history_fts) VALUES ('rebuild')")
+
+def _migration_5_option_stock(conn):
+    """Запас заранее сгенерированных вариантов"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS option_stock (
+        stock_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_option_stock_kind ON option_stock (kind, created_at)")
+
+def _migration_6_voice_file_ids(conn):
+    """file_id загруженных голосовых сообщений"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS voice_file_ids (
+        audio_key TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+def _migration_7_chat_user_state(conn):
+    """Состояние чатов и пользователей"""
+    for table, key_column in (("chat_state", "chat_id"), ("user_state", "user_id")):
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            {key_column} INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_updated ON {table} (updated_at)")
+
+def _migration_8_history_archive(conn):
+    """Архив истории неактивных сессий"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS history_archive (
+        archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        first_message_id INTEGER NOT NULL,
+        last_message_id INTEGER NOT NULL,
+        messages INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_archive_session ON history_archive (session_id)")
+
+def _migration_9_session_activity(conn):
+    """Время последнего обращения к сессии"""
+    # Восстановленная из архива история сохраняет старые отметки времени,
+    # поэтому архиватор учитывает и это поле
+    conn.execute("ALTER TABLE game_sessions ADD COLUMN last_activity TIMESTAMP")
+
+# Миграции применяются по порядку; номер версии — позиция в списке
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_hot_indexes,
+    _migration_3_campaign_memory,
+    _migration_4_history_fts,
+    _migration_5_option_stock,
+    _migration_6_voice_file_ids,
+    _migration_7_chat_user_state,
+    _migration_8_history_archive,
+    _migration_9_session_activity,
+]
+
+# Запросы, выполняемые на каждом ходу
+SQL_SESSION_DETAILS = """
     SELECT campaign_name, campaign_type, setting_description, current_location, current_quest
     FROM game_sessions 
     WHERE session_id = ?
-    """, (session_id,))
-    
-    session_data = cursor.fetchone()
-    if not session_data:
-        conn.close()
-        return "Активная сессия не найдена."
-    
-    campaign_name, campaign_type, setting_description, current_location, current_quest = session_data
-    
-    # Получить персонажей в этой сессии
-    cursor.execute("""
+    """
+SQL_SESSION_CHARACTERS = """
     SELECT player_name, name, race, class, level, hp, max_hp, 
            strength, dexterity, constitution, intelligence, wisdom, charisma
     FROM characters 
     WHERE session_id = ?
-    """, (session_id,))
-    
-    characters = cursor.fetchall()
-    
-    # Получить недавнюю историю разговоров (последние 10 сообщений)
-    cursor.execute("""
+    """
+SQL_RECENT_HISTORY = """
     SELECT sender, content FROM conversation_history 
     WHERE session_id = ? 
-    ORDER BY timestamp DESC LIMIT 10
-    """, (session_id,))
-    
-    history = cursor.fetchall()
-    history.reverse()  # Показать старые сообщения сначала
-    
-    conn.close()
-    
-    # Составить контекст
-    context = "ДЕТАЛИ КАМПАНИИ:\n"
-    context += f"Название: {campaign_name}\n"
-    context += f"Тип: {campaign_type}\n"
-    context += f"Текущая локация: {current_location}\n"
-    context += f"Текущий квест: {current_quest}\n\n"
-    
-    context += "ПЕРСОНАЖИ:\n"
+    ORDER BY message_id DESC LIMIT ?
+    """
+SQL_CAMPAIGN_MEMORY = "SELECT summary, summarized_upto FROM campaign_memory WHERE session_id = ?"
+# Еще не свернутые в сводку сообщения, не вошедшие в keep_recent последних
+SQL_UNSUMMARIZED_HISTORY = """
+    SELECT message_id, sender, content FROM conversation_history
+    WHERE session_id = ? AND message_id > ? AND message_id < (
+        SELECT message_id FROM conversation_history
+        WHERE session_id = ?
+        ORDER BY message_id DESC LIMIT 1 OFFSET ?
+    )
+    ORDER BY message_id LIMIT ?
+    """
+# BM25 считается только для последних совпадений сессии: FTS5 отдает их
+# в порядке rowid и останавливается на LIMIT, а не ранжирует всю историю
+SQL_RECALL_HISTORY = """
+    SELECT h.sender, h.content
+    FROM (
+        SELECT rowid, rank FROM history_fts
+        WHERE history_fts MATCH ?
+        ORDER BY rowid DESC LIMIT ?
+    ) AS found
+    JOIN conversation_history h ON h.message_id = found.rowid
+    ORDER BY found.rank LIMIT ?
+    """
+SQL_PLAYER_CHARACTER = "SELECT name FROM characters WHERE session_id = ? AND player_id = ?"
+SQL_ACTIVE_SESSION = "SELECT session_id FROM game_sessions WHERE chat_id = ? AND is_active = TRUE"
+
+# Для каждого запроса — индекс, который он обязан использовать
+HOT_QUERIES = {
+    SQL_SESSION_DETAILS: "INTEGER PRIMARY KEY",
+    SQL_SESSION_CHARACTERS: "idx_characters_player",
+    SQL_RECENT_HISTORY: "idx_history_session",
+    SQL_CAMPAIGN_MEMORY: "INTEGER PRIMARY KEY",
+    SQL_UNSUMMARIZED_HISTORY: "idx_history_session",
+    SQL_RECALL_HISTORY: "VIRTUAL TABLE INDEX",
+    SQL_PLAYER_CHARACTER: "idx_characters_player",
+    SQL_ACTIVE_SESSION: "idx_sessions_chat_active",
+}
+# Запросы, которым разрешена сортировка во временном B-дереве: она идет по ограниченной выборке
+BOUNDED_SORT_QUERIES = {SQL_RECALL_HISTORY}
+
+def check_query_plans(conn):
+    """Проверить через EXPLAIN QUERY PLAN, что частые запросы используют индексы
+
+    Возвращает список проблем; пустой список означает, что все планы в порядке.
+    """
+    problems = []
+    for sql, index in HOT_QUERIES.items():
+        params = (0,) * sql.count("?")
+        plan = " | ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+        if index not in plan or ("USE TEMP B-TREE" in plan and sql not in BOUNDED_SORT_QUERIES):
+            problems.append(f"{' '.join(sql.split())} -> {plan}")
+    return problems
+
+# Управление игровым контекстом
+# Сколько последних сообщений держать в кэше; в промпт попадает столько, сколько помещается в бюджет
+HISTORY_WINDOW = int(os.environ.get("HISTORY_WINDOW", "50"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1000"))
+# Бюджет токенов на весь запрос (системный промпт + промпт) и предел на одно сообщение истории
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))
+MESSAGE_TOKEN_CAP = int(os.environ.get("MESSAGE_TOKEN_CAP", "400"))
+# Поиск по старой истории: сколько сообщений искать и сколько токенов им отдать
+RECALL_TOP_K = int(os.environ.get("RECALL_TOP_K", "5"))
+RECALL_TOKEN_BUDGET = int(os.environ.get("RECALL_TOKEN_BUDGET", "400"))
+RECALL_MAX_TERMS = int(os.environ.get("RECALL_MAX_TERMS", "8"))        # слов в поисковом запросе
+RECALL_MIN_PREFIX = int(os.environ.get("RECALL_MIN_PREFIX", "4"))      # более короткие слова не ищутся
+RECALL_SCAN_LIMIT = int(os.environ.get("RECALL_SCAN_LIMIT", "200"))    # сколько последних совпадений ранжировать
+
+_TOKEN_PIECE = re.compile(r'\w+|[^\w\s]')
+
+def _piece_tokens(piece):
+    # BPE-токенизаторы режут латиницу примерно по 4 символа, кириллицу — по 3
+    return -(-len(piece) // (4 if piece.isascii() else 3))
+
+def count_tokens(text):
+    """Оценить число токенов в тексте без загрузки токенизатора модели
+
+    Оценка слегка завышена по сравнению с BPE-токенизаторами,
+    поэтому бюджет не будет превышен.
+    """
+    return sum(_piece_tokens(piece) for piece in _TOKEN_PIECE.findall(text))
+
+def truncate_to_tokens(text, limit):
+    """Обрезать текст до limit токенов, добавив многоточие"""
+    used = 0
+    for match in _TOKEN_PIECE.finditer(text):
+        used += _piece_tokens(match.group())
+        if used > limit:
+            return text[:match.start()].rstrip() + "…"
+    return text
+
+def format_campaign_block(campaign_name, campaign_type, setting_description, current_location, current_quest):
+    """Блок с деталями кампании для промпта"""
+    block = "ДЕТАЛИ КАМПАНИИ:\n"
+    block += f"Название: {campaign_name}\n"
+    block += f"Тип: {campaign_type}\n"
+    block += f"Текущая локация: {current_location}\n"
+    block += f"Текущий квест: {current_quest}\n\n"
+    return block
+
+def format_characters_block(characters):
+    """Блок с персонажами сессии для промпта"""
+    block = "ПЕРСОНАЖИ:\n"
     for char in characters:
         player_name, name, race, char_class, level, hp, max_hp, str_val, dex, con, intel, wis, cha = char
-        context += f"{name}: Уровень {level} {race} {char_class} (играет {player_name})\n"
-        context += f"ХП: {hp}/{max_hp}, Характеристики: СИЛ {str_val}, ЛОВ {dex}, ВЫН {con}, ИНТ {intel}, МДР {wis}, ХАР {cha}\n\n"
-    
-    context += "НЕДАВНЯЯ ИСТОРИЯ:\n"
-    for sender, content in history:
-        context += f"{sender}: {content}\n"
+        block += f"{name}: Уровень {level} {race} {char_class} (играет {player_name})\n"
+        block += f"ХП: {hp}/{max_hp}, Характеристики: СИЛ {str_val}, ЛОВ {dex}, ВЫН {con}, ИНТ {intel}, МДР {wis}, ХАР {cha}\n\n"
+    return block
+
+def format_memory_block(summary):
+    """Блок со сводкой ранних событий кампании для промпта"""
+    if not summary:
+        return ""
+    return f"ПАМЯТЬ КАМПАНИИ (ранние события):\n{summary}\n\n"
+
+def format_history_line(sender, content):
+    """Строка истории для промпта; слишком длинные сообщения обрезаются"""
+    return f"{sender}: {truncate_to_tokens(content, MESSAGE_TOKEN_CAP)}\n"
+
+RECALL_HEADER = "ВОСПОМИНАНИЯ (связанные ранние события):\n"
+
+class SessionContext:
+    """Подготовленный контекст сессии: блоки кампании и персонажей и последние сообщения
+
+    Сообщения истории хранятся вместе с оценкой числа токенов
+    (уже обрезанными до MESSAGE_TOKEN_CAP), чтобы не пересчитывать их при каждом ходе.
+    """
+
+    def __init__(self, campaign_block, characters_block, history=(), memory_block=""):
+        self.campaign_block = campaign_block
+        self.characters_block = characters_block
+        self.memory_block = memory_block
+        self.history = deque(maxlen=HISTORY_WINDOW)
+        self.shown = None  # сколько последних сообщений вошло в последний промпт
+        self.extend(history)
+
+    def extend(self, messages):
+        """Добавить сообщения (sender, content) в конец истории"""
+        for sender, content in messages:
+            line = format_history_line(sender, content)
+            self.history.append((line, count_tokens(line)))
+
+    def render(self, history_budget=None, recalled=()):
+        """Собрать текст контекста для промпта и вернуть его вместе с числом токенов
+
+        История добавляется от новых сообщений к старым, пока помещается в history_budget.
+        Под найденные поиском сообщения recalled резервируется до RECALL_TOKEN_BUDGET;
+        те из них, что уже есть в недавней истории, пропускаются.
+        """
+        static = self.campaign_block + self.characters_block + self.memory_block
+        tokens = count_tokens(static + "НЕДАВНЯЯ ИСТОРИЯ:\n")
+        remaining = history_budget - tokens if history_budget is not None else float("inf")
+        recalled = [format_history_line(sender, content) for sender, content in recalled]
+        # Резервировать не больше, чем нужно самим найденным сообщениям
+        recall_header_tokens = count_tokens(RECALL_HEADER) if recalled else 0
+        recall_need = recall_header_tokens + sum(count_tokens(line) for line in recalled[:RECALL_TOP_K])
+        recall_reserve = min(RECALL_TOKEN_BUDGET, recall_need, max(0, remaining))
+        remaining -= recall_reserve
+        lines = []
+        for line, line_tokens in reversed(self.history):
+            if line_tokens > remaining:
+                break
+            lines.append(line)
+            remaining -= line_tokens
+            tokens += line_tokens
+        lines.reverse()  # Показать старые сообщения сначала
+        self.shown = len(lines)
+        
+        remaining += recall_reserve - recall_header_tokens
+        shown = set(lines)
+        recall_lines = []
+        for line in recalled:
+            line_tokens = count_tokens(line)
+            if line in shown or line_tokens > remaining or len(recall_lines) >= RECALL_TOP_K:
+                continue
+            recall_lines.append(line)
+            remaining -= line_tokens
+            tokens += line_tokens
+        recall_block = ""
+        if recall_lines:
+            recall_block = RECALL_HEADER + "".join(recall_lines) + "\n"
+            tokens += recall_header_tokens
+        return static + recall_block + "НЕДАВНЯЯ ИСТОРИЯ:\n" + "".join(lines), tokens
+
+class SessionCache:
+    """LRU-кэш контекстов сессий со сквозной записью
+
+    Контекст загружается из базы при первом обращении, а дальше пути записи
+    (ходы, вступление, создание кампании) обновляют его напрямую, так что
+    сборка промпта не требует чтения из базы. Кто меняет таблицы в обход
+    этих путей, сбрасывает контекст через invalidate.
+    """
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    async def get(self, session_id):
+        """Вернуть контекст сессии или None, если сессия не найдена"""
+        ctx = self._items.get(session_id)
+        if ctx is None:
+            ctx = await self._load(session_id)
+            if ctx is None:
+                return None
+            # Пока шла загрузка, контекст мог появиться через сквозную запись
+            ctx = self._items.get(session_id, ctx)
+            self.put(session_id, ctx)
+        else:
+            self._items.move_to_end(session_id)
+        return ctx
+
+    def put(self, session_id, ctx):
+        """Положить контекст в кэш, вытеснив самые давние"""
+        self._items[session_id] = ctx
+        self._items.move_to_end(session_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def append_history(self, session_id, messages):
+        """Добавить сохраненные сообщения в контекст, если он в кэше"""
+        ctx = self._items.get(session_id)
+        if ctx is not None:
+            ctx.extend(messages)
+
+    def set_memory(self, session_id, summary):
+        """Обновить сводку кампании, если контекст в кэше"""
+        ctx = self._items.get(session_id)
+        if ctx is not None:
+            ctx.memory_block = format_memory_block(summary)
+
+    def shown_history(self, session_id):
+        """Сколько последних сообщений вошло в последний промпт сессии (None, если неизвестно)"""
+        ctx = self._items.get(session_id)
+        return ctx.shown if ctx is not None else None
+
+    def invalidate(self, session_id):
+        self._items.pop(session_id, None)
+
+    async def _load(self, session_id):
+        # Несохраненные сообщения сессии должны попасть в прочитанную историю,
+        # а заархивированная история — вернуться в базу
+        await history_writer.wait_session(session_id)
+        await history_archiver.restore(session_id)
+        session_data = await db.fetchone(SQL_SESSION_DETAILS, (session_id,))
+        if not session_data:
+            return None
+        characters = await db.fetchall(SQL_SESSION_CHARACTERS, (session_id,))
+        history = await db.fetchall(SQL_RECENT_HISTORY, (session_id, HISTORY_WINDOW))
+        history.reverse()  # Показать старые сообщения сначала
+        memory = await db.fetchone(SQL_CAMPAIGN_MEMORY, (session_id,))
+        return SessionContext(
+            format_campaign_block(*session_data),
+            format_characters_block(characters),
+            history,
+            format_memory_block(memory[0] if memory else None),
+        )
+
+session_cache = SessionCache()
+
+# Групповая запись истории: сообщения всех чатов копятся и сохраняются общей транзакцией
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.05"))
+HISTORY_FLUSH_SIZE = int(os.environ.get("HISTORY_FLUSH_SIZE", "500"))
+
+def _save_history(conn, rows):
+    conn.executemany("""
+    INSERT INTO conversation_history (session_id, sender, content)
+    VALUES (?, ?, ?)
+    """, rows)
+
+class HistoryWriter:
+    """Отложенная групповая запись conversation_history
+
+    append только ставит сообщения в очередь: они сохраняются одной
+    транзакцией через interval секунд после первого сообщения пакета или
+    сразу, когда в очереди набралось max_rows строк. Порядок сообщений
+    сохраняется. Контекст сессии в кэше обновляется сразу, а загрузка
+    контекста из базы сначала дожидается записи сообщений этой сессии,
+    поэтому следующий промпт всегда видит предыдущий ход.
+    """
+
+    def __init__(self, interval=HISTORY_FLUSH_INTERVAL, max_rows=HISTORY_FLUSH_SIZE):
+        self.interval = interval
+        self.max_rows = max_rows
+        self._rows = []
+        self._pending = {}  # session_id -> число несохраненных строк
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._stopped = False
+
+    def append(self, session_id, messages):
+        """Поставить сообщения сессии в очередь на запись"""
+        if self._stopped:
+            # После stop() очередь уже не будет сохранена: база закрывается следом
+            logger.error(f"История сессии {session_id} не сохранена: запись уже остановлена ({len(messages)} сообщений)")
+            return
+        self._rows.extend((session_id, sender, content) for sender, content in messages)
+        self._pending[session_id] = self._pending.get(session_id, 0) + len(messages)
+        if len(self._rows) >= self.max_rows:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, lambda: asyncio.create_task(self._flush_quietly()))
+
+    async def _flush_quietly(self):
+        try:
+            await self.flush()
+        except Exception:
+            pass  # ошибка уже записана в журнал, строки остались в очереди
+
+    async def wait_session(self, session_id):
+        """Дождаться сохранения всех поставленных в очередь сообщений сессии"""
+        while self._pending.get(session_id):
+            await self.flush()
+
+    async def flush(self):
+        """Сохранить очередь одной транзакцией"""
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            rows, self._rows = self._rows, []
+            if not rows:
+                return
+            try:
+                with stage("history_flush"):
+                    await db.transaction(_save_history, rows)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить историю ({len(rows)} сообщений), повтор: {e}")
+                self._rows[:0] = rows
+                self._schedule(max(self.interval, 1.0))
+                raise
+            metrics.inc("bot_history_rows_total", len(rows))
+            metrics.inc("bot_history_flushes_total")
+            for session_id, _, _ in rows:
+                left = self._pending[session_id] - 1
+                if left:
+                    self._pending[session_id] = left
+                else:
+                    del self._pending[session_id]
+
+    async def stop(self):
+        """Сохранить все оставшиеся сообщения (при остановке бота)"""
+        self._stopped = True
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"История не сохранена при остановке: {e}")
+
+history_writer = HistoryWriter()
+
+# Фоновое сворачивание старой истории в сводку
+SUMMARY_INTERVAL = float(os.environ.get("SUMMARY_INTERVAL", "30"))
+SUMMARY_MIN_BATCH = int(os.environ.get("SUMMARY_MIN_BATCH", "10"))
+SUMMARY_MAX_BATCH = int(os.environ.get("SUMMARY_MAX_BATCH", "40"))
+SUMMARY_CONCURRENCY = int(os.environ.get("SUMMARY_CONCURRENCY", "2"))
+SUMMARY_TOKEN_CAP = int(os.environ.get("SUMMARY_TOKEN_CAP", "500"))
+
+SUMMARY_SYSTEM_PROMPT = "Ты летописец кампании D&D. Ты ведешь краткую сводку событий для Мастера Подземелий."
+
+class CampaignMemory:
+    """Инкрементальная сводка истории, выпадающей из окна промпта
+
+    Ходы помечают сессию, а фоновая задача раз в SUMMARY_INTERVAL секунд
+    сворачивает накопившиеся старые сообщения всех помеченных сессий
+    в их сводки, не задерживая ответы игрокам. Сворачиваются только
+    сообщения, которые уже не попали в промпт: иначе одни и те же
+    события шли бы в модель дважды, в сводке и дословно.
+    """
+
+    def __init__(self, interval=SUMMARY_INTERVAL, min_batch=SUMMARY_MIN_BATCH,
+                 max_batch=SUMMARY_MAX_BATCH, concurrency=SUMMARY_CONCURRENCY):
+        self.interval = interval
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.concurrency = concurrency
+        self.dirty = set()
+        self._task = None
+
+    def mark(self, session_id):
+        """Отметить, что в сессии появились новые сообщения"""
+        self.dirty.add(session_id)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        """Свернуть историю всех помеченных сессий"""
+        sessions, self.dirty = self.dirty, set()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fold_limited(session_id):
+            async with semaphore:
+                await self.fold(session_id)
+
+        await asyncio.gather(*(fold_limited(session_id) for session_id in sessions))
+
+    async def fold(self, session_id):
+        """Добавить выпавшие из окна сообщения сессии в ее сводку"""
+        try:
+            memory = await db.fetchone(SQL_CAMPAIGN_MEMORY, (session_id,))
+            summary, summarized_upto = memory if memory else ("", 0)
+            # Сколько сообщений поместилось в последний промпт; если контекста нет
+            # в кэше — все окно HISTORY_WINDOW, которое вообще может попасть в промпт
+            shown = session_cache.shown_history(session_id)
+            keep_recent = max(1, HISTORY_WINDOW if shown is None else shown)
+            rows = await db.fetchall(SQL_UNSUMMARIZED_HISTORY,
+                                     (session_id, summarized_upto, session_id, keep_recent - 1, self.max_batch))
+            if len(rows) < self.min_batch:
+                return
+            events = "".join(format_history_line(sender, content) for _, sender, content in rows)
+            prompt = f"""
+Текущая сводка кампании:
+{summary or "(пока пусто)"}
+
+Новые события:
+{events}
+Обнови сводку, добавив в нее новые события. Сохрани имена НИП, места, предметы, обещания и незавершенные дела.
+Пиши кратко, не более {SUMMARY_TOKEN_CAP // 2} слов. Верни только текст сводки.
+"""
+            summary = await llm_scheduler.run(None, PRIORITY_BACKGROUND, ask_llm, prompt, SUMMARY_SYSTEM_PROMPT)
+            summary = truncate_to_tokens(summary.strip(), SUMMARY_TOKEN_CAP)
+            await db.execute("""
+            INSERT INTO campaign_memory (session_id, summary, summarized_upto) VALUES (?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                summary = excluded.summary,
+                summarized_upto = excluded.summarized_upto,
+                updated_at = CURRENT_TIMESTAMP
+            """, (session_id, summary, rows[-1][0]))
+            session_cache.set_memory(session_id, summary)
+            # Если пакет заполнен целиком, старых сообщений может остаться еще
+            if len(rows) == self.max_batch:
+                self.mark(session_id)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении сводки сессии {session_id}: {e}")
+            self.mark(session_id)
+
+campaign_memory = CampaignMemory()
+
+# Хранение истории: неактивные сессии уходят в сжатые архивы, место возвращается по частям
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "history_archive")
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_SESSIONS_PER_RUN = int(os.environ.get("ARCHIVE_SESSIONS_PER_RUN", "50"))
+ARCHIVE_DELETE_SLICE = int(os.environ.get("ARCHIVE_DELETE_SLICE", "2000"))
+VACUUM_SLICE_PAGES = int(os.environ.get("VACUUM_SLICE_PAGES", "256"))
+MAINTENANCE_PAUSE = float(os.environ.get("MAINTENANCE_PAUSE", "0.05"))
+
+# Сессии, последнее сообщение которых и последнее обращение (восстановление из архива) старше заданного срока
+SQL_INACTIVE_SESSIONS = """
+    SELECT h.session_id
+    FROM (SELECT session_id, MAX(message_id) AS last_id FROM conversation_history GROUP BY session_id) AS last
+    JOIN conversation_history h ON h.message_id = last.last_id
+    LEFT JOIN game_sessions s ON s.session_id = h.session_id
+    WHERE h.timestamp < datetime('now', ?)
+      AND (s.last_activity IS NULL OR s.last_activity < datetime('now', ?))
+    LIMIT ?
+    """
+
+# Сессия заархивирована после cutoff-проверки, только если к ней так и не обращались
+SQL_SESSION_TOUCHED = "SELECT 1 FROM game_sessions WHERE session_id = ? AND last_activity >= datetime('now', ?)"
+
+def _delete_history_slice(conn, session_id, last_message_id, limit, archive_row):
+    """Удалить порцию заархивированных сообщений; с последней порцией опубликовать архив"""
+    deleted = conn.execute("""
+    DELETE FROM conversation_history WHERE message_id IN (
+        SELECT message_id FROM conversation_history
+        WHERE session_id = ? AND message_id <= ?
+        ORDER BY message_id LIMIT ?
+    )
+    """, (session_id, last_message_id, limit)).rowcount
+    if deleted < limit:
+        _register_archive(conn, *archive_row)
+    return deleted
+
+def _register_archive(conn, session_id, path, first_id, last_id, messages, size):
+    conn.execute("""
+    INSERT INTO history_archive (session_id, path, first_message_id, last_message_id, messages, bytes)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """, (session_id, path, first_id, last_id, messages, size))
+
+def _restore_history(conn, session_id, rows, archive_ids):
+    # Исходные message_id сохраняются, триггер заново индексирует текст для поиска
+    conn.executemany("""
+    INSERT OR IGNORE INTO conversation_history (message_id, session_id, timestamp, sender, content)
+    VALUES (?, ?, ?, ?, ?)
+    """, [(message_id, session_id, timestamp, sender, content) for message_id, timestamp, sender, content in rows])
+    conn.executemany("DELETE FROM history_archive WHERE archive_id = ?", [(archive_id,) for archive_id in archive_ids])
+    # Сессия снова в ходу: без отметки архиватор вернул бы ее в архив по старым сообщениям
+    conn.execute("UPDATE game_sessions SET last_activity = CURRENT_TIMESTAMP WHERE session_id = ?", (session_id,))
+
+def _free_pages(conn):
+    return (conn.execute("PRAGMA freelist_count").fetchone()[0],
+            conn.execute("PRAGMA page_size").fetchone()[0],
+            conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+
+def _incremental_vacuum(conn, pages):
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+def _write_archive(path, rows):
+    """Записать сообщения в сжатый JSONL атомарно (через временный файл)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            for row in rows:
+                archive.write((json.dumps(row, ensure_ascii=False) + "\n").encode())
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+def _read_archive(path):
+    with gzip.open(path, "rt", encoding="utf-8") as archive:
+        return [tuple(json.loads(line)) for line in archive if line.strip()]
+
+class HistoryArchiver:
+    """Архивация истории неактивных сессий и постепенное возвращение места
+
+    Раз в interval секунд история сессий без сообщений и обращений дольше
+    ARCHIVE_AFTER_DAYS переносится в сжатые файлы
+    ARCHIVE_DIR/session_<id>_<первый>-<последний>.jsonl.gz и удаляется из
+    горячей базы небольшими транзакциями. Затем свободные страницы
+    возвращаются через incremental_vacuum порциями по VACUUM_SLICE_PAGES
+    с паузами, чтобы поток-писатель не занимался этим подолгу. При
+    обращении к заархивированной сессии история восстанавливается.
+
+    Архивация и восстановление одной сессии выполняются под общей
+    блокировкой. Запись в history_archive появляется в одной транзакции
+    с последней порцией удалений; если процесс прервался раньше, файл
+    без записи подхватывается следующим проходом (_adopt_orphans).
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR, after_days=ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL,
+                 sessions_per_run=ARCHIVE_SESSIONS_PER_RUN):
+        self.directory = directory
+        self.after_days = after_days
+        self.interval = interval
+        self.sessions_per_run = sessions_per_run
+        self._task = None
+        self._restoring = {}
+        self._locks = {}  # session_id -> [блокировка, число ожидающих]
+
+    @contextlib.asynccontextmanager
+    async def _session_lock(self, session_id):
+        entry = self._locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[session_id]
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.maintain()
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания истории: {e}")
+
+    async def maintain(self):
+        """Один проход: архивировать неактивные сессии и вернуть место; вернуть отчет"""
+        report = {"sessions": 0, "messages": 0, "archive_bytes": 0}
+        await self._adopt_orphans()
+        cutoff = f"-{self.after_days} days"
+        rows = await db.fetchall(SQL_INACTIVE_SESSIONS, (cutoff, cutoff, self.sessions_per_run))
+        for (session_id,) in rows:
+            messages, size = await self.archive(session_id, cutoff)
+            if not messages:
+                continue
+            report["sessions"] += 1
+            report["messages"] += messages
+            report["archive_bytes"] += size
+        report["reclaimed_bytes"] = await self.vacuum()
+        if report["sessions"] or report["reclaimed_bytes"]:
+            logger.info(f"Архивировано сессий: {report['sessions']}, сообщений: {report['messages']}, "
+                        f"архив {report['archive_bytes'] // 1024} КБ; "
+                        f"база уменьшилась на {report['reclaimed_bytes'] // 1024} КБ")
+        metrics.inc("bot_archived_messages_total", report["messages"])
+        metrics.inc("bot_reclaimed_bytes_total", report["reclaimed_bytes"])
+        return report
+
+    async def archive(self, session_id, cutoff=None):
+        """Перенести историю сессии в архивный файл; вернуть число сообщений и размер файла
+
+        С cutoff сессия пропускается, если к ней обращались позже этого срока
+        (например, восстановили, пока проход ждал своей очереди).
+        """
+        async with self._session_lock(session_id):
+            if cutoff is not None and await db.fetchone(SQL_SESSION_TOUCHED, (session_id, cutoff)):
+                return 0, 0
+            rows = await db.fetchall(
+                "SELECT message_id, timestamp, sender, content FROM conversation_history WHERE session_id = ? ORDER BY message_id",
+                (session_id,),
+            )
+            if not rows:
+                return 0, 0
+            first_id, last_id = rows[0][0], rows[-1][0]
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"session_{session_id}_{first_id}-{last_id}.jsonl.gz")
+            size = await asyncio.to_thread(_write_archive, path, rows)
+            archive_row = (session_id, path, first_id, last_id, len(rows), size)
+            # Удаляется только заархивированное: новые сообщения, пришедшие за это время, остаются
+            while await db.transaction(_delete_history_slice, session_id, last_id, ARCHIVE_DELETE_SLICE, archive_row) >= ARCHIVE_DELETE_SLICE:
+                await asyncio.sleep(MAINTENANCE_PAUSE)
+            session_cache.invalidate(session_id)
+            return len(rows), size
+
+    async def _adopt_orphans(self):
+        """Зарегистрировать архивы, чья запись не успела появиться из-за остановки процесса"""
+        if not os.path.isdir(self.directory):
+            return
+        known = {path for (path,) in await db.fetchall("SELECT path FROM history_archive")}
+        for name in os.listdir(self.directory):
+            match = re.fullmatch(r"session_(\d+)_(\d+)-(\d+)\.jsonl\.gz", name)
+            path = os.path.join(self.directory, name)
+            if match is None or path in known:
+                continue
+            session_id, first_id, last_id = map(int, match.groups())
+            async with self._session_lock(session_id):
+                if not os.path.exists(path) or await db.fetchone("SELECT 1 FROM history_archive WHERE path = ?", (path,)):
+                    continue
+                rows = await asyncio.to_thread(_read_archive, path)
+                # Восстановление вставляет строки через INSERT OR IGNORE, поэтому
+                # сообщения, которые успели остаться в базе, не задвоятся
+                await db.transaction(_register_archive, session_id, path, first_id, last_id,
+                                     len(rows), os.path.getsize(path))
+            logger.warning(f"Найден незарегистрированный архив {path}, он снова доступен для восстановления")
+
+    async def restore(self, session_id):
+        """Вернуть заархивированную историю сессии в базу (если она есть)"""
+        restoring = self._restoring.get(session_id)
+        if restoring is None:
+            restoring = self._restoring[session_id] = asyncio.ensure_future(self._restore(session_id))
+            restoring.add_done_callback(lambda _: self._restoring.pop(session_id, None))
+        return await asyncio.shield(restoring)
+
+    async def _restore(self, session_id):
+        async with self._session_lock(session_id):
+            return await self._restore_locked(session_id)
+
+    async def _restore_locked(self, session_id):
+        archives = await db.fetchall("SELECT archive_id, path FROM history_archive WHERE session_id = ?", (session_id,))
+        if not archives:
+            return 0
+        rows = []
+        for _, path in archives:
+            rows.extend(await asyncio.to_thread(_read_archive, path))
+        await db.transaction(_restore_history, session_id, rows, [archive_id for archive_id, _ in archives])
+        for _, path in archives:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить архив {path}: {e}")
+        logger.info(f"История сессии {session_id} восстановлена из архива ({len(rows)} сообщений)")
+        return len(rows)
+
+    async def vacuum(self):
+        """Вернуть свободные страницы файлу порциями; вернуть освобожденные байты"""
+        free, page_size, auto_vacuum = await db.transaction(_free_pages)
+        if not free:
+            return 0
+        if auto_vacuum != 2:
+            logger.info(f"Свободно {free * page_size // 1024} КБ, но incremental_vacuum недоступен: "
+                        "выполните python bot.py compact-db при остановленном боте")
+            return 0
+        reclaimed = 0
+        while free:
+            left = await db.transaction(_incremental_vacuum, VACUUM_SLICE_PAGES)
+            reclaimed += (free - left) * page_size
+            if left >= free:
+                break
+            free = left
+            await asyncio.sleep(MAINTENANCE_PAUSE)
+        return reclaimed
+
+history_archiver = HistoryArchiver()
+
+def compact_database(conn):
+    """Включить incremental auto_vacuum и перестроить файл (полный VACUUM, бот должен быть остановлен)"""
+    before = os.path.getsize(DB_PATH)
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return before, os.path.getsize(DB_PATH)
+
+# Запас заранее сгенерированных вариантов кампаний и персонажей
+OPTION_STOCK_SIZE = int(os.environ.get("OPTION_STOCK_SIZE", "3"))
+OPTION_STOCK_TTL = float(os.environ.get("OPTION_STOCK_TTL", str(6 * 3600)))
+OPTION_REFILL_INTERVAL = float(os.environ.get("OPTION_REFILL_INTERVAL", "60"))
+
+CAMPAIGN_OPTIONS_PROMPT = """
+    Создай новую кампанию D&D с тремя вариантами на выбор. Для каждого варианта предоставь:
+    1. name — название кампании
+    2. type — тип кампании (исследование, героика, хоррор и т.д.)
+    3. setting — краткое описание сеттинга
+    4. location — начальную локацию
+    5. quest — первый квест
     
-    return context
+    Ответь только JSON-объектом без пояснений, в формате:
+    {"campaigns": [{"name": "...", "type": "...", "setting": "...", "location": "...", "quest": "..."}, ...]}
+    """
+
+# Поля варианта кампании и значения по умолчанию, если модель их пропустила
+CAMPAIGN_DEFAULTS = {
+    "name": "Новая кампания",
+    "type": "Приключение",
+    "setting": "Фэнтезийный мир",
+    "location": "Таверна",
+    "quest": "Начало приключения",
+}
+
+def parse_campaign_options(text):
+    """Разобрать JSON с вариантами кампаний и вернуть список из трех словарей"""
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end < start:
+        raise ValueError("В ответе нет JSON-объекта")
+    campaigns = json.loads(text[start:end + 1])["campaigns"]
+    options = [
+        {field: str(campaign.get(field) or default).strip() for field, default in CAMPAIGN_DEFAULTS.items()}
+        for campaign in campaigns[:3] if isinstance(campaign, dict)
+    ]
+    if len(options) < 3:
+        raise ValueError("В ответе меньше трех вариантов")
+    return options
 
-def generate_dm_response(user_input, session_id, player_name):
-    """Сгенерировать ответ Мастера Подземелий, используя LLM"""
-    context = get_session_context(session_id)
+def format_campaign_options(options):
+    """Текст с вариантами кампаний для игрока"""
+    return "\n\n".join(
+        f"{i}. {option['name']} ({option['type']})\n"
+        f"Сеттинг: {option['setting']}\n"
+        f"Локация: {option['location']}\n"
+        f"Квест: {option['quest']}"
+        for i, option in enumerate(options, start=1)
+    )
+
+CHARACTER_OPTIONS_PROMPT = """
+    Создай три варианта персонажей D&D 5e уровня 1 на выбор. Для каждого варианта предоставь:
+    1. Имя
+    2. Раса
+    3. Класс
+    4. Краткая предыстория (1-2 предложения)
+    5. Ключевые характеристики (СИЛ, ЛОВ, ВЫН, ИНТ, МДР, ХАР)
+    6. ХП и КД
     
-    prompt = f"""
+    Формат ответа должен быть кратким и чётким, с ясным разделением между тремя вариантами.
+    """
+
+# Вид вариантов -> (промпт, системный промпт, нормализация ответа перед сохранением)
+OPTION_KINDS = {
+    "campaign": (
+        CAMPAIGN_OPTIONS_PROMPT,
+        "Ты помощник Мастера Подземелий, создающий варианты новых кампаний D&D. Ты отвечаешь только валидным JSON.",
+        lambda text: json.dumps(parse_campaign_options(text), ensure_ascii=False),
+    ),
+    "character": (CHARACTER_OPTIONS_PROMPT, "Ты помощник по созданию персонажей D&D.", str.strip),
+}
+
+def _take_option(conn, kind, fresh_after):
+    """Удалить устаревшие варианты и забрать самый старый из свежих"""
+    conn.execute("DELETE FROM option_stock WHERE kind = ? AND created_at < ?", (kind, fresh_after))
+    return conn.execute("""
+    DELETE FROM option_stock
+    WHERE stock_id = (SELECT stock_id FROM option_stock WHERE kind = ? ORDER BY created_at LIMIT 1)
+    RETURNING content
+    """, (kind,)).fetchone()
+
+class OptionPool:
+    """Фоновый запас готовых вариантов кампаний и персонажей в базе
+
+    Команды забирают готовый вариант мгновенно; фоновая задача
+    поддерживает по size свежих вариантов каждого вида с низким
+    приоритетом, а варианты старше ttl выбрасываются.
+    """
+
+    def __init__(self, kinds=OPTION_KINDS, size=OPTION_STOCK_SIZE, ttl=OPTION_STOCK_TTL, interval=OPTION_REFILL_INTERVAL):
+        self.kinds = kinds
+        self.size = size
+        self.ttl = ttl
+        self.interval = interval
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def take(self, kind):
+        """Забрать готовый вариант из запаса или вернуть None"""
+        row = await db.transaction(_take_option, kind, time.time() - self.ttl)
+        self._wake.set()
+        return row[0] if row else None
+
+    async def get(self, kind, chat_id, key=None):
+        """Вернуть вариант из запаса, а если он пуст — сгенерировать сразу"""
+        content = await self.take(kind)
+        if content is not None:
+            return content
+        prompt, system_prompt, normalize = self.kinds[kind]
+        return normalize(await llm_scheduler.run(chat_id, PRIORITY_OPTIONS, ask_fast_llm, prompt, system_prompt, key=key))
+
+    async def refill(self):
+        """Догенерировать недостающие свежие варианты"""
+        for kind, (prompt, system_prompt, normalize) in self.kinds.items():
+            fresh = (await db.fetchone(
+                "SELECT COUNT(*) FROM option_stock WHERE kind = ? AND created_at >= ?",
+                (kind, time.time() - self.ttl),
+            ))[0]
+            for _ in range(self.size - fresh):
+                content = await llm_scheduler.run(None, PRIORITY_BACKGROUND, ask_fast_llm, prompt, system_prompt)
+                try:
+                    content = normalize(content)
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Некорректный ответ при генерации вариантов ({kind}): {e}")
+                    continue
+                await db.execute("INSERT INTO option_stock (kind, content, created_at) VALUES (?, ?, ?)",
+                                 (kind, content, time.time()))
+
+    def start(self):
+        if self._task is None and self.size > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Ошибка при пополнении запаса вариантов: {e}")
+            # Проснуться после расхода запаса или по таймеру, чтобы заменить устаревшие
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+option_pool = OptionPool()
+
+# Упреждающая генерация вступлений, пока игрок выбирает кампанию
+SPECULATIVE_INTRO_AUDIO = os.environ.get("SPECULATIVE_INTRO_AUDIO", "0") == "1"
+SPECULATION_TTL = float(os.environ.get("SPECULATION_TTL", "3600"))
+
+def build_intro_prompt(campaign):
+    """Промпт для вступления к выбранной кампании"""
+    return f"""
+            Ты Мастер Подземелий для новой кампании D&D.
+            
+            Кампания: {campaign['name']}
+            Тип: {campaign['type']}
+            Сеттинг: {campaign['setting']}
+            Начальная локация: {campaign['location']}
+            Начальный квест: {campaign['quest']}
+            
+            Напиши захватывающее вступление к этой кампании, устанавливающее сцену и атмосферу. Не более 5-6 предложений.
+            Обращайся к игрокам, приглашая их в этот мир. Не указывай им, что делать, а просто представь ситуацию.
+            """
+
+async def _speculate_intro(campaign, chat_id):
+    """Заранее сгенерировать вступление (и при желании его озвучку)"""
+    intro_text = await llm_scheduler.run(chat_id, PRIORITY_OPTIONS, ask_llm, build_intro_prompt(campaign), DM_SYSTEM_PROMPT)
+    speech_clip = await generate_speech(intro_text, chat_id) if SPECULATIVE_INTRO_AUDIO else None
+    return intro_text, speech_clip
+
+class IntroSpeculation:
+    """Вступления ко всем вариантам кампании, генерируемые во время выбора
+
+    Когда игрок выбирает вариант, остальные задачи отменяются; уже
+    синтезированная озвучка остается в кэше и вытесняется им как обычно.
+    Если выбор так и не сделан, задачи отменяются через ttl секунд.
+    """
+
+    def __init__(self, ttl=SPECULATION_TTL):
+        self.ttl = ttl
+        self._pending = {}  # (chat_id, user_id) -> (задачи, таймер истечения)
+
+    def start(self, chat_id, user_id, campaigns):
+        self.cancel(chat_id, user_id)
+        tasks = [asyncio.create_task(_speculate_intro(campaign, chat_id)) for campaign in campaigns]
+        for task in tasks:
+            task.add_done_callback(self._observe)
+        key = (chat_id, user_id)
+        timer = asyncio.get_running_loop().call_later(self.ttl, self._expire, key, tasks)
+        self._pending[key] = (tasks, timer)
+
+    def take(self, chat_id, user_id, index):
+        """Забрать задачу выбранного варианта, отменив остальные"""
+        tasks = self._pop(chat_id, user_id)
+        chosen = tasks[index] if index < len(tasks) else None
+        self._cancel_tasks(task for task in tasks if task is not chosen)
+        return chosen
+
+    def cancel(self, chat_id, user_id):
+        self._cancel_tasks(self._pop(chat_id, user_id))
+
+    def _pop(self, chat_id, user_id):
+        tasks, timer = self._pending.pop((chat_id, user_id), ([], None))
+        if timer is not None:
+            timer.cancel()
+        return tasks
+
+    def _cancel_tasks(self, tasks):
+        for task in tasks:
+            task.cancel()
+
+    def _expire(self, key, tasks):
+        # Ключ мог уже занять новый запуск с другими задачами
+        if self._pending.get(key, (None,))[0] is tasks:
+            self.cancel(*key)
+
+    @staticmethod
+    def _observe(task):
+        """Забрать исключение задачи, чтобы ошибка невостребованного варианта не терялась молча"""
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Не удалось заранее сгенерировать вступление: {task.exception()}")
+
+intro_speculation = IntroSpeculation()
+
+async def get_session_context(session_id, history_budget=None, recalled=()):
+    """Получить состояние игры, персонажей и историю разговоров для сессии
+
+    Возвращает текст контекста и оценку числа токенов в нем.
+    """
+    ctx = await session_cache.get(session_id)
+    if ctx is None:
+        text = "Активная сессия не найдена."
+        return text, count_tokens(text)
+    return ctx.render(history_budget, recalled)
+
+_RECALL_WORD = re.compile(r'\w{3,}')
+_RECALL_STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только
+ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть
+был него до вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо
+ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот
+того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда
+зачем всех никогда можно при наконец два об другой хоть после над больше тот через эти нас про
+всего них какая много разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том
+нельзя такой им более всегда конечно всю между хочу хочет иду делаю пытаюсь
+""".split())
+
+def build_recall_query(session_id, text):
+    """Построить запрос FTS5 по значимым словам текста игрока
+
+    Слова берутся с усеченным окончанием и префиксным поиском, чтобы
+    находить другие падежи имен и названий. Стоп-слова и слова короче
+    RECALL_MIN_PREFIX пропускаются: короткий префикс совпадает с огромным
+    числом токенов индекса. В запрос попадают не больше RECALL_MAX_TERMS
+    самых длинных слов. Каждое слово заключено в кавычки, поэтому
+    синтаксис FTS5 во вводе игрока не интерпретируется.
+    """
+    words = []
+    for word in _RECALL_WORD.findall(text.lower()):
+        if len(word) < RECALL_MIN_PREFIX or word in _RECALL_STOPWORDS or word.isdigit():
+            continue
+        if word not in words:
+            words.append(word)
+    # Длинные слова (имена, названия) различают сообщения лучше коротких
+    words = sorted(words, key=len, reverse=True)[:RECALL_MAX_TERMS]
+    terms = []
+    for word in words:
+        term = f'"{word[:max(RECALL_MIN_PREFIX, len(word) - 2)]}"*'
+        if term not in terms:
+            terms.append(term)
+    if not terms:
+        return None
+    return f"session_key:s{int(session_id)} AND ({' OR '.join(terms)})"
+
+async def recall_history(session_id, text, top_k=RECALL_TOP_K):
+    """Найти в истории сессии сообщения, связанные с текстом игрока (ранжирование BM25)"""
+    query = build_recall_query(session_id, text)
+    if query is None or top_k <= 0:
+        return []
+    try:
+        # С запасом: часть найденного может уже быть в недавней истории
+        rows = await db.fetchall(SQL_RECALL_HISTORY, (query, RECALL_SCAN_LIMIT, top_k * 2))
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка полнотекстового поиска: {e}")
+        return []
+    return rows
+
+DM_PROMPT_TEMPLATE = """
 Текущий игровой контекст:
 {context}
 
-Действие игрока ({player_name}):
-{user_input}
+{actions}
 
 Ответь как Мастер Подземелий. Поддерживай ход игры, реагируй на действия игрока и продолжай развивать приключение.
 """
+
+def format_actions(actions):
+    """Раздел промпта с действиями игроков; actions — список (player_name, text)"""
+    if len(actions) == 1:
+        player_name, text = actions[0]
+        return f"Действие игрока ({player_name}):\n{text}"
+    lines = "".join(f"{player_name}: {text}\n" for player_name, text in actions)
+    return "Действия игроков (они действуют одновременно, ответь на все действия в одном повествовании):\n" + lines.rstrip("\n")
+
+async def build_dm_prompt(session_id, actions, budget=PROMPT_TOKEN_BUDGET):
+    """Собрать промпт МП, заполняя историю в пределах бюджета токенов
+
+    Возвращает промпт и оценку числа токенов всего запроса.
+    """
+    actions_text = format_actions(actions)
+    fixed_tokens = (count_tokens(DM_SYSTEM_PROMPT)
+                    + count_tokens(DM_PROMPT_TEMPLATE.format(context="", actions=actions_text)))
+    with stage("context"):
+        # Загрузка контекста возвращает в базу заархивированную историю, поэтому идет до поиска
+        await session_cache.get(session_id)
+    with stage("recall"):
+        recalled = await recall_history(session_id, " ".join(text for _, text in actions))
+    with stage("context"):
+        context, context_tokens = await get_session_context(session_id, max(0, budget - fixed_tokens), recalled)
+    prompt = DM_PROMPT_TEMPLATE.format(context=context, actions=actions_text)
+    return prompt, fixed_tokens + context_tokens
+
+async def generate_dm_response(actions, session_id, on_text=None):
+    """Сгенерировать ответ Мастера Подземелий, используя LLM
+
+    actions — список (player_name, text) действий, на которые МП отвечает
+    одним ответом. Если передан on_text, ответ генерируется потоково и
+    колбэк получает накопленный текст с уже обработанными бросками кубиков.
+    """
+    prompt, prompt_tokens = await build_dm_prompt(session_id, actions)
+    logger.info(f"Промпт для сессии {session_id}: ~{prompt_tokens} токенов, действий: {len(actions)}")
     
-    # Используем предоставленную функцию ask_llm
-    response = ask_llm(prompt, DM_SYSTEM_PROMPT)
-    
-    # Обработка бросков кубиков в ответе
-    response = process_dice_rolls(response)
+    if on_text is None:
+        response = await ask_llm(prompt, DM_SYSTEM_PROMPT)
+        # Обработка бросков кубиков в ответе
+        response = process_dice_rolls(response)
+    else:
+        # Броски обрабатываются, как только приходит закрывающая скобка
+        dice_stream = DiceStream()
+        response = ""
+        async for chunk in stream_llm(prompt, DM_SYSTEM_PROMPT):
+            ready = dice_stream.feed(chunk)
+            if ready:
+                response += ready
+                await on_text(response)
+        response += dice_stream.flush()
+        await on_text(response)
     
     # Сохранить это взаимодействие в истории
-    conn = sqlite3.connect('dnd_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-    INSERT INTO conversation_history (session_id, sender, content)
-    VALUES (?, ?, ?)
-    """, (session_id, player_name, user_input))
-    
-    cursor.execute("""
-    INSERT INTO conversation_history (session_id, sender, content)
-    VALUES (?, ?, ?)
-    """, (session_id, "МП", response))
-    
-    conn.commit()
-    conn.close()
+    messages = list(actions) + [("МП", response)]
+    history_writer.append(session_id, messages)
+    session_cache.append_history(session_id, messages)
+    campaign_memory.mark(session_id)
     
     return response
 
+# Кубики: разбор выражений, броски и вероятности
+MAX_DICE = 100000          # кубиков в одной группе
+MAX_TOTAL_DICE = 100000    # кубиков во всем выражении
+MAX_SIDES = 10000          # граней у кубика
+MAX_TERMS = 20             # слагаемых в выражении
+MAX_SHOWN_DICE = 20        # сколько отдельных результатов показывать
+MAX_REPEAT = 10000         # повторов в одном броске вида "6x4d6"
+EXACT_KEEP_DICE = 12       # до скольких кубиков распределение с kh/kl считается точно
+SAMPLED_ROLLS = 200000     # иначе распределение оценивается по выборке
+EXACT_KEEP_WORK = 100000000  # оценка числа операций точного расчета kh/kl (больше — по выборке)
+MAX_ROLL_CELLS = 10000000  # кубиков в одном векторном броске (больше — по частям)
+MAX_ROLL_WORK = 10000000   # кубиков во всех повторах одного /roll
+MAX_DISTRIBUTION_SIZE = 2000000  # число возможных итогов, для которого считается статистика
+
+_DICE_TERM = re.compile(r'([+-])?(?:(\d*)d(\d+|%)(?:(kh|kl|dh|dl)(\d+))?|(\d+))')
+_DICE_OPERATOR_SPACE = re.compile(r'\s*([+-])\s*')
+
+SMALL_POOL = 32            # группы до стольких кубиков бросаются без NumPy
+
+# Генераторы случайных чисел для бросков. После seed_dice (запись и
+# воспроизведение сессий) у каждого чата и вида обработки свой поток,
+# выведенный из зерна, поэтому броски не зависят от чередования чатов
+dice_random = random.Random()
+dice_rng = np.random.default_rng()
+dice_seed = None
+_dice_streams = {}
+
+def seed_dice(seed):
+    """Задать зерно бросков"""
+    global dice_seed
+    dice_seed = seed
+    _dice_streams.clear()
+
+def dice_generators():
+    """Генераторы (random.Random, numpy Generator) для бросков текущей трассировки"""
+    if dice_seed is None:
+        return dice_random, dice_rng
+    trace = current_trace.get()
+    key = (trace.fields.get("chat_id"), trace.kind) if trace else (None, None)
+    streams = _dice_streams.get(key)
+    if streams is None:
+        seed = int.from_bytes(hashlib.sha256(f"{dice_seed}:{key[0]}:{key[1]}".encode()).digest()[:8], "big")
+        streams = _dice_streams[key] = (random.Random(seed), np.random.default_rng(seed))
+    return streams
+
+def _power_pmf(pmf, n):
+    """Распределение суммы n независимых величин с распределением pmf (свертка)"""
+    size = n * (len(pmf) - 1) + 1
+    if size > 4096:
+        # Для больших пулов — возведение спектра в степень через БПФ
+        length = 1 << (size - 1).bit_length()
+        result = np.fft.irfft(np.fft.rfft(pmf, length) ** n, length)[:size]
+        result = np.clip(result, 0, None)
+        return result / result.sum()
+    result = np.ones(1)
+    base = pmf
+    while n:
+        if n & 1:
+            result = np.convolve(result, base)
+        n >>= 1
+        if n:
+            base = np.convolve(base, base)
+    return result
+
+def _keep_highest_work(count, sides, keep):
+    """Оценка числа операций _keep_highest_pmf: грани × состояния × переходы × длина массива"""
+    return sides * (count + 1) ** 2 * (keep + 1) * (keep * sides + 1)
+
+def _keep_highest_pmf(count, sides, keep):
+    """Точное распределение суммы keep старших из count кубиков d(sides)
+
+    Грани перебираются от старшей к младшей; состояние — сколько кубиков
+    уже распределено и сколько из них оставлено, значение — число
+    исходов для каждой суммы оставленных кубиков.
+    """
+    states = {(0, 0): np.zeros(keep * sides + 1)}
+    states[(0, 0)][0] = 1.0
+    for face in range(sides, 0, -1):
+        next_states = {}
+        for (assigned, kept), sums in states.items():
+            for shown in range(count - assigned + 1):
+                take = min(shown, keep - kept)
+                ways = math.comb(count - assigned, shown)
+                shifted = np.zeros_like(sums)
+                shift = take * face
+                shifted[shift:] = sums[:len(sums) - shift] * ways
+                key = (assigned + shown, kept + take)
+                if key in next_states:
+                    next_states[key] += shifted
+                else:
+                    next_states[key] = shifted
+        states = next_states
+    sums = sum(s for (assigned, _), s in states.items() if assigned == count)
+    return sums / float(sides) ** count
+
+class DiceGroup:
+    """Группа одинаковых кубиков, например 4d6dl1"""
+
+    def __init__(self, count, sides, keep=None, keep_count=None):
+        self.count = count
+        self.sides = sides
+        self.keep = keep                # 'h' или 'l' — оставить старшие или младшие
+        self.keep_count = keep_count if keep else count
+
+    def roll(self, rng, py_random=dice_random):
+        """Бросить группу; вернуть сумму и текстовую запись результатов"""
+        if self.count <= SMALL_POOL:
+            # Для пары кубиков накладные расходы NumPy больше самого броска
+            rolls = [py_random.randint(1, self.sides) for _ in range(self.count)]
+        else:
+            rolls = rng.integers(1, self.sides + 1, size=self.count).tolist()
+        kept = None
+        if self.keep:
+            order = sorted(range(self.count), key=rolls.__getitem__)
+            kept = set(order[-self.keep_count:] if self.keep == 'h' else order[:self.keep_count])
+        total = sum(r for i, r in enumerate(rolls) if i in kept) if kept is not None else sum(rolls)
+        if self.count > MAX_SHOWN_DICE:
+            return total, f"[{self.count} кубиков]"
+        values = [str(r) if kept is None or i in kept else f"({r})" for i, r in enumerate(rolls)]
+        if self.count == 1:
+            return total, values[0]
+        return total, "[" + ", ".join(values) + "]"
+
+    def roll_many(self, times, rng):
+        """Векторно бросить группу times раз и вернуть массив сумм"""
+        rolls = rng.integers(1, self.sides + 1, size=(times, self.count))
+        if not self.keep:
+            return rolls.sum(axis=1)
+        rolls.sort(axis=1)
+        kept = rolls[:, -self.keep_count:] if self.keep == 'h' else rolls[:, :self.keep_count]
+        return kept.sum(axis=1)
+
+    def pmf(self):
+        """Распределение суммы группы; индекс массива — сумма минус minimum()"""
+        if not self.keep or self.keep_count == self.count:
+            return _power_pmf(np.full(self.sides, 1.0 / self.sides), self.count), True
+        if self.count > EXACT_KEEP_DICE or _keep_highest_work(self.count, self.sides, self.keep_count) > EXACT_KEEP_WORK:
+            samples = min(SAMPLED_ROLLS, max(100, MAX_ROLL_CELLS // self.count))
+            totals = self.roll_many(samples, np.random.default_rng(0))
+            counts = np.bincount(totals - self.keep_count, minlength=self.keep_count * (self.sides - 1) + 1)
+            return counts / counts.sum(), False
+        high = _keep_highest_pmf(self.count, self.sides, self.keep_count)[self.keep_count:]
+        # Младшие k — зеркальное отражение старших k (грань v ↔ sides+1-v)
+        return (high if self.keep == 'h' else high[::-1]), True
+
+    def minimum(self):
+        return self.keep_count
+
+    def support(self):
+        """Число возможных сумм группы"""
+        return self.keep_count * (self.sides - 1) + 1
+
+class DiceExpression:
+    """Скомпилированное выражение: список слагаемых (знак, DiceGroup или число)"""
+
+    def __init__(self, text, terms):
+        self.text = text
+        self.terms = terms
+        self._distribution = None
+
+    def roll(self, rng=None):
+        """Бросить выражение; вернуть итог и запись вида "[3, 5] + 2" """
+        py_random, rng = dice_generators() if rng is None else (dice_random, rng)
+        total = 0
+        parts = []
+        for sign, term in self.terms:
+            if isinstance(term, DiceGroup):
+                value, shown = term.roll(rng, py_random)
+            else:
+                value, shown = term, str(term)
+            total += sign * value
+            if parts:
+                parts.append("-" if sign < 0 else "+")
+            elif sign < 0:
+                shown = "-" + shown
+            parts.append(shown)
+        return total, " ".join(parts)
+
+    def roll_many(self, times, rng=None):
+        """Векторно бросить выражение times раз (большие броски — частями)"""
+        rng = rng or dice_generators()[1]
+        largest = max((term.count for _, term in self.terms if isinstance(term, DiceGroup)), default=1)
+        chunk = max(1, MAX_ROLL_CELLS // largest)
+        totals = np.zeros(times, dtype=np.int64)
+        for start in range(0, times, chunk):
+            part = totals[start:start + chunk]
+            for sign, term in self.terms:
+                part += sign * (term.roll_many(len(part), rng) if isinstance(term, DiceGroup) else term)
+        return totals
+
+    def dice_count(self):
+        """Число кубиков в одном броске выражения"""
+        return sum(term.count for _, term in self.terms if isinstance(term, DiceGroup))
+
+    def support_size(self):
+        """Число возможных итогов выражения"""
+        return sum(term.support() - 1 for _, term in self.terms if isinstance(term, DiceGroup)) + 1
+
+    def distribution(self):
+        """Распределение итога: (минимальное значение, вероятности, точное ли)"""
+        if self._distribution is None:
+            low = 0
+            pmf = np.ones(1)
+            exact = True
+            for sign, term in self.terms:
+                if isinstance(term, DiceGroup):
+                    group_pmf, group_exact = term.pmf()
+                    exact = exact and group_exact
+                    if sign < 0:
+                        group_pmf = group_pmf[::-1]
+                        low -= term.minimum() + len(group_pmf) - 1
+                    else:
+                        low += term.minimum()
+                    pmf = np.convolve(pmf, group_pmf) if len(pmf) * len(group_pmf) <= 4_000_000 else _fft_convolve(pmf, group_pmf)
+                else:
+                    low += sign * term
+            self._distribution = (low, pmf, exact)
+        return self._distribution
+
+    def stats(self, dc=None):
+        """Среднее, процентили и (если задан dc) шанс выкинуть не меньше dc"""
+        low, pmf, exact = self.distribution()
+        values = np.arange(low, low + len(pmf))
+        cdf = np.cumsum(pmf)
+
+        def percentile(q):
+            return int(values[min(np.searchsorted(cdf, q - 1e-12), len(values) - 1)])
+
+        result = {
+            "exact": exact,
+            "mean": float((values * pmf).sum()),
+            "min": int(values[np.nonzero(pmf)[0][0]]),
+            "max": int(values[np.nonzero(pmf)[0][-1]]),
+            "p10": percentile(0.10),
+            "p50": percentile(0.50),
+            "p90": percentile(0.90),
+        }
+        if dc is not None:
+            result["chance"] = float(pmf[max(0, dc - low):].sum()) if dc - low < len(pmf) else 0.0
+        return result
+
+def _fft_convolve(a, b):
+    size = len(a) + len(b) - 1
+    length = 1 << (size - 1).bit_length()
+    result = np.clip(np.fft.irfft(np.fft.rfft(a, length) * np.fft.rfft(b, length), length)[:size], 0, None)
+    return result / result.sum()
+
+@functools.lru_cache(maxsize=1024)
+def compile_dice(expr):
+    """Разобрать выражение кубиков и вернуть DiceExpression (с кэшированием)
+
+    Поддерживаются слагаемые NdM, dM, d%, NdMkhK/klK (оставить K старших/младших),
+    NdMdhK/dlK (отбросить K старших/младших) и целые числа, например
+    8d6+1d4+3, 2d20kh1 или 4d6dl1. Пробелы допустимы только вокруг + и -:
+    "1d6 2" — ошибка, а не d62. При ошибке поднимается ValueError.
+    """
+    text = _DICE_OPERATOR_SPACE.sub(r'\1', expr.strip()).lower()
+    if any(char.isspace() for char in text):
+        raise ValueError(f"Неверное выражение кубиков: {expr}")
+    if not text or 'd' not in text:
+        raise ValueError("В выражении нет кубиков")
+    terms = []
+    pos = 0
+    while pos < len(text):
+        match = _DICE_TERM.match(text, pos)
+        if not match or match.end() == pos or (terms and not match.group(1)):
+            raise ValueError(f"Неверное выражение кубиков: {expr}")
+        sign = -1 if match.group(1) == '-' else 1
+        count, sides, mode, mode_count, number = match.group(2, 3, 4, 5, 6)
+        if number is not None:
+            terms.append((sign, int(number)))
+        else:
+            count = int(count) if count else 1
+            sides = 100 if sides == '%' else int(sides)
+            if not (1 <= count <= MAX_DICE and 1 <= sides <= MAX_SIDES):
+                raise ValueError(f"Слишком много кубиков или граней: {expr}")
+            keep, keep_count = None, None
+            if mode:
+                mode_count = int(mode_count)
+                if mode in ('dh', 'dl'):
+                    mode_count = count - mode_count
+                    mode = 'kl' if mode == 'dh' else 'kh'
+                if not 1 <= mode_count <= count:
+                    raise ValueError(f"Нельзя оставить {mode_count} из {count} кубиков")
+                keep, keep_count = mode[1], mode_count
+            terms.append((sign, DiceGroup(count, sides, keep, keep_count)))
+        if len(terms) > MAX_TERMS:
+            raise ValueError("Слишком много слагаемых")
+        pos = match.end()
+    expression = DiceExpression(text, terms)
+    if expression.dice_count() > MAX_TOTAL_DICE:
+        raise ValueError(f"Слишком много кубиков в выражении: больше {MAX_TOTAL_DICE}")
+    return expression
+
 def process_dice_rolls(text):
     """Обработать выражения бросков кубиков типа {1d20+5} в тексте и заменить результатами"""
     def roll_dice(match):
-        dice_expr = match.group(1)
-        
-        # Разобрать выражение кубиков (например, "2d6+3")
-        if '+' in dice_expr:
-            dice_part, bonus_part = dice_expr.split('+')
-            bonus = int(bonus_part)
-        elif '-' in dice_expr:
-            dice_part, penalty_part = dice_expr.split('-')
-            bonus = -int(penalty_part)
-        else:
-            dice_part = dice_expr
-            bonus = 0
-            
-        num_dice, sides = map(int, dice_part.split('d'))
-        
-        # Бросить кубики
-        rolls = [random.randint(1, sides) for _ in range(num_dice)]
-        total = sum(rolls) + bonus
-        
-        # Форматировать результат
-        if len(rolls) > 1:
-            return f"{{{dice_expr} → [" + ", ".join(str(r) for r in rolls) + f"] + {bonus} = {total}}}"
-        else:
-            return f"{{{dice_expr} → {rolls[0]}" + (f" + {bonus}" if bonus != 0 else "") + f" = {total}}}"
+        try:
+            expression = compile_dice(match.group(1))
+        except ValueError:
+            return match.group(0)  # Не кубики — оставить как есть
+        total, shown = expression.roll()
+        if shown == str(total):
+            return f"{{{match.group(1)} → {total}}}"
+        return f"{{{match.group(1)} → {shown} = {total}}}"
     
     # Найти все выражения с кубиками и заменить их
-    pattern = r'\{([1-9]\d*d[1-9]\d*(?:[+-][1-9]\d*)?)\}'
-    return re.sub(pattern, roll_dice, text)
+    with stage("dice"):
+        return re.sub(r'\{([0-9dkhl%+\- ]{2,60})\}', roll_dice, text)
+
+class DiceStream:
+    """Инкрементальная обработка бросков кубиков в потоковом тексте"""
+
+    # Выражения кубиков короткие: незакрытая скобка длиннее этого — просто текст
+    MAX_PENDING = 64
+
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, chunk):
+        """Принять фрагмент и вернуть текст, который уже можно показать"""
+        self.pending += chunk
+        cut = self.pending.rfind('{')
+        if cut == -1 or '}' in self.pending[cut:] or len(self.pending) - cut > self.MAX_PENDING:
+            cut = len(self.pending)
+        ready, self.pending = self.pending[:cut], self.pending[cut:]
+        return process_dice_rolls(ready)
+
+    def flush(self):
+        """Вернуть остаток текста в конце потока"""
+        ready, self.pending = self.pending, ""
+        return process_dice_rolls(ready)
+
+class StreamingReply:
+    """Ответ, который дописывается правками сообщений Telegram по мере генерации
+
+    Правки выполняются не чаще STREAM_EDIT_INTERVAL, а текст длиннее
+    MESSAGE_LIMIT сразу продолжается в новом сообщении.
+    """
+
+    def __init__(self, message, interval=STREAM_EDIT_INTERVAL, limit=MESSAGE_LIMIT):
+        self.message = message
+        self.interval = interval
+        self.limit = limit
+        self.text = ""
+        self.sent = []
+        self.shown = []
+        self._last_flush = 0.0
+
+    async def update(self, text):
+        """Запомнить новый текст и показать его, если пришло время правки"""
+        self.text = text
+        now = asyncio.get_running_loop().time()
+        if self.sent and now - self._last_flush < self.interval:
+            return
+        await self._flush(now)
+
+    async def finish(self):
+        """Показать окончательный текст"""
+        await self._flush(asyncio.get_running_loop().time())
+
+    async def _flush(self, now):
+        parts = [self.text[i:i+self.limit] for i in range(0, len(self.text), self.limit)]
+        for idx, part in enumerate(parts):
+            if not part.strip():
+                continue
+            if idx < len(self.sent):
+                if self.shown[idx] != part:
+                    with stage("telegram_text"):
+                        await self.sent[idx].edit_text(part)
+                    self.shown[idx] = part
+            else:
+                with stage("telegram_text"):
+                    self.sent.append(await self.message.reply_text(part))
+                self.shown.append(part)
+        self._last_flush = now
 
 # Функциональность преобразования текста в речь
-def generate_speech(text, output_file="dm_response.mp3"):
-    """Генерировать речь из текста и сохранять в файл"""
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+TTS_TIMEOUT = float(os.environ.get("TTS_TIMEOUT", "60"))
+# Параметры голоса МП: подстрока в имени голоса и скорость речи
+TTS_VOICE_HINT = os.environ.get("TTS_VOICE_HINT", "male")
+TTS_RATE = int(os.environ.get("TTS_RATE", "150"))
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Кодирование в OGG/Opus (формат голосовых сообщений Telegram) через ffmpeg;
+# без ffmpeg отправляется исходный WAV
+TTS_ENCODER = os.environ.get("TTS_ENCODER") or shutil.which("ffmpeg")
+TTS_OPUS_BITRATE = os.environ.get("TTS_OPUS_BITRATE", "32k")
+TTS_FORMAT = "ogg" if TTS_ENCODER else "wav"
+
+# Движок TTS живет в каждом рабочем процессе и инициализируется один раз
+_tts_engine = None
+
+def _init_tts_worker():
+    """Инициализировать движок и выбрать голос в рабочем процессе"""
+    global _tts_engine
+    _tts_engine = pyttsx3.init()
+    # Настроить параметры голоса для более драматичного голоса МП
+    for voice in _tts_engine.getProperty('voices'):
+        if TTS_VOICE_HINT in voice.name.lower():
+            _tts_engine.setProperty('voice', voice.id)
+            break
+    # Немного замедленная скорость для драматического эффекта
+    _tts_engine.setProperty('rate', TTS_RATE)
+
+def _synthesize(clean_text, output_file):
+    """Синтезировать речь и закодировать ее в Opus (выполняется в рабочем процессе)
+
+    ffmpeg читает WAV прямо из файла, записанного движком, и пишет OGG
+    в output_file. Возвращает размер WAV, размер результата и время кодирования.
+    """
+    if not TTS_ENCODER:
+        _tts_engine.save_to_file(clean_text, output_file)
+        _tts_engine.runAndWait()
+        size = os.path.getsize(output_file)
+        return size, size, 0.0
+    raw_file = output_file + ".wav"
     try:
-        # Удалить обозначения бросков кубиков для более чистой речи
-        clean_text = re.sub(r'\{.*?\}', '', text)
-        
-        engine = pyttsx3.init()
-        # Настроить параметры голоса для более драматичного голоса МП
-        voice_id = None
-        voices = engine.getProperty('voices')
-        for voice in voices:
-            if 'male' in voice.name.lower():
-                voice_id = voice.id
-                break
-        
-        if voice_id:
-            engine.setProperty('voice', voice_id)
-        
-        # Немного замедленная скорость для драматического эффекта
-        engine.setProperty('rate', 150)
-        engine.save_to_file(clean_text, output_file)
-        engine.runAndWait()
-        return output_file
+        _tts_engine.save_to_file(clean_text, raw_file)
+        _tts_engine.runAndWait()
+        raw_size = os.path.getsize(raw_file)
+        started = time.perf_counter()
+        subprocess.run(
+            [TTS_ENCODER, "-hide_banner", "-loglevel", "error", "-y", "-i", raw_file,
+             "-ac", "1", "-c:a", "libopus", "-b:a", TTS_OPUS_BITRATE, "-application", "voip",
+             "-f", "ogg", output_file],
+            check=True, timeout=TTS_TIMEOUT,
+        )
+        return raw_size, os.path.getsize(output_file), time.perf_counter() - started
+    finally:
+        if os.path.exists(raw_file):
+            os.remove(raw_file)
+
+_tts_pool = None
+
+def get_tts_pool():
+    """Вернуть пул процессов TTS, создав его при первом обращении"""
+    global _tts_pool
+    if _tts_pool is None:
+        _tts_pool = ProcessPoolExecutor(max_workers=TTS_WORKERS, initializer=_init_tts_worker)
+    return _tts_pool
+
+def shutdown_tts_pool():
+    """Остановить рабочие процессы TTS"""
+    global _tts_pool
+    if _tts_pool is not None:
+        _tts_pool.shutdown(wait=False, cancel_futures=True)
+        _tts_pool = None
+
+def _discard_tts_pool(pool, kill=False):
+    """Убрать пул из обращения; следующий синтез создаст новый
+
+    kill — завершить процессы пула: зависший синтез иначе продолжал бы
+    занимать процесс, хотя слот планировщика уже освобожден.
+    """
+    global _tts_pool
+    if _tts_pool is pool:
+        _tts_pool = None
+    if kill:
+        # У ProcessPoolExecutor нет публичного способа прервать выполняемую задачу
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+tts_scheduler = JobScheduler("tts", TTS_WORKERS)
+
+async def _render_speech(clean_text, output_file):
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = get_tts_pool()
+        job = loop.run_in_executor(pool, _synthesize, clean_text, output_file)
+        try:
+            return await asyncio.wait_for(job, TTS_TIMEOUT)
+        except BrokenProcessPool:
+            # Упал процесс синтеза или его инициализация: пул больше не работает
+            _discard_tts_pool(pool)
+            if attempt:
+                raise
+            logger.warning("Пул процессов TTS сломан, создается новый")
+        except asyncio.TimeoutError:
+            _discard_tts_pool(pool, kill=True)
+            raise
+
+class SpeechClip:
+    """Озвученный фрагмент: файл в кэше и, если уже загружался, file_id в Telegram"""
+
+    def __init__(self, key, path=None, file_id=None, text=None):
+        self.key = key
+        self.path = path
+        self.file_id = file_id
+        self.text = text  # очищенный текст: по нему клип синтезируется заново, если file_id отклонен
+
+class AudioCache:
+    """Кэш озвучки на диске с адресацией по содержимому
+
+    Ключ — хэш очищенного текста, голоса и скорости. Размер каталога
+    ограничен max_bytes, при переполнении удаляются давно не
+    использованные файлы. После первой отправки запоминается file_id
+    Telegram, и повторы отправляются ссылкой без синтеза и загрузки.
+    """
+
+    # Временные файлы синтеза старше этого срока остались от прерванных процессов
+    STALE_PART_AGE = 3600
+
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._files = None  # key -> размер, от давно использованных к недавним
+        self._file_ids = {}
+        self._inflight = {}
+
+    @staticmethod
+    def key(clean_text):
+        payload = "\0".join((" ".join(clean_text.split()), TTS_VOICE_HINT, str(TTS_RATE), TTS_FORMAT, TTS_OPUS_BITRATE))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.{TTS_FORMAT}")
+
+    def _load_index(self):
+        if self._files is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.endswith(f".{TTS_FORMAT}"):
+                continue
+            stat = entry.stat()
+            if ".part." in entry.name:
+                # Свежий временный файл может еще писать предыдущий процесс с тем же каталогом
+                if now - stat.st_mtime > self.STALE_PART_AGE:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                continue
+            entries.append((stat.st_mtime, entry.name.rsplit(".", 1)[0], stat.st_size))
+        entries.sort()
+        self._files = OrderedDict((key, size) for _, key, size in entries)
+        self.total_bytes = sum(self._files.values())
+
+    def _touch(self, key):
+        self._files.move_to_end(key)
+        try:
+            os.utime(self.path(key))  # mtime служит порядком LRU после перезапуска
+        except OSError:
+            pass
+
+    def _add(self, key):
+        size = os.path.getsize(self.path(key))
+        self._files[key] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self._files) > 1:
+            old_key, old_size = self._files.popitem(last=False)
+            self.total_bytes -= old_size
+            try:
+                os.remove(self.path(old_key))
+            except OSError:
+                pass
+
+    async def get(self, clean_text, chat_id=None):
+        """Вернуть клип из кэша или синтезировать его"""
+        self._load_index()
+        key = self.key(clean_text)
+        file_id = await self.file_id(key)
+        if key in self._files and os.path.exists(self.path(key)):
+            self._touch(key)
+            return SpeechClip(key, self.path(key), file_id, clean_text)
+        self._discard(key)
+        if file_id:
+            return SpeechClip(key, None, file_id, clean_text)
+        # Одинаковый текст, который уже синтезируется, не синтезируется второй раз
+        if key not in self._inflight:
+            render = asyncio.ensure_future(self._render(key, clean_text, chat_id))
+            render.add_done_callback(lambda _, key=key: self._inflight.pop(key, None))
+            self._inflight[key] = render
+        return await asyncio.shield(self._inflight[key])
+
+    async def _render(self, key, clean_text, chat_id):
+        fd, temp_file = tempfile.mkstemp(prefix=f"{key}.", suffix=f".part.{TTS_FORMAT}", dir=self.directory)
+        os.close(fd)
+        try:
+            raw_size, size, encode_time = await tts_scheduler.run(chat_id, PRIORITY_VOICE, _render_speech, clean_text, temp_file)
+            os.replace(temp_file, self.path(key))
+            if TTS_ENCODER:
+                logger.info(f"Озвучка закодирована в Opus: {raw_size / 1024:.0f} КБ → {size / 1024:.0f} КБ "
+                            f"(сжатие {raw_size / max(size, 1):.1f}×) за {encode_time * 1000:.0f} мс")
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        self._add(key)
+        return SpeechClip(key, self.path(key), text=clean_text)
+
+    def _discard(self, key):
+        """Убрать из индекса клип, файла которого больше нет"""
+        size = self._files.pop(key, None) if self._files is not None else None
+        if size is not None:
+            self.total_bytes -= size
+
+    def open(self, clip):
+        """Открыть файл клипа для загрузки; None, если файла нет"""
+        if clip.path is None:
+            return None
+        try:
+            return open(clip.path, 'rb')
+        except FileNotFoundError:
+            self._discard(clip.key)
+            return None
+
+    async def file_id(self, key):
+        """file_id Telegram для клипа, если он уже загружался"""
+        if key not in self._file_ids:
+            row = await db.fetchone("SELECT file_id FROM voice_file_ids WHERE audio_key = ?", (key,))
+            if not row:
+                return None
+            self._file_ids[key] = row[0]
+        return self._file_ids[key]
+
+    async def remember_file_id(self, key, file_id):
+        """Запомнить file_id после первой загрузки"""
+        self._file_ids[key] = file_id
+        await db.execute("INSERT OR REPLACE INTO voice_file_ids (audio_key, file_id) VALUES (?, ?)", (key, file_id))
+
+    async def forget_file_id(self, key):
+        """Забыть file_id, который Telegram больше не принимает"""
+        self._file_ids.pop(key, None)
+        await db.execute("DELETE FROM voice_file_ids WHERE audio_key = ?", (key,))
+
+audio_cache = AudioCache()
+
+async def generate_speech(text, chat_id=None):
+    """Получить озвучку текста из кэша или синтезировать ее; вернуть SpeechClip"""
+    # Удалить обозначения бросков кубиков для более чистой речи
+    clean_text = re.sub(r'\{.*?\}', '', text)
+    if not clean_text.strip():
+        return None
+    try:
+        with stage("tts"):
+            return await audio_cache.get(clean_text, chat_id)
     except Exception as e:
         logger.error(f"Ошибка при генерации речи: {e}")
         return None
 
+async def send_speech(update: Update, speech_task, caption=None):
+    """Дождаться синтеза и отправить голосовое сообщение"""
+    await send_voice_file(update, await speech_task, caption)
+
+async def send_voice_file(update: Update, clip, caption=None, resynthesize=True):
+    """Отправить клип голосовым сообщением: ссылкой на file_id или загрузкой файла"""
+    if clip is None:
+        return
+    if clip.file_id:
+        try:
+            with stage("telegram_voice"):
+                await update.message.reply_voice(voice=clip.file_id, caption=caption)
+            return
+        except BadRequest as e:
+            # file_id устарел или принадлежит другому боту: загрузить файл заново
+            logger.warning(f"Telegram отклонил file_id озвучки, файл загружается заново: {e}")
+            await audio_cache.forget_file_id(clip.key)
+    audio = audio_cache.open(clip)
+    if audio is None:
+        # Файла нет (вытеснен из кэша или не сохранялся): синтезировать заново, но один раз
+        if not resynthesize:
+            return
+        chat = update.effective_chat
+        clip = await generate_speech(clip.text or "", chat.id if chat else None)
+        return await send_voice_file(update, clip, caption, resynthesize=False)
+    with audio, stage("telegram_voice"):
+        message = await update.message.reply_voice(voice=audio, caption=caption)
+    if message.voice:
+        await audio_cache.remember_file_id(clip.key, message.voice.file_id)
+
+class SpeechPipeline:
+    """Конвейер озвучки по предложениям
+
+    Текст разбивается на предложения прямо во время генерации. Первое
+    предложение озвучивается отдельно, чтобы голос появился как можно
+    раньше, а остальные собираются в клипы по REST_CHUNK_CHARS символов:
+    иначе каждое предложение стало бы отдельным голосовым сообщением и
+    группа быстро упиралась бы в лимит Telegram на сообщения в чат.
+    Клипы озвучиваются параллельно в пуле TTS и отправляются строго по порядку.
+    """
+
+    SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+    # Слишком короткие предложения объединяются со следующими
+    MIN_CHUNK_CHARS = 40
+    # Размер следующих клипов: обычный ответ МП укладывается в один-два
+    REST_CHUNK_CHARS = 600
+
+    def __init__(self, update: Update):
+        self.update = update
+        self.consumed = 0
+        self.chunks = 0
+        self.queue = asyncio.Queue()
+        self.sender = asyncio.create_task(self._send_loop())
+
+    def feed(self, text):
+        """Принять накопленный текст и отправить в синтез законченные фрагменты"""
+        start = self.consumed
+        for match in self.SENTENCE_END.finditer(text, self.consumed):
+            limit = self.MIN_CHUNK_CHARS if not self.chunks else self.REST_CHUNK_CHARS
+            if match.start() - start >= limit:
+                self._submit(text[start:match.start()])
+                start = match.end()
+        self.consumed = start
+
+    async def finish(self, text):
+        """Озвучить остаток текста и дождаться отправки всех клипов"""
+        self.feed(text)
+        self._submit(text[self.consumed:])
+        self.consumed = len(text)
+        await self.queue.put(None)
+        await self.sender
+
+    async def cancel(self):
+        """Прервать отправку и синтез еще не отправленных клипов (ход не удался)"""
+        self.sender.cancel()
+        tasks = [self.sender]
+        while not self.queue.empty():
+            speech_task = self.queue.get_nowait()
+            if speech_task is not None:
+                speech_task.cancel()
+                tasks.append(speech_task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _submit(self, chunk):
+        if chunk.strip():
+            self.chunks += 1
+            self.queue.put_nowait(asyncio.create_task(generate_speech(chunk, self.update.effective_chat.id)))
+
+    async def _send_loop(self):
+        while (speech_task := await self.queue.get()) is not None:
+            try:
+                await send_speech(self.update, speech_task)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке голосового сообщения: {e}")
+
+# Раунды: одновременные действия игроков чата объединяются в один ход МП
+TURN_WINDOW = float(os.environ.get("TURN_WINDOW", "1.5"))
+# Сколько секунд при остановке ждать уже начатые раунды, прежде чем отменить их
+TURN_CLOSE_TIMEOUT = float(os.environ.get("TURN_CLOSE_TIMEOUT", "30"))
+
+class PlayerAction:
+    """Действие игрока, ожидающее хода МП"""
+
+    def __init__(self, update, chat_data, session_id, player_name, text):
+        self.update = update
+        self.chat_data = chat_data
+        self.session_id = session_id
+        self.player_name = player_name
+        self.text = text
+        trace = current_trace.get()
+        self.trace_id = trace.trace_id if trace else None
+        self.created = time.perf_counter()
+
+async def play_turn(batch):
+    """Сыграть один ход МП в ответ на все действия раунда"""
+    first = batch[0]
+    session_id = first.session_id
+    chat_id = first.update.effective_chat.id
+    trace = Trace("turn", chat_id=chat_id, session_id=session_id, actions=len(batch),
+                  updates=[action.trace_id for action in batch])
+    # Ход отсчитывается от первого действия раунда, включая окно сбора
+    trace.started = min(action.created for action in batch)
+    trace.add("coalesce", time.perf_counter() - trace.started)
+    session_recorder.batch(chat_id, [action.update.update_id for action in batch])
+    with tracing(trace):
+        await _play_turn(batch, first, session_id, chat_id)
+
+async def _play_turn(batch, first, session_id, chat_id):
+    actions = [(action.player_name, action.text) for action in batch if action.session_id == session_id]
+    speech = SpeechPipeline(first.update) if first.chat_data.get('voice_enabled', True) else None
+    try:
+        if LLM_STREAMING:
+            reply = StreamingReply(first.update.message)
+            
+            async def on_text(partial):
+                await reply.update(partial)
+                if speech:
+                    speech.feed(partial)
+            
+            dm_response = await llm_scheduler.run(chat_id, PRIORITY_TURN, generate_dm_response, actions, session_id, on_text)
+            await reply.finish()
+        else:
+            dm_response = await llm_scheduler.run(chat_id, PRIORITY_TURN, generate_dm_response, actions, session_id)
+            # Разделить ответ на части, если он слишком длинный
+            for i in range(0, len(dm_response), MESSAGE_LIMIT):
+                with stage("telegram_text"):
+                    await first.update.message.reply_text(dm_response[i:i+MESSAGE_LIMIT])
+        
+        # Дождаться озвучки оставшихся предложений
+        if speech:
+            await speech.finish(dm_response)
+    except BaseException:
+        # Иначе отправитель ждал бы очередь вечно, а начатый синтез никто бы не дождался
+        if speech:
+            await speech.cancel()
+        raise
+
+class TurnCoalescer:
+    """Очередь действий для каждого чата с коротким окном сбора
+
+    Первое действие открывает окно длиной window секунд; все действия,
+    пришедшие за это время, уходят в один запрос к LLM. Действия,
+    пришедшие во время хода, составляют следующий раунд, поэтому ходы
+    одного чата идут строго по очереди.
+    """
+
+    def __init__(self, window=TURN_WINDOW, play=play_turn):
+        self.window = window
+        self.play = play
+        self._pending = {}
+        self._tasks = {}
+        self._closed = False
+
+    def submit(self, chat_id, action):
+        """Добавить действие в очередь чата; после close() вернуть False"""
+        if self._closed:
+            logger.warning(f"Действие в чате {chat_id} отклонено: бот останавливается")
+            return False
+        self._pending.setdefault(chat_id, []).append(action)
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return True
+
+    async def close(self, timeout=TURN_CLOSE_TIMEOUT):
+        """Перестать принимать действия и дождаться начатых раундов (при остановке бота)
+
+        Раунды, не завершившиеся за timeout секунд, отменяются, чтобы
+        история и состояние сохранялись уже после последнего хода.
+        """
+        self._closed = True
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning(f"Раунды не завершились за {timeout:.0f} с и отменены: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _drain(self, chat_id):
+        try:
+            await asyncio.sleep(self.window)
+            while self._pending.get(chat_id):
+                await self._play(chat_id, self._pending.pop(chat_id))
+        finally:
+            self._tasks.pop(chat_id, None)
+            self._pending.pop(chat_id, None)
+
+    async def _play(self, chat_id, batch):
+        """Сыграть раунд и сообщить игрокам об ошибке"""
+        try:
+            await self.play(batch)
+        except SchedulerBusy:
+            await reply_busy(batch[0].update)
+        except Exception as e:
+            logger.error(f"Ошибка при ходе МП в чате {chat_id}: {e}")
+            try:
+                await batch[0].update.message.reply_text("Мастер Подземелий задумался и не смог ответить. Попробуйте еще раз.")
+            except Exception as e:
+                logger.error(f"Не удалось сообщить об ошибке в чат {chat_id}: {e}")
+
+turn_coalescer = TurnCoalescer()
+
+async def reply_busy(update: Update):
+    """Сообщить игрокам, что бот перегружен"""
+    try:
+        await update.message.reply_text("⏳ Мастер Подземелий сейчас занят. Попробуйте через минуту.")
+    except Exception as e:
+        logger.error(f"Не удалось отправить сообщение о перегрузке: {e}")
+
+# Состояние чатов (active_session_id, voice_enabled) и пользователей
+# (ожидаемый выбор кампании, варианты) в SQLite
+STATE_CACHE_SIZE = int(os.environ.get("STATE_CACHE_SIZE", "10000"))
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "2"))
+PENDING_CHOICE_TTL = float(os.environ.get("PENDING_CHOICE_TTL", str(24 * 3600)))
+STATE_SWEEP_INTERVAL = float(os.environ.get("STATE_SWEEP_INTERVAL", "3600"))
+# Рабочие процессы режима вебхука (см. WebhookFront). Чаты распределены между
+# ними без пересечений, а один пользователь может играть в чатах разных процессов,
+# поэтому состояние пользователей в рабочем процессе не кэшируется
+WORKERS = int(os.environ.get("WORKERS", str(os.cpu_count() or 1)))
+WORKER_INDEX = os.environ.get("WORKER_INDEX")  # задается фронтом для рабочих процессов
+SHARED_USER_STATE = WORKER_INDEX is not None and WORKERS > 1
+# Незавершенный выбор: удаляется, если пользователь не отвечал дольше PENDING_CHOICE_TTL
+PENDING_KEYS = ('expecting_campaign_choice', 'campaign_options', 'expecting_character_choice', 'character_options')
+
+def _write_state(conn, table, key_column, rows, deleted):
+    conn.executemany(f"""
+    INSERT INTO {table} ({key_column}, data, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT({key_column}) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+    """, rows)
+    conn.executemany(f"DELETE FROM {table} WHERE {key_column} = ?", deleted)
+
+def _expire_state(conn, table, cutoff):
+    """Удалить незавершенный выбор из давно не менявшихся записей; вернуть число затронутых"""
+    paths = ", ".join(f"'$.{key}'" for key in PENDING_KEYS)
+    conditions = " OR ".join(f"json_type(data, '$.{key}') IS NOT NULL" for key in PENDING_KEYS)
+    changed = conn.execute(f"""
+    UPDATE {table} SET data = json_remove(data, {paths})
+    WHERE updated_at < ? AND ({conditions})
+    """, (cutoff,)).rowcount
+    conn.execute(f"DELETE FROM {table} WHERE data = '{{}}'")
+    return changed
+
+class StateStore:
+    """Словари состояния чатов или пользователей с ленивой загрузкой и отложенной записью
+
+    Запись загружается из SQLite при первом обращении и хранится в
+    LRU-кэше на max_size записей. Измененные записи сохраняются пакетом
+    в одной транзакции раз в STATE_FLUSH_INTERVAL секунд и при остановке.
+    Незавершенный выбор (PENDING_KEYS) старше ttl удаляется и в памяти,
+    и в базе, поэтому тексты вариантов не копятся бесконечно.
+    """
+
+    def __init__(self, table, key_column, max_size=STATE_CACHE_SIZE, ttl=PENDING_CHOICE_TTL,
+                 interval=STATE_FLUSH_INTERVAL, sweep_interval=STATE_SWEEP_INTERVAL):
+        self.table = table
+        self.key_column = key_column
+        self.max_size = max_size
+        self.ttl = ttl
+        self.interval = interval
+        self.sweep_interval = sweep_interval
+        self._cache = OrderedDict()  # key -> (state, время последнего изменения)
+        self._dirty = {}  # key -> state; вытесненные из кэша записи живут здесь до сохранения
+        self._loading = {}
+        self._task = None
+
+    async def get(self, key):
+        """Вернуть словарь состояния, загрузив его при первом обращении"""
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            return entry[0]
+        if key in self._dirty:
+            self._put(key, self._dirty[key], time.time())
+            return self._dirty[key]
+        # Одновременные обновления одного чата должны получить один и тот же словарь
+        loading = self._loading.get(key)
+        if loading is None:
+            loading = self._loading[key] = asyncio.ensure_future(self._load(key))
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, key):
+        row = await db.fetchone(f"SELECT data, updated_at FROM {self.table} WHERE {self.key_column} = ?", (key,))
+        state, updated_at = (json.loads(row[0]), row[1]) if row else ({}, time.time())
+        if self._expire(state, updated_at, time.time()):
+            self._dirty[key] = state
+        self._put(key, state, updated_at)
+        return state
+
+    def _put(self, key, state, updated_at):
+        self._cache[key] = (state, updated_at)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def _expire(self, state, updated_at, now):
+        if now - updated_at < self.ttl or not any(key in state for key in PENDING_KEYS):
+            return False
+        for key in PENDING_KEYS:
+            state.pop(key, None)
+        return True
+
+    def mark(self, key, state):
+        """Отметить, что состояние изменилось и его нужно сохранить"""
+        self._dirty[key] = state
+        if key in self._cache:
+            self._cache[key] = (state, time.time())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись и сохранить все изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+            if time.monotonic() - last_sweep >= self.sweep_interval:
+                last_sweep = time.monotonic()
+                await self.sweep()
+
+    async def flush(self):
+        """Сохранить все измененные записи одной транзакцией"""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        now = time.time()
+        rows = [(key, json.dumps(state, ensure_ascii=False), now) for key, state in batch.items() if state]
+        deleted = [(key,) for key, state in batch.items() if not state]
+        try:
+            await db.transaction(_write_state, self.table, self.key_column, rows, deleted)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить {self.table}: {e}")
+            for key, state in batch.items():
+                self._dirty.setdefault(key, state)
+
+    async def sweep(self):
+        """Удалить устаревший незавершенный выбор в памяти и в базе"""
+        now = time.time()
+        for key, (state, updated_at) in list(self._cache.items()):
+            if key not in self._dirty and self._expire(state, updated_at, now):
+                self._cache[key] = (state, now)
+        try:
+            expired = await db.transaction(_expire_state, self.table, now - self.ttl)
+        except Exception as e:
+            logger.error(f"Ошибка при очистке {self.table}: {e}")
+            return
+        if expired:
+            logger.info(f"{self.table}: удален устаревший выбор в {expired} записях")
+
+chat_state = StateStore("chat_state", "chat_id")
+# Без кэша состояние пользователя читается из базы и сохраняется сразу после обработчика
+user_state = StateStore("user_state", "user_id", max_size=0 if SHARED_USER_STATE else STATE_CACHE_SIZE)
+
+class StateContext:
+    """Контекст обработчика, в котором chat_data и user_data берутся из StateStore"""
+
+    def __init__(self, context, chat_data, user_data):
+        self._context = context
+        self.chat_data = chat_data
+        self.user_data = user_data
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+def _state_snapshot(state):
+    return json.dumps(state, sort_keys=True, ensure_ascii=False)
+
+def with_state(handler):
+    """Обернуть обработчик: подставить сохраняемое состояние и отметить его изменения"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        chat_id, user_id = update.effective_chat.id, update.effective_user.id
+        with stage("state_load"):
+            chat_data, user_data = await chat_state.get(chat_id), await user_state.get(user_id)
+        chat_before, user_before = _state_snapshot(chat_data), _state_snapshot(user_data)
+        try:
+            return await handler(update, StateContext(context, chat_data, user_data))
+        finally:
+            if _state_snapshot(chat_data) != chat_before:
+                chat_state.mark(chat_id, chat_data)
+            if _state_snapshot(user_data) != user_before:
+                user_state.mark(user_id, user_data)
+                if SHARED_USER_STATE:
+                    await user_state.flush()
+    return wrapper
+
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "256"))
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных чатов обрабатываются параллельно, одного чата — по очереди
+
+    Обработчик следующего обновления чата видит состояние, сохраненное
+    предыдущим: например, выбор кампании сразу после /new_game. Блокировки
+    asyncio справедливы, поэтому порядок обновлений чата сохраняется.
+    Долгая работа хода идет в TurnCoalescer и чат не задерживает.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # chat_id -> [блокировка, число ожидающих]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        entry = self._locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 # Обработчики команд
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
@@ -283,7 +3483,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/join_game - Присоединиться к существующей кампании\n"
         "/create_character - Создать нового персонажа\n"
         "/show_character - Показать детали вашего персонажа\n"
-        "/roll [кубики] - Бросить кубики (например, /roll 2d6+3)\n"
+        "/roll [кубики] - Бросить кубики (например, /roll 2d6+3, /roll 2d20kh1 dc 15)\n"
         "/speak - Включить/выключить голосовое повествование\n\n"
         "Пусть приключение начнется!"
     )
@@ -304,7 +3504,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /level_up - Повысить уровень вашего персонажа
 
 ИГРОВЫЕ МЕХАНИКИ:
-/roll [кубики] - Бросить кубики (например, /roll 2d6+3)
+/roll [кубики] - Бросить кубики (например, /roll 8d6+1d4+3, /roll 2d20kh1+5 dc 15, /roll 6x4d6dl1)
 /initiative - Бросить на инициативу в бою
 /rest - Сделать короткий или долгий отдых
 /speak - Включить/выключить голосовое повествование
@@ -323,46 +3523,43 @@ async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
     
-    conn = sqlite3.connect('dnd_bot.db')
-    cursor = conn.cursor()
-    
     # Проверить, существует ли уже активная игра
-    cursor.execute("SELECT session_id FROM game_sessions WHERE chat_id = ? AND is_active = TRUE", (chat_id,))
-    existing_session = cursor.fetchone()
+    existing_session = await db.fetchone(SQL_ACTIVE_SESSION, (chat_id,))
     
     if existing_session:
-        conn.close()
         await update.message.reply_text("В этом чате уже есть активная игра. Используйте /join_game, чтобы присоединиться, или /end_game, чтобы завершить текущую игру.")
         return
     
-    # Запросить у LLM предложения для новой кампании
-    campaign_prompt = """
-    Создай новую кампанию D&D с тремя вариантами на выбор. Для каждого варианта предоставь:
-    1. Название кампании
-    2. Тип кампании (исследование, героика, хоррор и т.д.)
-    3. Краткое описание сеттинга
-    4. Начальную локацию
-    5. Первый квест
-    
-    Формат ответа должен быть кратким и чётким, с ясным разделением между тремя вариантами.
-    """
+    # Взять готовые варианты кампании из запаса или сгенерировать их
+    try:
+        campaign_options = await option_pool.get("campaign", chat_id, key=f"campaign_options:{user_id}")
+    except SchedulerBusy:
+        await reply_busy(update)
+        return
+    except JobSuperseded:
+        return
     
-    campaign_options = ask_llm(campaign_prompt, "Ты помощник Мастера Подземелий, создающий варианты новых кампаний D&D.")
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Ошибка при разборе вариантов кампании: {e}")
+        await update.message.reply_text("Не удалось придумать варианты кампании. Попробуйте /new_game еще раз.")
+        return
     
     # Сохранить варианты в контексте для дальнейшего использования
+    campaign_options = json.loads(campaign_options)
     context.user_data['campaign_options'] = campaign_options
     
+    # Установить следующий шаг обработки до ответа: игрок может выбрать сразу
+    context.user_data['expecting_campaign_choice'] = True
+    
+    # Пока игрок читает, заранее сгенерировать вступления ко всем вариантам
+    intro_speculation.start(chat_id, user_id, campaign_options)
+    
     await update.message.reply_text(
         f"🏰 {user_name}, давайте создадим новую кампанию D&D! 🏰\n\n"
         "Вот несколько вариантов кампаний. Выберите один, написав его номер (1, 2 или 3):\n\n"
-        f"{campaign_options}\n\n"
+        f"{format_campaign_options(campaign_options)}\n\n"
         "Или напишите /custom, чтобы создать свою собственную кампанию."
     )
-    
-    # Установить следующий шаг обработки
-    context.user_data['expecting_campaign_choice'] = True
-    
-    conn.close()
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
@@ -375,63 +3572,24 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get('expecting_campaign_choice'):
         if text in ['1', '2', '3']:
             # Пользователь выбрал предварительно созданную кампанию
-            campaign_options = context.user_data.get('campaign_options', '')
-            
-            # Разобрать ответ LLM для извлечения деталей кампании
-            # Это упрощенный анализ, вы можете улучшить его для более надежного извлечения данных
-            lines = campaign_options.split('\n')
-            choice_idx = int(text)
-            
-            # Найти выбранную кампанию в тексте
-            campaign_name = "Новая кампания"
-            campaign_type = "Приключение"
-            setting_desc = "Фэнтезийный мир"
-            current_location = "Таверна"
-            current_quest = "Начало приключения"
-            
-            try:
-                # Поиск деталей выбранной кампании
-                # Этот код предполагает определенный формат ответа LLM
-                option_found = False
-                for i, line in enumerate(lines):
-                    if f"Вариант {choice_idx}:" in line or f"{choice_idx}." in line:
-                        option_found = True
-                        # Извлечь имя кампании из текущей строки
-                        parts = line.split(":", 1)
-                        if len(parts) > 1:
-                            campaign_name = parts[1].strip()
-                        
-                        # Проверить следующие строки для других деталей
-                        for j in range(i+1, min(i+10, len(lines))):
-                            if "Тип:" in lines[j]:
-                                campaign_type = lines[j].split(":", 1)[1].strip()
-                            elif "Сеттинг:" in lines[j] or "Описание:" in lines[j]:
-                                setting_desc = lines[j].split(":", 1)[1].strip()
-                            elif "Локация:" in lines[j]:
-                                current_location = lines[j].split(":", 1)[1].strip()
-                            elif "Квест:" in lines[j]:
-                                current_quest = lines[j].split(":", 1)[1].strip()
-                            
-                            # Переход к следующей опции или концу текста
-                            if j+1 < len(lines) and ("Вариант" in lines[j+1] or "---" in lines[j+1]):
-                                break
-                        
-                        break
-            except Exception as e:
-                logger.error(f"Ошибка при разборе ответа LLM: {e}")
+            choice_idx = int(text) - 1
+            campaign = context.user_data.get('campaign_options', [])[choice_idx]
+            intro_task = intro_speculation.take(chat_id, user_id, choice_idx)
+            campaign_name = campaign['name']
+            campaign_type = campaign['type']
+            setting_desc = campaign['setting']
+            current_location = campaign['location']
+            current_quest = campaign['quest']
             
             # Создать новую игровую сессию
-            conn = sqlite3.connect('dnd_bot.db')
-            cursor = conn.cursor()
-            
-            cursor.execute("""
+            session_id = await db.execute("""
             INSERT INTO game_sessions (chat_id, campaign_name, campaign_type, setting_description, current_location, current_quest)
             VALUES (?, ?, ?, ?, ?, ?)
             """, (chat_id, campaign_name, campaign_type, setting_desc, current_location, current_quest))
-            
-            session_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            session_cache.put(session_id, SessionContext(
+                format_campaign_block(campaign_name, campaign_type, setting_desc, current_location, current_quest),
+                format_characters_block([]),
+            ))
             
             # Очистить флаг ожидания
             context.user_data.pop('expecting_campaign_choice', None)
@@ -448,40 +3606,30 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Когда все будут готовы, МП начнет приключение!"
             )
             
-            # Получить вступительное слово от Мастера Подземелий
-            intro_prompt = f"""
-            Ты Мастер Подземелий для новой кампании D&D.
-            
-            Кампания: {campaign_name}
-            Тип: {campaign_type}
-            Сеттинг: {setting_desc}
-            Начальная локация: {current_location}
-            Начальный квест: {current_quest}
-            
-            Напиши захватывающее вступление к этой кампании, устанавливающее сцену и атмосферу. Не более 5-6 предложений.
-            Обращайся к игрокам, приглашая их в этот мир. Не указывай им, что делать, а просто представь ситуацию.
-            """
-            
-            intro_text = ask_llm(intro_prompt, DM_SYSTEM_PROMPT)
+            # Вступление обычно уже сгенерировано, пока игрок выбирал
+            intro_text, speech_clip = None, None
+            if intro_task is not None:
+                try:
+                    intro_text, speech_clip = await intro_task
+                except Exception as e:
+                    logger.warning(f"Упреждающее вступление не готово: {e}")
+            if intro_text is None:
+                try:
+                    intro_text = await llm_scheduler.run(chat_id, PRIORITY_TURN, ask_llm, build_intro_prompt(campaign), DM_SYSTEM_PROMPT)
+                except SchedulerBusy:
+                    await reply_busy(update)
+                    return
             
             # Сохранить вступление в историю
-            conn = sqlite3.connect('dnd_bot.db')
-            cursor = conn.cursor()
-            cursor.execute("""
-            INSERT INTO conversation_history (session_id, sender, content)
-            VALUES (?, ?, ?)
-            """, (session_id, "МП", intro_text))
-            conn.commit()
-            conn.close()
-            
-            # Сгенерировать и отправить аудио
-            speech_file = generate_speech(intro_text)
-            if speech_file:
-                with open(speech_file, 'rb') as audio:
-                    await update.message.reply_voice(voice=audio, caption="🎭 Мастер Подземелий начинает историю...")
-                os.remove(speech_file)  # Удалить временный файл
+            history_writer.append(session_id, [("МП", intro_text)])
+            session_cache.append_history(session_id, [("МП", intro_text)])
             
+            # Синтез аудио (если его нет заранее) идет в пуле процессов, пока отправляется текст
+            speech_task = None if speech_clip else asyncio.create_task(generate_speech(intro_text, chat_id))
             await update.message.reply_text(intro_text)
+            if speech_task:
+                speech_clip = await speech_task
+            await send_voice_file(update, speech_clip, caption="🎭 Мастер Подземелий начинает историю...")
             
             return
         else:
@@ -493,11 +3641,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session_id = context.chat_data.get('active_session_id')
     if session_id:
         # Проверить, есть ли у пользователя персонаж
-        conn = sqlite3.connect('dnd_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM characters WHERE session_id = ? AND player_id = ?", (session_id, user_id))
-        character = cursor.fetchone()
-        conn.close()
+        character = await db.fetchone(SQL_PLAYER_CHARACTER, (session_id, user_id))
         
         if not character:
             await update.message.reply_text(
@@ -505,25 +3649,15 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        # Обработать игровое взаимодействие
-        character_name = character[0]
-        dm_response = generate_dm_response(text, session_id, f"{character_name} ({user_name})")
-        
-        # Сгенерировать и отправить аудио, если включено
-        if context.chat_data.get('voice_enabled', True):
-            speech_file = generate_speech(dm_response)
-            if speech_file:
-                with open(speech_file, 'rb') as audio:
-                    await update.message.reply_voice(voice=audio)
-                os.remove(speech_file)  # Удалить временный файл
+        # При перегрузке сразу отказать, не ставя действие в очередь
+        if llm_scheduler.overloaded(chat_id):
+            await reply_busy(update)
+            return
         
-        # Разделить ответ на части, если он слишком длинный
-        if len(dm_response) > 4000:
-            parts = [dm_response[i:i+4000] for i in range(0, len(dm_response), 4000)]
-            for part in parts:
-                await update.message.reply_text(part)
-        else:
-            await update.message.reply_text(dm_response)
+        # Действие попадет в ближайший раунд чата вместе с действиями других игроков
+        character_name = character[0]
+        if not turn_coalescer.submit(chat_id, PlayerAction(update, context.chat_data, session_id, f"{character_name} ({user_name})", text)):
+            await reply_busy(update)
     else:
         # Если нет активной сессии
         await update.message.reply_text(
@@ -543,64 +3677,82 @@ async def create_character(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Проверить, есть ли уже персонаж
-    conn = sqlite3.connect('dnd_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM characters WHERE session_id = ? AND player_id = ?", (session_id, user_id))
-    existing_character = cursor.fetchone()
-    conn.close()
+    existing_character = await db.fetchone(SQL_PLAYER_CHARACTER, (session_id, user_id))
     
     if existing_character:
         await update.message.reply_text(f"У вас уже есть персонаж {existing_character[0]} в этой кампании! Используйте /show_character, чтобы увидеть его.")
         return
     
-    # Запросить у LLM предложения персонажей
-    character_prompt = """
-    Создай три варианта персонажей D&D 5e уровня 1 на выбор. Для каждого варианта предоставь:
-    1. Имя
-    2. Раса
-    3. Класс
-    4. Краткая предыстория (1-2 предложения)
-    5. Ключевые характеристики (СИЛ, ЛОВ, ВЫН, ИНТ, МДР, ХАР)
-    6. ХП и КД
-    
-    Формат ответа должен быть кратким и чётким, с ясным разделением между тремя вариантами.
-    """
-    
-    character_options = ask_llm(character_prompt, "Ты помощник по созданию персонажей D&D.")
+    # Взять готовые варианты персонажей из запаса или сгенерировать их
+    try:
+        character_options = await option_pool.get("character", chat_id, key=f"character_options:{user_id}")
+    except SchedulerBusy:
+        await reply_busy(update)
+        return
+    except JobSuperseded:
+        return
     
     # Сохранить варианты в контексте для дальнейшего использования
     context.user_data['character_options'] = character_options
     
+    # Установить следующий шаг обработки до ответа: игрок может выбрать сразу
+    context.user_data['expecting_character_choice'] = True
+    
     await update.message.reply_text(
         f"🧙‍♂️ {user_name}, давайте создадим вашего персонажа! 🧙‍♂️\n\n"
         "Вот несколько вариантов персонажей. Выберите один, написав его номер (1, 2 или 3):\n\n"
         f"{character_options}\n\n"
         "Или напишите /custom_char, чтобы создать своего собственного персонажа."
     )
-    
-    # Установить следующий шаг обработки
-    context.user_data['expecting_character_choice'] = True
+
+_ROLL_ARGS = re.compile(r'^(?:(\d+)\s*[xх]\s*)?(.+?)(?:\s+(?:dc|кс)\s*(-?\d+))?$', re.IGNORECASE)
+
+def format_roll(expr, times=1, dc=None):
+    """Бросить выражение (возможно, несколько раз) и описать результат со статистикой
+
+    Тяжелые выражения ограничены заранее, но расчет все равно может занять
+    десятки миллисекунд, поэтому обработчик вызывает функцию в потоке.
+    """
+    expression = compile_dice(expr)
+    if times * expression.dice_count() > MAX_ROLL_WORK:
+        raise ValueError(f"Слишком большой бросок: больше {MAX_ROLL_WORK} кубиков за раз")
+    if times == 1:
+        total, shown = expression.roll()
+        lines = [f"{expression.text} → {shown} = {total}" if shown != str(total) else f"{expression.text} → {total}"]
+    else:
+        totals = expression.roll_many(times)
+        if times <= MAX_SHOWN_DICE:
+            lines = [f"{times}×{expression.text} → " + ", ".join(str(t) for t in totals.tolist())]
+        else:
+            lines = [f"{times}×{expression.text} → мин {totals.min()}, среднее {totals.mean():.1f}, макс {totals.max()}"]
+    if expression.support_size() > MAX_DISTRIBUTION_SIZE:
+        return "\n".join(lines)
+    stats = expression.stats(dc)
+    approx = "" if stats["exact"] else "≈"
+    lines.append(f"Среднее {approx}{stats['mean']:.1f}, медиана {stats['p50']}, 10–90%: {stats['p10']}–{stats['p90']}")
+    if dc is not None:
+        lines.append(f"Шанс выбросить {dc} и больше: {approx}{stats['chance'] * 100:.1f}%")
+    return "\n".join(lines)
 
 async def roll_dice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды для броска кубиков"""
     if not context.args:
-        await update.message.reply_text("Укажите формат броска, например /roll 2d6+3")
+        await update.message.reply_text("Укажите формат броска, например /roll 2d6+3, /roll 2d20kh1+5 dc 15 или /roll 6x4d6dl1")
         return
     
-    dice_expr = context.args[0]
-    
-    # Проверить правильность формата выражения
-    if not re.match(r'^[1-9]\d*d[1-9]\d*(?:[+-][1-9]\d*)?$', dice_expr):
-        await update.message.reply_text("Неверный формат! Используйте формат вида 2d6+3")
+    match = _ROLL_ARGS.match(" ".join(context.args))
+    times = int(match.group(1)) if match.group(1) else 1
+    dc = int(match.group(3)) if match.group(3) else None
+    try:
+        if not 1 <= times <= MAX_REPEAT:
+            raise ValueError(f"Можно повторить бросок от 1 до {MAX_REPEAT} раз")
+        with stage("dice"):
+            roll_result = await asyncio.to_thread(format_roll, match.group(2), times, dc)
+    except ValueError as e:
+        await update.message.reply_text(f"Неверный формат! {e}. Используйте формат вида 2d6+3, 2d20kh1 или 4d6dl1")
         return
     
-    # Использовать функцию process_dice_rolls
-    roll_result = process_dice_rolls("{" + dice_expr + "}")
-    
-    # Удалить фигурные скобки для чистоты ответа
-    roll_result = roll_result.strip("{}")
-    
-    await update.message.reply_text(f"🎲 {update.effective_user.first_name} бросает {dice_expr}:\n{roll_result}")
+    await update.message.reply_text(f"🎲 {update.effective_user.first_name} бросает {match.group(2)}:\n{roll_result}")
 
 async def speak_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Включить/выключить голосовые ответы МП"""
@@ -611,30 +3763,421 @@ async def speak_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status = "включено" if voice_enabled else "выключено"
     await update.message.reply_text(f"🔊 Голосовое повествование {status}.")
 
+# Режим вебхука: фронт принимает обновления Telegram и раздает их рабочим процессам
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публичный адрес вебхука; без него — polling
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_LIMIT = int(os.environ.get("WEBHOOK_QUEUE_LIMIT", "1000"))  # на рабочий процесс
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "10"))
+WEBHOOK_MAX_BODY = int(os.environ.get("WEBHOOK_MAX_BODY", str(1024 * 1024)))  # байт в одном обновлении
+WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", "8600"))  # процесс i слушает 127.0.0.1:WORKER_BASE_PORT+i
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", "1"))
+WORKER_STOP_TIMEOUT = float(os.environ.get("WORKER_STOP_TIMEOUT", "30"))
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org/bot")
+
+# Виды обновлений, у которых есть чат
+_CHAT_UPDATE_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post", "business_message",
+                     "my_chat_member", "chat_member", "chat_join_request", "message_reaction")
+
+def update_chat_id(data):
+    """chat_id обновления Telegram в виде JSON; для обновлений без чата — id пользователя"""
+    for key in _CHAT_UPDATE_KEYS:
+        if key in data:
+            return data[key]["chat"]["id"]
+    for value in data.values():
+        if isinstance(value, dict):
+            message = value.get("message")
+            if isinstance(message, dict) and "chat" in message:
+                return message["chat"]["id"]
+            if "from" in value:
+                return value["from"]["id"]
+    return 0
+
+def worker_for_chat(chat_id, workers=WORKERS):
+    """Номер рабочего процесса чата; остаток от деления не меняется между перезапусками"""
+    return chat_id % workers
+
+class HTTPRequestError(Exception):
+    """Запрос отклонен до чтения тела; status — строка статуса ответа"""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+async def _read_http_request(reader, max_body, secret=""):
+    """Прочитать HTTP/1.1-запрос: (метод, путь, заголовки, тело) или None, если соединение закрыто
+
+    Секрет и Content-Length проверяются до чтения тела, поэтому чужой
+    клиент не может заставить процесс держать в памяти большое тело.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPRequestError("431 Request Header Fields Too Large")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HTTPRequestError("400 Bad Request")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    if secret and not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1"),
+                                          secret.encode("latin-1")):
+        raise HTTPRequestError("403 Forbidden")
+    length = headers.get("content-length", "0")
+    if not (length.isascii() and length.isdigit()):
+        raise HTTPRequestError("400 Bad Request")
+    if int(length) > max_body:
+        raise HTTPRequestError("413 Payload Too Large")
+    body = await reader.readexactly(int(length))
+    return method, path, headers, body
+
+def _http_response(status, body=b""):
+    return (f"HTTP/1.1 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+def _stop_event():
+    """Событие, которое устанавливается по SIGTERM или SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    return stop
+
+class WebhookFront:
+    """Прием вебхука Telegram и раздача обновлений рабочим процессам по chat_id
+
+    Фронт не выполняет обработчики: он разбирает JSON обновления, выбирает
+    рабочий процесс по chat_id и сразу отвечает Telegram. Все обновления
+    одного чата попадают в один процесс и пересылаются ему пакетами по
+    порядку, поэтому очередность и кэши чата остаются в одном процессе, а
+    разные чаты обрабатываются на разных ядрах. Общее состояние процессы
+    хранят в базе. Пока процесс недоступен, пакет пересылается повторно, а
+    упавший процесс перезапускается; при переполнении очереди Telegram
+    получает 503 и повторит доставку сам.
+    """
+
+    def __init__(self, token, url=WEBHOOK_URL, workers=WORKERS, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                 secret=WEBHOOK_SECRET, base_port=WORKER_BASE_PORT, queue_limit=WEBHOOK_QUEUE_LIMIT):
+        self.token = token
+        self.url = url
+        self.path = urlsplit(url).path or "/"
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.base_port = base_port
+        self.queue_limit = queue_limit
+        self.queues = []
+        self._processes = {}
+        self._tasks = []
+        self._connections = set()
+        self._server = None
+        self._client = None
+        self._stopping = False
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=LLM_TIMEOUT)
+        self.queues = [asyncio.Queue() for _ in range(self.workers)]
+        for index in range(self.workers):
+            await self._spawn(index)
+            self._tasks.append(asyncio.create_task(self._supervise(index)))
+            self._tasks.append(asyncio.create_task(self._forward(index)))
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        params = {"url": self.url}
+        if self.secret:
+            params["secret_token"] = self.secret
+        response = await self._client.post(f"{TELEGRAM_API_BASE}{self.token}/setWebhook", data=params)
+        response.raise_for_status()
+        logger.info(f"Вебхук {self.url} принимается на {self.host}:{self.port}, рабочих процессов: {self.workers}")
+
+    def _worker_env(self, index):
+        env = dict(os.environ, WORKER_INDEX=str(index), WORKERS=str(self.workers))
+        if METRICS_PORT:
+            env["METRICS_PORT"] = str(METRICS_PORT + 1 + index)
+        if SESSION_TRACE_PATH:
+            # Чаты процессов не пересекаются, поэтому каждая запись воспроизводится отдельно
+            directory, name = os.path.split(SESSION_TRACE_PATH)
+            base, dot, extension = name.partition(".")
+            env["SESSION_TRACE_PATH"] = os.path.join(directory, f"{base}.w{index}{dot}{extension}")
+        # У каждого процесса свой индекс LRU, поэтому и свой каталог кэша озвучки с долей общего объема:
+        # иначе процессы вытесняли бы файлы друг друга, а вместе занимали бы WORKERS × TTS_CACHE_MAX_BYTES
+        env["TTS_CACHE_DIR"] = os.path.join(TTS_CACHE_DIR, str(index))
+        env["TTS_CACHE_MAX_BYTES"] = str(TTS_CACHE_MAX_BYTES // self.workers)
+        return env
+
+    async def _spawn(self, index):
+        self._processes[index] = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "worker", env=self._worker_env(index))
+
+    async def _supervise(self, index):
+        """Перезапускать рабочий процесс, если он завершился не по команде фронта"""
+        while True:
+            code = await self._processes[index].wait()
+            if self._stopping:
+                return
+            logger.error(f"Рабочий процесс {index} завершился с кодом {code}, перезапуск")
+            metrics.inc("bot_webhook_worker_restarts_total", worker=str(index))
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            if self._stopping:
+                return
+            await self._spawn(index)
+
+    async def _handle(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await _read_http_request(reader, WEBHOOK_MAX_BODY, self.secret)
+                except HTTPRequestError as e:
+                    # Тело не прочитано, поэтому соединение дальше не используется
+                    writer.write(_http_response(e.status))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                writer.write(self._accept(*request))
+                await writer.drain()
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _accept(self, method, path, headers, body):
+        """Поставить обновление в очередь его рабочего процесса; вернуть HTTP-ответ"""
+        if method != "POST" or path.split("?")[0] != self.path:
+            return _http_response("404 Not Found")
+        try:
+            index = worker_for_chat(update_chat_id(json.loads(body)), self.workers)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return _http_response("400 Bad Request")
+        queue = self.queues[index]
+        if queue.qsize() >= self.queue_limit:
+            metrics.inc("bot_webhook_rejected_total", worker=str(index))
+            return _http_response("503 Service Unavailable")
+        queue.put_nowait(body)
+        metrics.inc("bot_webhook_updates_total", worker=str(index))
+        metrics.set("bot_webhook_queue_depth", queue.qsize(), worker=str(index))
+        return _http_response("200 OK")
+
+    async def _forward(self, index):
+        """Пересылать обновления рабочему процессу пакетами, сохраняя порядок"""
+        queue, url = self.queues[index], f"http://127.0.0.1:{self.base_port + index}/updates"
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty() and len(batch) < WEBHOOK_BATCH_SIZE:
+                batch.append(queue.get_nowait())
+            metrics.set("bot_webhook_queue_depth", queue.qsize(), worker=str(index))
+            payload = b"[" + b",".join(batch) + b"]"
+            delay = 0.05
+            while True:
+                try:
+                    response = await self._client.post(url, content=payload, headers={"Content-Type": "application/json"})
+                    response.raise_for_status()
+                    break
+                except httpx.HTTPError as e:
+                    # Процесс запускается или перезапускается: пакет остается у фронта
+                    if delay >= 2.0:
+                        logger.warning(f"Рабочий процесс {index} недоступен: {e!r}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 2.0)
+            for _ in batch:
+                queue.task_done()
+
+    async def stop(self):
+        """Перестать принимать обновления, доставить очереди и остановить рабочие процессы"""
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Не все обновления доставлены рабочим процессам до остановки")
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        for index, process in self._processes.items():
+            try:
+                await asyncio.wait_for(process.wait(), WORKER_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Рабочий процесс {index} не остановился за {WORKER_STOP_TIMEOUT:.0f} с")
+                process.kill()
+                await process.wait()
+        if self._client is not None:
+            await self._client.aclose()
+
+async def run_webhook_front(token):
+    """Фронт режима вебхука: работает до SIGTERM или SIGINT"""
+    stop = _stop_event()
+    front = WebhookFront(token)
+    await metrics_server.start()
+    try:
+        await front.start()
+        await stop.wait()
+    finally:
+        await front.stop()
+        await metrics_server.stop()
+
+async def run_worker(application):
+    """Рабочий процесс: обрабатывать пакеты обновлений от фронта обычными обработчиками"""
+    stop = _stop_event()
+    port = WORKER_BASE_PORT + int(WORKER_INDEX or 0)
+    connections = set()
+
+    async def handle(reader, writer):
+        connections.add(writer)
+        try:
+            while True:
+                # Пакет от фронта: до WEBHOOK_BATCH_SIZE обновлений, каждое не больше WEBHOOK_MAX_BODY
+                request = await _read_http_request(reader, WEBHOOK_MAX_BODY * WEBHOOK_BATCH_SIZE)
+                if request is None:
+                    break
+                method, path, _, body = request
+                if method == "POST" and path == "/updates":
+                    for data in json.loads(body):
+                        try:
+                            update = Update.de_json(data, application.bot)
+                        except Exception as e:
+                            # Иначе фронт пересылал бы этот пакет бесконечно
+                            logger.error(f"Некорректное обновление {data.get('update_id')}: {e}")
+                            continue
+                        await application.update_queue.put(update)
+                    writer.write(_http_response("200 OK"))
+                else:
+                    writer.write(_http_response("404 Not Found"))
+                await writer.drain()
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError, HTTPRequestError):
+            pass
+        finally:
+            connections.discard(writer)
+            writer.close()
+
+    async with application:
+        # post_init и post_shutdown вызываются только в run_polling/run_webhook
+        await on_startup(application)
+        await application.start()
+        server = await asyncio.start_server(handle, "127.0.0.1", port)
+        logger.info(f"Рабочий процесс {WORKER_INDEX} принимает обновления на 127.0.0.1:{port}")
+        await stop.wait()
+        server.close()
+        for writer in list(connections):
+            writer.close()
+        await server.wait_closed()
+        await application.stop()
+    await on_shutdown(application)
+
+async def on_startup(application: Application):
+    """Запустить фоновые задачи"""
+    campaign_memory.start()
+    # Общие для всей базы задачи выполняет только один рабочий процесс
+    if WORKER_INDEX in (None, "0"):
+        option_pool.start()
+        history_archiver.start()
+    chat_state.start()
+    user_state.start()
+    await metrics_server.start()
+    session_recorder.start()
+
+async def on_shutdown(application: Application):
+    """Освободить ресурсы при остановке бота"""
+    # Сначала доиграть начатые раунды: они еще пишут историю и состояние
+    await turn_coalescer.close()
+    await campaign_memory.stop()
+    await option_pool.stop()
+    await history_archiver.stop()
+    # История сохраняется после всех, кто ее пишет, и до закрытия базы
+    await history_writer.stop()
+    await chat_state.stop()
+    await user_state.stop()
+    await metrics_server.stop()
+    session_recorder.stop()
+    await llm_client.aclose()
+    shutdown_tts_pool()
+    db.close()
+
 def main():
     """Основная функция для запуска бота"""
     # Настройка базы данных при старте
     setup_database()
     
+    # "python bot.py check-db" — только проверить планы запросов и выйти
+    if sys.argv[1:] == ["check-db"]:
+        problems = db.run_sync(check_query_plans)
+        db.close()
+        if problems:
+            print("Запросы без нужного индекса:\n" + "\n".join(problems), file=sys.stderr)
+            sys.exit(1)
+        print("Все частые запросы используют индексы")
+        return
+    
+    # Обслуживание базы без запуска бота
+    if sys.argv[1:] == ["maintain-db"]:
+        report = asyncio.run(history_archiver.maintain())
+        db.close()
+        print(f"Архивировано сессий: {report['sessions']}, сообщений: {report['messages']}, "
+              f"архив {report['archive_bytes'] // 1024} КБ, освобождено {report['reclaimed_bytes'] // 1024} КБ")
+        return
+    if sys.argv[1:] == ["compact-db"]:
+        before, after = db.run_sync(compact_database)
+        db.close()
+        print(f"Размер базы: {before // 1024} КБ → {after // 1024} КБ, incremental auto_vacuum включен")
+        return
+    if sys.argv[1:2] == ["restore-session"] and len(sys.argv) == 3:
+        restored = asyncio.run(history_archiver.restore(int(sys.argv[2])))
+        db.close()
+        print(f"Восстановлено сообщений: {restored}")
+        return
+    
     # Получить токен бота
     token = os.environ.get("TELEGRAM_BOT_TOKEN", "your_token_here")
     
-    # Создать приложение
-    application = Application.builder().token(token).build()
+    # Режим вебхука: этот процесс только принимает и раздает обновления
+    if WEBHOOK_URL and WORKER_INDEX is None:
+        db.close()
+        asyncio.run(run_webhook_front(token))
+        return
+    
+    # Создать приложение; обновления разных чатов обрабатываются параллельно, одного — по очереди
+    application = (
+        Application.builder()
+        .token(token)
+        .base_url(TELEGRAM_API_BASE)
+        .concurrent_updates(ChatUpdateProcessor())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Добавить обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("new_game", new_game))
-    application.add_handler(CommandHandler("create_character", create_character))
-    application.add_handler(CommandHandler("roll", roll_dice_command))
-    application.add_handler(CommandHandler("speak", speak_toggle))
+    application.add_handler(CommandHandler("start", traced(with_state(start))))
+    application.add_handler(CommandHandler("help", traced(with_state(help_command))))
+    application.add_handler(CommandHandler("new_game", traced(with_state(new_game))))
+    application.add_handler(CommandHandler("create_character", traced(with_state(create_character))))
+    application.add_handler(CommandHandler("roll", traced(with_state(roll_dice_command))))
+    application.add_handler(CommandHandler("speak", traced(with_state(speak_toggle))))
     
     # Обработчик для текстовых сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, traced(with_state(handle_text))))
     
-    # Запустить бота
-    application.run_polling()
+    # Запустить бота: рабочий процесс режима вебхука или polling
+    if sys.argv[1:] == ["worker"]:
+        asyncio.run(run_worker(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
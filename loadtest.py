@@ -0,0 +1,464 @@
+"""Офлайн-нагрузочный тест бота.
+
+Гоняет настоящие обработчики bot.py (new_game, handle_text, create_character,
+roll_dice_command) на синтетических обновлениях Telegram. Вместо Together
+используется локальный HTTP-сервер с OpenAI-совместимым chat-completions
+(задержка, разброс, потоковая выдача), вместо TTS — заглушка.
+Моделируются N чатов × M игроков; в конце печатаются пропускная
+способность, p50/p95/p99 задержки хода, разбивка по этапам и задержка
+цикла событий.
+
+Запуск: python loadtest.py --chats 30 --players 4 --turns 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+FAKE_NARRATION = (
+    "Ветер воет в ущелье, и факелы отбрасывают дрожащие тени на стены. "
+    "Ты делаешь шаг вперед и бросаешь {1d20+3} на внимательность. "
+    "Из темноты выходит гоблин с ржавым копьем, он наносит {1d6+2} урона. "
+    "Трактирщик Гарет кричит вам вслед, что дорога к башне опасна. "
+    "Что вы будете делать дальше?"
+)
+
+FAKE_CAMPAIGNS = json.dumps({"campaigns": [
+    {"name": f"Кампания {i}", "type": "героика", "setting": "Северные королевства",
+     "location": "Таверна «Серый гусь»", "quest": "Найти пропавший караван"}
+    for i in range(1, 4)
+]}, ensure_ascii=False)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class FakeLLMServer:
+    """Локальный OpenAI-совместимый /chat/completions с настраиваемой задержкой"""
+
+    def __init__(self, latency, jitter, tokens_per_second, stall=0.0, fail=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.stall = stall  # доля запросов с десятикратной задержкой
+        self.fail = fail    # доля запросов с ответом 500
+        self.requests = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _reply_for(self, payload):
+        system_prompt, prompt = payload["messages"][0]["content"], payload["messages"][1]["content"]
+        if "campaigns" in prompt:
+            return FAKE_CAMPAIGNS
+        if "летописец" in system_prompt:
+            return "Герои прибыли в таверну и узнали о пропавшем караване."
+        if "персонаж" in system_prompt:
+            return "1. Торин, дварф-воин\n2. Лира, эльфийка-следопыт\n3. Мирт, человек-волшебник"
+        return FAKE_NARRATION
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                headers = {}
+                for line in head.decode("latin-1").split("\r\n")[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                payload = json.loads(await reader.readexactly(int(headers.get("content-length", 0))))
+                self.requests += 1
+                latency = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+                await asyncio.sleep(latency * 10 if random.random() < self.stall else latency)
+                text = self._reply_for(payload)
+                if random.random() < self.fail:
+                    writer.write(b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n")
+                    await writer.drain()
+                elif payload.get("stream"):
+                    await self._stream(writer, text)
+                else:
+                    body = json.dumps({"choices": [{"message": {"role": "assistant", "content": text}}]}).encode()
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                                 b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass  # клиент отменил запрос или сервер останавливается
+        finally:
+            writer.close()
+
+    async def _stream(self, writer, text):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == 0 else " " + word
+            event = "data: " + json.dumps({"choices": [{"delta": {"content": delta}}]}, ensure_ascii=False) + "\n\n"
+            self._chunk(writer, event.encode())
+            await writer.drain()
+            if self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+        self._chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def _chunk(writer, data):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+class Stages:
+    """Время по этапам обработки"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def add(self, name, seconds):
+        self.samples[name].append(seconds)
+
+    def wrap(self, name, fn):
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started)
+        return timed
+
+    def wrap_sync(self, name, fn):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started)
+        return timed
+
+    def wrap_stream(self, name, fn):
+        def timed(*args, **kwargs):
+            async def generator():
+                started = time.perf_counter()
+                first = True
+                async for chunk in fn(*args, **kwargs):
+                    if first:
+                        self.add(name + "_first_token", time.perf_counter() - started)
+                        first = False
+                    yield chunk
+                self.add(name, time.perf_counter() - started)
+            return generator()
+        return timed
+
+
+class FakeTelegram:
+    """Имитация Bot API: задержка вызовов и учет отправленного"""
+
+    def __init__(self, latency, stages):
+        self.latency = latency
+        self.stages = stages
+        self.calls = defaultdict(int)
+        self.uploaded_bytes = 0
+        self._message_ids = 0
+
+    async def call(self, method):
+        self.calls[method] += 1
+        started = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        self.stages.add("telegram_" + method, time.perf_counter() - started)
+
+    def next_message_id(self):
+        self._message_ids += 1
+        return self._message_ids
+
+
+class FakeUser:
+    def __init__(self, user_id, first_name):
+        self.id = user_id
+        self.first_name = first_name
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeVoice:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeMessage:
+    def __init__(self, telegram, chat, user, text=None):
+        self.telegram = telegram
+        self.chat = chat
+        self.from_user = user
+        self.text = text
+        self.message_id = telegram.next_message_id()
+        self.voice = None
+        self.first_reply_at = None
+
+    def _mark_reply(self):
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+
+    async def reply_text(self, text, **kwargs):
+        self._mark_reply()
+        await self.telegram.call("send_message")
+        return FakeMessage(self.telegram, self.chat, None, text)
+
+    async def edit_text(self, text, **kwargs):
+        await self.telegram.call("edit_message")
+        self.text = text
+        return self
+
+    async def reply_voice(self, voice, caption=None, **kwargs):
+        self._mark_reply()
+        if hasattr(voice, "read"):
+            self.telegram.uploaded_bytes += len(voice.read())
+        await self.telegram.call("send_voice")
+        reply = FakeMessage(self.telegram, self.chat, None)
+        reply.voice = FakeVoice(f"voice-{reply.message_id}")
+        return reply
+
+
+class FakeUpdate:
+    def __init__(self, telegram, chat, user, text):
+        self.update_id = telegram.next_message_id()
+        self.message = FakeMessage(telegram, chat, user, text)
+        self.effective_chat = chat
+        self.effective_user = user
+
+
+class FakeContext:
+    def __init__(self, user_data, chat_data, args=None):
+        self.user_data = user_data
+        self.chat_data = chat_data
+        self.args = args or []
+
+
+class LoadTest:
+    """Сценарий: N чатов × M игроков, каждый делает несколько ходов"""
+
+    def __init__(self, bot, options):
+        self.bot = bot
+        self.options = options
+        self.stages = Stages()
+        self.telegram = FakeTelegram(options.telegram_latency, self.stages)
+        self.user_data = defaultdict(dict)
+        self.chat_data = defaultdict(dict)
+        self.pending = {}
+        self.turn_latency = []
+        self.first_text_latency = []
+        self.rounds = 0
+        self.actions = 0
+        self.loop_lag = []
+
+    def install(self):
+        """Подменить TTS и обернуть этапы бота замерами времени"""
+        bot, stages = self.bot, self.stages
+
+        async def fake_render(clean_text, output_file):
+            await asyncio.sleep(self.options.tts_latency)
+            with open(output_file, "wb") as audio:
+                audio.write(b"\0" * (len(clean_text) * 40))
+            return len(clean_text) * 400, len(clean_text) * 40, 0.0
+
+        bot._render_speech = fake_render
+        bot.build_dm_prompt = stages.wrap("prompt_build", bot.build_dm_prompt)
+        bot.ask_llm = stages.wrap("llm", bot.ask_llm)
+        bot.stream_llm = stages.wrap_stream("llm_stream", bot.stream_llm)
+        bot.process_dice_rolls = stages.wrap_sync("dice", bot.process_dice_rolls)
+        bot.generate_speech = stages.wrap("tts", bot.generate_speech)
+        bot.db.fetchone = stages.wrap("db_read", bot.db.fetchone)
+        bot.db.fetchall = stages.wrap("db_read", bot.db.fetchall)
+        bot.db.transaction = stages.wrap("db_write", bot.db.transaction)
+
+        submit = bot.turn_coalescer.submit
+        play = stages.wrap("turn", bot.turn_coalescer.play)
+
+        def tracked_submit(chat_id, action):
+            action.submitted_at = time.perf_counter()
+            self.pending[id(action)] = asyncio.get_running_loop().create_future()
+            return submit(chat_id, action)
+
+        async def tracked_play(batch):
+            try:
+                await play(batch)
+            finally:
+                done = time.perf_counter()
+                self.rounds += 1
+                first_reply = batch[0].update.message.first_reply_at
+                for action in batch:
+                    self.actions += 1
+                    self.turn_latency.append(done - action.submitted_at)
+                    if first_reply is not None:
+                        self.first_text_latency.append(first_reply - action.submitted_at)
+                    future = self.pending.pop(id(action), None)
+                    if future and not future.done():
+                        future.set_result(None)
+
+        bot.turn_coalescer.submit = tracked_submit
+        bot.turn_coalescer.play = tracked_play
+        # Обработчики вызываются так же, как их регистрирует main()
+        self.handlers = {name: bot.traced(bot.with_state(getattr(bot, name)))
+                         for name in ("new_game", "handle_text", "create_character", "roll_dice_command")}
+
+    def update(self, chat_id, user_id, text):
+        chat = FakeChat(chat_id)
+        user = FakeUser(user_id, f"Игрок{user_id}")
+        args = text.split()[1:] if text.startswith("/") else []
+        return FakeUpdate(self.telegram, chat, user, text), FakeContext(self.user_data[user_id], self.chat_data[chat_id], args)
+
+    async def watch_loop(self, interval=0.01):
+        """Измерять задержку цикла событий (признак блокирующих вызовов)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(loop.time() - started - interval)
+
+    async def run_chat(self, chat_index):
+        bot, options = self.bot, self.options
+        chat_id = -1000 - chat_index
+        owner = chat_index * 100 + 1
+        chat_data = await bot.chat_state.get(chat_id)
+        chat_data['voice_enabled'] = options.voice
+        bot.chat_state.mark(chat_id, chat_data)
+
+        await self.handlers["new_game"](*self.update(chat_id, owner, "/new_game"))
+        await self.handlers["handle_text"](*self.update(chat_id, owner, "1"))
+        session_id = chat_data['active_session_id']
+
+        players = [owner + i for i in range(options.players)]
+        for player in players:
+            await self.handlers["create_character"](*self.update(chat_id, player, "/create_character"))
+            await bot.db.execute(
+                "INSERT INTO characters (session_id, player_id, player_name, name, race, class, hp, max_hp) "
+                "VALUES (?, ?, ?, ?, 'человек', 'воин', 12, 12)",
+                (session_id, player, f"Игрок{player}", f"Герой{player}"),
+            )
+        bot.session_cache.invalidate(session_id)
+
+        async def play(player):
+            for turn in range(options.turns):
+                await asyncio.sleep(random.uniform(0, options.think_time))
+                if random.random() < options.roll_share:
+                    await self.handlers["roll_dice_command"](*self.update(chat_id, player, "/roll 2d20kh1+5 dc 15"))
+                update, context = self.update(chat_id, player, f"Я осматриваю комнату и ищу ловушки ({turn})")
+                before = set(self.pending)
+                await self.handlers["handle_text"](update, context)
+                waiting = [self.pending[key] for key in set(self.pending) - before]
+                if waiting:
+                    await asyncio.wait_for(asyncio.gather(*waiting), options.timeout)
+
+        await asyncio.gather(*(play(player) for player in players))
+
+    def report(self, elapsed, servers):
+        print(f"\nЧатов: {self.options.chats}, игроков в чате: {self.options.players}, ходов на игрока: {self.options.turns}")
+        print(f"Время: {elapsed:.2f} с; действий: {self.actions}, раундов МП: {self.rounds}, "
+              f"запросов к LLM: {[server.requests for server in servers]}")
+        print(f"Пропускная способность: {self.actions / elapsed:.1f} действий/с, {self.rounds / elapsed:.1f} ходов МП/с")
+        for title, values in (("Задержка хода", self.turn_latency), ("До первого текста", self.first_text_latency)):
+            print(f"{title}: p50 {percentile(values, 50) * 1000:.0f} мс, p95 {percentile(values, 95) * 1000:.0f} мс, "
+                  f"p99 {percentile(values, 99) * 1000:.0f} мс")
+        print(f"Задержка цикла событий: p99 {percentile(self.loop_lag, 99) * 1000:.1f} мс, "
+              f"макс {max(self.loop_lag, default=0) * 1000:.1f} мс")
+        print(f"Telegram: {dict(self.telegram.calls)}, загружено {self.telegram.uploaded_bytes / 1024:.0f} КБ")
+        for name in ("bot_llm_hedges_total", "bot_llm_hedge_wins_total", "bot_llm_breaker_open"):
+            values = {dict(key).get("backend"): value for key, value in self.bot.metrics._values.get(name, {}).items()}
+            if values:
+                print(f"{name}: {values}")
+        print(f"\n{'Этап':<28}{'вызовов':>9}{'сумма, с':>11}{'среднее, мс':>13}{'p95, мс':>10}{'p99, мс':>10}")
+        for name, values in sorted(self.stages.samples.items()):
+            print(f"{name:<28}{len(values):>9}{sum(values):>11.2f}{sum(values) / len(values) * 1000:>13.2f}"
+                  f"{percentile(values, 95) * 1000:>10.2f}{percentile(values, 99) * 1000:>10.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=10, help="число одновременных чатов")
+    parser.add_argument("--players", type=int, default=3, help="игроков в чате")
+    parser.add_argument("--turns", type=int, default=5, help="ходов на игрока")
+    parser.add_argument("--think-time", type=float, default=2.0, help="макс. пауза игрока перед ходом, с")
+    parser.add_argument("--roll-share", type=float, default=0.2, help="доля ходов с /roll перед действием")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="задержка LLM до первого токена, с")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="разброс задержки LLM, с")
+    parser.add_argument("--llm-tps", type=float, default=200, help="скорость потоковой выдачи, токенов/с (0 — мгновенно)")
+    parser.add_argument("--no-stream", action="store_true", help="отключить потоковые ответы")
+    parser.add_argument("--llm-servers", type=int, default=1, help="число имитаций бэкендов LLM (маршрутизатор)")
+    parser.add_argument("--llm-stall", type=float, default=0.0, help="доля зависаний (×10 задержки) первого бэкенда")
+    parser.add_argument("--llm-fail", type=float, default=0.0, help="доля ошибок 500 первого бэкенда")
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="время синтеза одного фрагмента, с")
+    parser.add_argument("--no-voice", dest="voice", action="store_false", help="отключить озвучку")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="задержка вызова Bot API, с")
+    parser.add_argument("--turn-window", type=float, default=0.5, help="окно сбора действий в раунд, с")
+    parser.add_argument("--timeout", type=float, default=120, help="предельное ожидание хода, с")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--record", help="записать прогон для replay.py (как SESSION_TRACE_PATH)")
+    parser.add_argument("--verbose", action="store_true", help="показывать журнал бота")
+    return parser.parse_args(argv)
+
+
+async def main_async(options):
+    random.seed(options.seed)
+    servers = [FakeLLMServer(options.llm_latency, options.llm_jitter, options.llm_tps,
+                             options.llm_stall if i == 0 else 0.0, options.llm_fail if i == 0 else 0.0)
+               for i in range(options.llm_servers)]
+    for server in servers:
+        await server.start()
+    workdir = tempfile.mkdtemp(prefix="dnd_loadtest_")
+    # Настройки бота читаются при импорте, поэтому окружение задается заранее
+    os.environ.update({
+        "DB_PATH": os.path.join(workdir, "dnd_bot.db"),
+        "TTS_CACHE_DIR": os.path.join(workdir, "tts_cache"),
+        "LLM_BACKENDS": json.dumps([{"name": f"fake{i + 1}", "api_base": f"http://127.0.0.1:{server.port}", "api_key": "-"}
+                                    for i, server in enumerate(servers)]),
+        "LLM_STREAMING": "0" if options.no_stream else "1",
+        "TURN_WINDOW": str(options.turn_window),
+        "OPTION_STOCK_SIZE": "0",
+        "STREAM_EDIT_INTERVAL": "0.5",
+    })
+    if options.record:
+        os.environ["SESSION_TRACE_PATH"] = options.record
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    bot.setup_database()
+    bot.session_recorder.start()
+    test = LoadTest(bot, options)
+    test.install()
+    watcher = asyncio.create_task(test.watch_loop())
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(test.run_chat(i) for i in range(options.chats)))
+    finally:
+        elapsed = time.perf_counter() - started
+        watcher.cancel()
+        test.report(elapsed, servers)
+        await bot.on_shutdown(None)
+        for server in servers:
+            await server.stop()
+
+
+def main(argv=None):
+    asyncio.run(main_async(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
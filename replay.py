@@ -0,0 +1,340 @@
+"""Детерминированное воспроизведение записанных игровых сессий.
+
+Запись включается у работающего бота переменной SESSION_TRACE_PATH.
+Воспроизведение прогоняет записанные обновления через текущие обработчики
+bot.py: ответы LLM берутся из записи по номеру запроса в чате, раунды
+собираются из тех же обновлений, что и при записи, кубики каждого чата
+бросаются из своего потока с записанным зерном, Telegram и TTS заменены
+имитациями из loadtest.py. Обновления одного чата обрабатываются по
+очереди, как в боте. Паузы между обновлениями и задержки LLM сжимаются в
+--speed раз, поэтому накладные расходы (БД, сборка промпта,
+диспетчеризация) разных версий бота сравниваются на реальной форме
+нагрузки.
+
+Запуск: python replay.py session.jsonl.gz --speed 50 [--save run.json] [--baseline prev.json]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from loadtest import FakeChat, FakeContext, FakeTelegram, FakeUpdate, FakeUser, Stages, percentile
+
+# Этапы, не зависящие от внешних сервисов: их и сравниваем между версиями
+OVERHEAD_STAGES = ("db_read", "db_write", "recall", "context", "dice")
+# Сколько ждать недостающие обновления записанного раунда, с
+BATCH_WAIT = 5.0
+
+
+def read_events(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+class RecordedLLM:
+    """Ответы LLM из записи, сопоставленные по чату и номеру запроса в нем
+
+    Запросы нумеруются так же, как при записи: по порядку начала в чате.
+    Запросы, отмененные или завершившиеся ошибкой при записи, повторяют
+    свою задержку и ошибку. Если номера нет в записи или системный промпт
+    другой (воспроизведение разошлось с записью), берется очередной ответ
+    на тот же системный промпт, а счетчик missing растет.
+    """
+
+    def __init__(self, bot, events, speed):
+        self.bot = bot
+        self.speed = speed
+        self.by_seq = {}
+        self.responses = defaultdict(deque)
+        self.last_by_system = {}
+        self.calls = defaultdict(int)
+        self.missing = 0
+        for event in events:
+            if event["type"] != "llm":
+                continue
+            if "seq" in event:
+                self.by_seq[(event["chat_id"], event["seq"])] = event
+            if "text" in event:
+                reply = ("ok", event["text"], event["latency"])
+                self.responses[(event["chat_id"], event["system"])].append(reply)
+                self.last_by_system[event["system"]] = reply
+
+    def take(self, system_prompt):
+        key = self.bot.prompt_key(system_prompt)
+        trace = self.bot.current_trace.get()
+        chat_id = trace.fields.get("chat_id") if trace else None
+        seq = self.calls[chat_id]
+        self.calls[chat_id] += 1
+        recorded = self.by_seq.get((chat_id, seq))
+        if recorded is not None and recorded["system"] == key:
+            if "text" in recorded:
+                return "ok", recorded["text"], recorded["latency"]
+            # Отмененный при записи запрос обычно отменяется и здесь; иначе — последний подходящий ответ
+            fallback = self.last_by_system.get(key, ("ok", "Мастер Подземелий молча кивает.", 0.0))
+            return recorded["status"], fallback[1], recorded["latency"]
+        # Фоновые запросы (запас вариантов) в записи не привязаны к чату
+        self.missing += 1
+        for candidate in ((chat_id, key), (None, key)):
+            if self.responses[candidate]:
+                return self.responses[candidate].popleft()
+        return self.last_by_system.get(key, ("ok", "Мастер Подземелий молча кивает.", 0.0))
+
+    async def reply(self, system_prompt):
+        status, text, latency = self.take(system_prompt)
+        with self.bot.stage("llm"):
+            await asyncio.sleep(latency / self.speed)
+        if status == "error":
+            raise RuntimeError("Ошибка LLM, записанная в сессии")
+        return text
+
+    async def complete(self, prompt, system_prompt, temperature=1.1, timeout=None, tier=None):
+        return await self.reply(system_prompt)
+
+    async def stream(self, prompt, system_prompt, temperature=1.1, timeout=None, tier=None):
+        text = await self.reply(system_prompt)
+        for word in re.findall(r"\S+\s*", text):
+            yield word
+
+
+def summarize(traces):
+    """Свести трассировки: длительность по видам и средние этапы хода"""
+    by_kind = defaultdict(list)
+    stages = defaultdict(float)
+    turns = 0
+    for trace in traces:
+        by_kind[trace["kind"]].append(trace["duration"])
+        if trace["kind"] == "turn":
+            turns += 1
+            for name, seconds in trace["stages"].items():
+                stages[name] += seconds
+    return {
+        "kinds": {kind: {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95)}
+                  for kind, values in by_kind.items()},
+        "turn_stages": {name: total / turns for name, total in stages.items()} if turns else {},
+        "turn_overhead": sum(stages[name] for name in OVERHEAD_STAGES) / turns if turns else 0.0,
+    }
+
+
+class Replay:
+    def __init__(self, bot, events, options):
+        self.bot = bot
+        self.events = events
+        self.options = options
+        self.telegram = FakeTelegram(options.telegram_latency, Stages())
+        self.characters = set()
+        self.traces = []
+        self.tasks = []
+        self.batches = defaultdict(deque)
+        for event in events:
+            if event["type"] == "batch":
+                self.batches[event["chat_id"]].append(set(event["updates"]))
+        self.batch_mismatches = 0
+        self.processor = bot.ChatUpdateProcessor()
+
+    def install(self):
+        bot = self.bot
+        llm = RecordedLLM(bot, self.events, self.options.speed)
+        bot.llm_client.complete = llm.complete
+        bot.llm_client.stream = llm.stream
+        self.llm = llm
+
+        async def fake_render(clean_text, output_file):
+            with open(output_file, "wb") as audio:
+                audio.write(b"\0" * len(clean_text))
+            return len(clean_text), len(clean_text), 0.0
+
+        bot._render_speech = fake_render
+
+        finish = bot.Trace.finish
+        traces = self.traces
+
+        def collect(trace, status="ok"):
+            traces.append({"kind": trace.kind, "duration": time.perf_counter() - trace.started,
+                           "stages": dict(trace.stages)})
+            finish(trace, status)
+
+        bot.Trace.finish = collect
+        bot.turn_coalescer._drain = self.drain
+
+    async def drain(self, chat_id):
+        """Собирать раунды чата из записанных обновлений вместо окна сбора"""
+        coalescer = self.bot.turn_coalescer
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.sleep(coalescer.window)
+            while coalescer._pending.get(chat_id):
+                expected = self.batches[chat_id].popleft() if self.batches[chat_id] else None
+                deadline = loop.time() + BATCH_WAIT
+                while expected and loop.time() < deadline and not expected <= {
+                        action.update.update_id for action in coalescer._pending.get(chat_id, [])}:
+                    await asyncio.sleep(0.001)
+                pending = coalescer._pending.pop(chat_id, [])
+                batch = [action for action in pending if expected is None or action.update.update_id in expected]
+                rest = [action for action in pending if action not in batch]
+                if rest:
+                    coalescer._pending[chat_id] = rest
+                if expected is not None and {action.update.update_id for action in batch} != expected:
+                    self.batch_mismatches += 1
+                if batch:
+                    await coalescer._play(chat_id, batch)
+        finally:
+            coalescer._tasks.pop(chat_id, None)
+            coalescer._pending.pop(chat_id, None)
+
+    async def prepare(self, event, chat_data, user_data):
+        """Восстановить состояние, созданное до начала записи или вне бота"""
+        bot = self.bot
+        if event["session_id"] and not chat_data.get('active_session_id'):
+            chat_data['active_session_id'] = await bot.db.execute(
+                "INSERT INTO game_sessions (chat_id, campaign_name, campaign_type, setting_description, current_location, current_quest) "
+                "VALUES (?, 'Записанная кампания', 'героика', '', '', '')",
+                (event["chat_id"],),
+            )
+            bot.chat_state.mark(event["chat_id"], chat_data)
+        session_id = chat_data.get('active_session_id')
+        if (event["handler"] == "handle_text" and session_id and not user_data.get('expecting_campaign_choice')
+                and (session_id, event["user_id"]) not in self.characters):
+            # Персонажи создаются вне записанных обработчиков
+            self.characters.add((session_id, event["user_id"]))
+            if not await bot.db.fetchone(bot.SQL_PLAYER_CHARACTER, (session_id, event["user_id"])):
+                await bot.db.execute(
+                    "INSERT INTO characters (session_id, player_id, player_name, name, race, class, hp, max_hp) "
+                    "VALUES (?, ?, ?, ?, 'человек', 'воин', 10, 10)",
+                    (session_id, event["user_id"], event["first_name"], event["first_name"]),
+                )
+                bot.session_cache.invalidate(session_id)
+
+    async def dispatch(self, event):
+        text = event["text"] or ""
+        update = FakeUpdate(self.telegram, FakeChat(event["chat_id"]), FakeUser(event["user_id"], event["first_name"]), text)
+        update.update_id = event.get("update_id", update.update_id)
+        # Обновления одного чата — по очереди, как в боте
+        await self.processor.process_update(update, self.handle(event, update))
+
+    async def handle(self, event, update):
+        chat_data = await self.bot.chat_state.get(event["chat_id"])
+        user_data = await self.bot.user_state.get(event["user_id"])
+        await self.prepare(event, chat_data, user_data)
+        text = event["text"] or ""
+        args = text.split()[1:] if text.startswith("/") else []
+        handler = self.bot.traced(self.bot.with_state(getattr(self.bot, event["handler"])))
+        await handler(update, FakeContext({}, {}, args))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for event in self.events:
+            if event["type"] != "update":
+                continue
+            delay = started + event["t"] / self.options.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Обновления обрабатываются параллельно, как при concurrent_updates
+            self.tasks.append(asyncio.create_task(self.dispatch(event)))
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # Дождаться ходов, собранных в окне после последних сообщений
+        while self.bot.turn_coalescer._tasks:
+            await asyncio.sleep(0.01)
+        return loop.time() - started
+
+
+def report(recorded, replayed, baseline, recorded_span, elapsed, missing, batch_mismatches):
+    print(f"\nЗапись: {recorded_span:.1f} с, воспроизведение: {elapsed:.2f} с "
+          f"(в {recorded_span / elapsed if elapsed else 0:.0f} раз быстрее реального времени)")
+    if missing:
+        print(f"Ответов LLM не по номеру запроса: {missing} (использованы ответы на тот же системный промпт)")
+    if batch_mismatches:
+        print(f"Раундов с другим составом действий: {batch_mismatches}")
+    print(f"\n{'Вид':<22}{'записано':>10}{'p50 зап.':>11}{'повторено':>11}{'p50 повт.':>11}{'p95 повт.':>11}")
+    for kind, stats in sorted(replayed["kinds"].items()):
+        original = recorded["kinds"].get(kind, {"count": 0, "p50": 0.0})
+        print(f"{kind:<22}{original['count']:>10}{original['p50'] * 1000:>11.1f}{stats['count']:>11}"
+              f"{stats['p50'] * 1000:>11.1f}{stats['p95'] * 1000:>11.1f}")
+    columns = f"{'Этап хода, мс':<22}{'запись':>10}{'повтор':>10}"
+    if baseline:
+        columns += f"{'база':>10}{'разница':>10}"
+    print("\n" + columns)
+    names = sorted(set(recorded["turn_stages"]) | set(replayed["turn_stages"]))
+    rows = [(name, recorded["turn_stages"].get(name, 0.0), replayed["turn_stages"].get(name, 0.0),
+             baseline["turn_stages"].get(name, 0.0) if baseline else None) for name in names]
+    rows.append(("накладные расходы", recorded["turn_overhead"], replayed["turn_overhead"],
+                 baseline["turn_overhead"] if baseline else None))
+    for name, original, current, base in rows:
+        line = f"{name:<22}{original * 1000:>10.2f}{current * 1000:>10.2f}"
+        if base is not None:
+            line += f"{base * 1000:>10.2f}{(current - base) * 1000:>+10.2f}"
+        print(line)
+    print("\nllm, tts, coalesce и queue_* сжаты в --speed раз; сравнивайте накладные расходы")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="файл записи (SESSION_TRACE_PATH)")
+    parser.add_argument("--speed", type=float, default=50, help="во сколько раз сжимать паузы и задержки")
+    parser.add_argument("--db", help="снимок базы данных на момент начала записи (копируется)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка вызова Bot API, с")
+    parser.add_argument("--save", help="сохранить сводку воспроизведения в JSON")
+    parser.add_argument("--baseline", help="сводка предыдущего воспроизведения для сравнения")
+    parser.add_argument("--verbose", action="store_true", help="показывать журнал бота")
+    return parser.parse_args(argv)
+
+
+async def main_async(options):
+    events = read_events(options.trace)
+    start = next((event for event in events if event["type"] == "start"), {})
+    workdir = tempfile.mkdtemp(prefix="dnd_replay_")
+    db_path = os.path.join(workdir, "dnd_bot.db")
+    if options.db:
+        shutil.copyfile(options.db, db_path)
+    # Настройки бота читаются при импорте, поэтому окружение задается заранее
+    os.environ.pop("SESSION_TRACE_PATH", None)
+    os.environ.update({
+        "DB_PATH": db_path,
+        "TTS_CACHE_DIR": os.path.join(workdir, "tts_cache"),
+        "LLM_STREAMING": "1" if start.get("streaming", True) else "0",
+        "TURN_WINDOW": str(start.get("turn_window", 1.5) / options.speed),
+        "STREAM_EDIT_INTERVAL": str(start.get("stream_edit_interval", 1.0) / options.speed),
+        "OPTION_STOCK_SIZE": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    bot.setup_database()
+    bot.seed_dice(start.get("seed", 0))
+    replay = Replay(bot, events, options)
+    replay.install()
+    try:
+        elapsed = await replay.run()
+    finally:
+        await bot.on_shutdown(None)
+
+    recorded = summarize([event for event in events if event["type"] == "trace"])
+    replayed = summarize(replay.traces)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    recorded_span = max((event["t"] for event in events), default=0.0)
+    report(recorded, replayed, baseline, recorded_span, elapsed, replay.llm.missing, replay.batch_mismatches)
+    if options.save:
+        with open(options.save, "w", encoding="utf-8") as save_file:
+            json.dump(replayed, save_file, ensure_ascii=False, indent=2)
+
+
+def main(argv=None):
+    asyncio.run(main_async(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""Локальная проверка режима вебхука с несколькими рабочими процессами.
+
+Запускает bot.py в режиме вебхука (фронт и WORKERS рабочих процессов),
+имитацию Bot API, принимающую ответы бота, и имитацию LLM из loadtest.py,
+затем отправляет на вебхук обновления в формате Telegram от нескольких
+чатов: /speak (выключить озвучку), /new_game, выбор кампании и ходы
+игроков. Персонажи добавляются прямо в базу, как в loadtest.py. В отчете —
+задержка от действия игрока до первого ответа бота в чате, пропускная
+способность и распределение обновлений по рабочим процессам из метрик
+фронта.
+
+Запуск: python webhook_poster.py --workers 4 --chats 40 --players 2 --turns 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+import httpx
+
+from loadtest import FakeLLMServer, percentile
+
+TOKEN = "123456:fake"
+SECRET = "poster-secret"
+
+
+class FakeBotAPI:
+    """Имитация Bot API: отвечает на вызовы бота и запоминает сообщения по чатам"""
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.calls = defaultdict(int)
+        self.replies = defaultdict(list)  # chat_id -> [(время, метод, текст)]
+        self.changed = asyncio.Condition()
+        self.webhook = None
+        self._message_id = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, _, header_block = head.decode("latin-1").partition("\r\n")
+                headers = dict(line.lower().split(": ", 1) for line in header_block.split("\r\n") if ": " in line)
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                method = request_line.split(" ")[1].rsplit("/", 1)[-1]
+                result = await self._call(method, self._params(headers.get("content-type", ""), body))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(content_type, body):
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            # Из файлов нужны только текстовые поля
+            return dict(re.findall(rb'name="(\w+)"\r\n(?:[^\r\n]+\r\n)*\r\n([^\r]*)\r\n', body))
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    async def _call(self, method, params):
+        self.calls[method] += 1
+        params = {(k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+                  for k, v in params.items()}
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Мастер", "username": "dm_test_bot"}
+        if method == "setWebhook":
+            self.webhook = params.get("url")
+            async with self.changed:
+                self.changed.notify_all()
+            return True
+        if method not in ("sendMessage", "editMessageText", "sendVoice"):
+            return True
+        chat_id = int(params["chat_id"])
+        self._message_id += 1
+        async with self.changed:
+            self.replies[chat_id].append((time.perf_counter(), method, params.get("text") or params.get("caption", "")))
+            self.changed.notify_all()
+        message = {"message_id": int(params.get("message_id", self._message_id)), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "group", "title": f"Чат {chat_id}"}, "text": params.get("text", "")}
+        if method == "sendVoice":
+            message["voice"] = {"file_id": "voice", "file_unique_id": "voice", "duration": 1}
+        return message
+
+    async def wait_for(self, predicate, timeout):
+        async with self.changed:
+            await asyncio.wait_for(self.changed.wait_for(predicate), timeout)
+
+    async def wait_reply(self, chat_id, since, marker, timeout):
+        """Дождаться ответа в чате после since, содержащего marker; вернуть его время"""
+        def found():
+            return next((t for t, _, text in self.replies[chat_id] if t >= since and marker in text), None)
+        await self.wait_for(lambda: found() is not None, timeout)
+        return found()
+
+
+def free_port(count=1):
+    """Первый из count свободных подряд портов"""
+    while True:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            base = probe.getsockname()[1]
+        if base + count > 65535:
+            continue
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+
+
+class Poster:
+    """Отправитель обновлений на вебхук от имени игроков"""
+
+    def __init__(self, url, api, options, db_path):
+        self.url = url
+        self.api = api
+        self.options = options
+        self.db_path = db_path
+        self.client = httpx.AsyncClient(timeout=30)
+        self.update_id = 0
+        self.posted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.reply_latency = []
+
+    async def post(self, chat_id, user_id, text):
+        self.update_id += 1
+        message = {
+            "message_id": self.update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "group", "title": f"Чат {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Игрок{user_id}"},
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        while True:
+            response = await self.client.post(self.url, json={"update_id": self.update_id, "message": message},
+                                              headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            if response.status_code != 503:
+                response.raise_for_status()
+                break
+            # Как Telegram: повторить доставку позже
+            self.rejected += 1
+            await asyncio.sleep(0.5)
+        self.posted += 1
+        return time.perf_counter()
+
+    async def command(self, chat_id, user_id, text, marker):
+        """Отправить обновление и вернуть задержку ответа или None, если ответа не было"""
+        sent = await self.post(chat_id, user_id, text)
+        try:
+            return await self.api.wait_reply(chat_id, sent, marker, self.options.timeout) - sent
+        except asyncio.TimeoutError:
+            # Например, рабочий процесс упал, не успев ответить
+            self.timeouts += 1
+            return None
+
+    def add_characters(self, chat_id, players):
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            session_id = conn.execute("SELECT MAX(session_id) FROM game_sessions WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO characters (session_id, player_id, player_name, name, race, class, hp, max_hp) "
+                "VALUES (?, ?, ?, ?, 'человек', 'воин', 12, 12)",
+                [(session_id, player, f"Игрок{player}", f"Герой{player}") for player in players],
+            )
+
+    async def run_chat(self, chat_index):
+        options = self.options
+        chat_id = -1000 - chat_index
+        owner = chat_index * 100 + 1
+        await self.command(chat_id, owner, "/speak", "Голосовое повествование")
+        await self.command(chat_id, owner, "/new_game", "1")
+        if await self.command(chat_id, owner, "1", "успешно создана") is None:
+            return
+        players = [owner + i for i in range(options.players)]
+        await asyncio.to_thread(self.add_characters, chat_id, players)
+
+        async def play(player):
+            for turn in range(options.turns):
+                await asyncio.sleep(random.uniform(0, options.think_time))
+                # Ответом на действие считается первый текст после него, в том числе правка потока
+                latency = await self.command(chat_id, player, f"Я осматриваю комнату и ищу ловушки ({turn})", "")
+                if latency is not None:
+                    self.reply_latency.append(latency)
+
+        await asyncio.gather(*(play(player) for player in players))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def front_metrics(text):
+    """Обновления, принятые фронтом, по рабочим процессам"""
+    return {int(worker): float(value) for worker, value in
+            re.findall(r'^bot_webhook_updates_total\{worker="(\d+)"\} (\S+)$', text, re.MULTILINE)}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2, help="число рабочих процессов бота")
+    parser.add_argument("--chats", type=int, default=10, help="число одновременных чатов")
+    parser.add_argument("--players", type=int, default=2, help="игроков в чате")
+    parser.add_argument("--turns", type=int, default=3, help="ходов на игрока")
+    parser.add_argument("--think-time", type=float, default=1.0, help="макс. пауза игрока перед ходом, с")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="задержка LLM до первого токена, с")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="разброс задержки LLM, с")
+    parser.add_argument("--llm-tps", type=float, default=200, help="скорость потоковой выдачи, токенов/с (0 — мгновенно)")
+    parser.add_argument("--turn-window", type=float, default=0.5, help="окно сбора действий в раунд, с")
+    parser.add_argument("--timeout", type=float, default=60, help="предельное ожидание ответа, с")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="показывать журнал бота")
+    return parser.parse_args(argv)
+
+
+async def main_async(options):
+    random.seed(options.seed)
+    llm = FakeLLMServer(options.llm_latency, options.llm_jitter, options.llm_tps)
+    api = FakeBotAPI()
+    await llm.start()
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix="dnd_webhook_")
+    db_path = os.path.join(workdir, "dnd_bot.db")
+    webhook_port, metrics_port = free_port(), free_port(options.workers + 1)
+    url = f"http://127.0.0.1:{webhook_port}/telegram"
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        TELEGRAM_API_BASE=f"http://127.0.0.1:{api.port}/bot",
+        WEBHOOK_URL=url,
+        WEBHOOK_HOST="127.0.0.1",
+        WEBHOOK_PORT=str(webhook_port),
+        WEBHOOK_SECRET=SECRET,
+        WORKERS=str(options.workers),
+        WORKER_BASE_PORT=str(free_port(options.workers)),
+        METRICS_PORT=str(metrics_port),
+        DB_PATH=db_path,
+        TTS_CACHE_DIR=os.path.join(workdir, "tts_cache"),
+        ARCHIVE_DIR=os.path.join(workdir, "archive"),
+        LLM_BACKENDS=json.dumps([{"name": "fake", "api_base": f"http://127.0.0.1:{llm.port}", "api_key": "-"}]),
+        TURN_WINDOW=str(options.turn_window),
+        OPTION_STOCK_SIZE="0",
+        STREAM_EDIT_INTERVAL="0.5",
+    )
+    env.pop("WORKER_INDEX", None)
+    env.pop("SESSION_TRACE_PATH", None)
+    bot_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    output = None if options.verbose else asyncio.subprocess.DEVNULL
+    front = await asyncio.create_subprocess_exec(sys.executable, bot_script, env=env, stdout=output, stderr=output)
+    poster = Poster(url, api, options, db_path)
+    try:
+        await api.wait_for(lambda: api.webhook == url, options.timeout)
+        started = time.perf_counter()
+        await asyncio.gather(*(poster.run_chat(i) for i in range(options.chats)))
+        elapsed = time.perf_counter() - started
+        async with httpx.AsyncClient() as client:
+            distribution = front_metrics((await client.get(f"http://127.0.0.1:{metrics_port}/metrics")).text)
+    finally:
+        await poster.close()
+        if front.returncode is None:
+            front.terminate()
+        await front.wait()
+        await api.stop()
+        await llm.stop()
+
+    print(f"\nРабочих процессов: {options.workers}, чатов: {options.chats}, игроков в чате: {options.players}, "
+          f"ходов на игрока: {options.turns}")
+    print(f"Время: {elapsed:.2f} с; обновлений: {poster.posted} ({poster.posted / elapsed:.1f}/с), "
+          f"отклонено с 503: {poster.rejected}, без ответа: {poster.timeouts}, запросов к LLM: {llm.requests}")
+    latency = poster.reply_latency
+    print(f"От действия до ответа: p50 {percentile(latency, 50) * 1000:.0f} мс, p95 {percentile(latency, 95) * 1000:.0f} мс, "
+          f"p99 {percentile(latency, 99) * 1000:.0f} мс")
+    print(f"Bot API: {dict(api.calls)}")
+    print(f"Обновлений по рабочим процессам: {dict(sorted(distribution.items()))}")
+    print(f"Код завершения фронта: {front.returncode}")
+
+
+def main(argv=None):
+    asyncio.run(main_async(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()